@@ -1,11 +1,21 @@
 import os
-import json
+import json_codec as json
 import re
 import time
+import random
+import threading
 import requests
+from requests.adapters import HTTPAdapter
+from contextlib import contextmanager
 from google import genai
 from google.genai import types
 
+from llm_cache import LLMCache
+from llm_metrics import llm_metrics
+from image_cache import ImageSearchCache
+from image_pipeline import mirror_image
+from singleflight import SingleFlight
+
 # --- CONFIGURATION ---
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")   
 
@@ -14,12 +24,234 @@ if not GEMINI_API_KEY:
 
 # ✅ User Requested Model
 MODEL_NAME = "gemma-3-27b-it" 
+GENERATION_PARAMS = {"temperature": 0.7}
+
+# Shared across users: identical prompts are only ever generated once
+llm_cache = LLMCache()
+
+# Outbound quota (defaults match the Gemma free tier)
+LLM_REQUESTS_PER_MINUTE = int(os.environ.get("LLM_REQUESTS_PER_MINUTE", 30))
+LLM_TOKENS_PER_MINUTE = int(os.environ.get("LLM_TOKENS_PER_MINUTE", 15000))
+LLM_MAX_CONCURRENCY = 8
+LLM_TARGET_LATENCY_S = 20      # Slower than this and we start backing off concurrency
+EXPECTED_OUTPUT_TOKENS = 1200  # Budgeted per call until usage_metadata tells us the real count
 
 try:
     client = genai.Client(api_key=GEMINI_API_KEY)
 except Exception as e:
     print(f"❌ Error initializing Gemini Client: {e}")
 
+# --- 🚦 OUTBOUND RATE LIMITER ---
+
+def _is_throttle_error(e):
+    text = str(e)
+    return any(code in text for code in ("429", "503", "RESOURCE_EXHAUSTED", "UNAVAILABLE"))
+
+def _backoff_delay(attempt, base=1.0, cap=30.0):
+    # Exponential backoff with jitter, so retries from different workers don't line up
+    return min(cap, base * (2 ** attempt)) * random.uniform(0.5, 1.5)
+
+def _estimate_tokens(prompt):
+    return len(prompt) // 4 + EXPECTED_OUTPUT_TOKENS
+
+class OutboundLimiter:
+    """
+    Gate in front of every Gemini call:
+    - token buckets for requests/min and tokens/min,
+    - AIMD concurrency limit (halved on 429/503, grows back slowly while latency is healthy),
+    - foreground calls are always admitted ahead of waiting prefetch calls,
+      and a prefetch someone is now waiting on can be promote()d to foreground.
+    """
+
+    def __init__(self, rpm, tpm, max_concurrency, min_concurrency=1, target_latency_s=LLM_TARGET_LATENCY_S):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.target_latency_s = target_latency_s
+
+        self._cond = threading.Condition()
+        self._request_budget = float(rpm)
+        self._token_budget = float(tpm)
+        self._last_refill = time.monotonic()
+        self._limit = float(max_concurrency)
+        self._in_flight = 0
+        self._foreground_waiting = 0
+        self._stats = {"admitted": 0, "foreground": 0, "background": 0, "promoted": 0, "throttled": 0, "slow": 0, "wait_s": 0.0}
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        self._request_budget = min(self.rpm, self._request_budget + elapsed * self.rpm / 60)
+        self._token_budget = min(self.tpm, self._token_budget + elapsed * self.tpm / 60)
+
+    def acquire(self, est_tokens, priority=None):
+        """priority: None for a foreground call, else the CallPriority of a background block."""
+        est_tokens = min(est_tokens, self.tpm)  # A huge prompt must still be admissible eventually
+        started = time.monotonic()
+        counted = False
+        with self._cond:
+            try:
+                while True:
+                    # Re-read every pass: a waiting background call may have been promoted meanwhile
+                    foreground = priority is None or not priority.background
+                    if foreground and not counted:
+                        self._foreground_waiting += 1
+                        counted = True
+                    self._refill()
+                    yields_to_foreground = not foreground and self._foreground_waiting > 0
+                    if (not yields_to_foreground
+                            and self._in_flight < int(self._limit)
+                            and self._request_budget >= 1
+                            and self._token_budget >= est_tokens):
+                        self._request_budget -= 1
+                        self._token_budget -= est_tokens
+                        self._in_flight += 1
+                        self._stats["admitted"] += 1
+                        self._stats["foreground" if foreground else "background"] += 1
+                        self._stats["wait_s"] += time.monotonic() - started
+                        return
+
+                    # Sleep until the buckets could cover this call, or a slot is released
+                    refill_s = max(
+                        (1 - self._request_budget) * 60 / self.rpm,
+                        (est_tokens - self._token_budget) * 60 / self.tpm,
+                        0.05
+                    )
+                    self._cond.wait(timeout=min(refill_s, 1.0))
+            finally:
+                if counted:
+                    self._foreground_waiting -= 1
+                    self._cond.notify_all()
+
+    def release(self, est_tokens, used_tokens, latency_s, throttled):
+        with self._cond:
+            self._in_flight -= 1
+            if used_tokens is not None:
+                self._token_budget -= used_tokens - est_tokens  # Settle the estimate against real usage
+
+            if throttled:
+                # Multiplicative decrease, and pause new requests until the bucket refills a bit
+                self._limit = max(self.min_concurrency, self._limit / 2)
+                self._request_budget = min(self._request_budget, 0)
+                self._stats["throttled"] += 1
+            elif latency_s > self.target_latency_s:
+                self._limit = max(self.min_concurrency, self._limit * 0.9)
+                self._stats["slow"] += 1
+            else:
+                # Additive increase: roughly +1 per `limit` successful calls
+                self._limit = min(self.max_concurrency, self._limit + 1 / self._limit)
+            self._cond.notify_all()
+
+    def promote(self, priority):
+        """A user is now waiting on this background work: its calls (queued or future) go first."""
+        with self._cond:
+            if not priority.background: return
+            priority.background = False
+            self._stats["promoted"] += 1
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, est_tokens):
+        """Holds one admitted call. Set usage['tokens'] to report real token usage."""
+        self.acquire(est_tokens, getattr(_call_context, "priority", None))
+        usage = {"tokens": None}
+        started = time.monotonic()
+        throttled = False
+        try:
+            yield usage
+        except Exception as e:
+            throttled = _is_throttle_error(e)
+            raise
+        finally:
+            self.release(est_tokens, usage["tokens"], time.monotonic() - started, throttled)
+
+    def stats(self):
+        with self._cond:
+            self._refill()
+            stats = dict(self._stats)
+            stats["wait_s"] = round(stats["wait_s"], 3)
+            stats.update({
+                "concurrency_limit": round(self._limit, 2),
+                "in_flight": self._in_flight,
+                "foreground_waiting": self._foreground_waiting,
+                "request_budget": round(self._request_budget, 2),
+                "token_budget": round(self._token_budget),
+            })
+        return stats
+
+_call_context = threading.local()
+llm_limiter = OutboundLimiter(LLM_REQUESTS_PER_MINUTE, LLM_TOKENS_PER_MINUTE, LLM_MAX_CONCURRENCY)
+
+class CallPriority:
+    """Priority shared by the calls of one background_llm_calls() block; see OutboundLimiter.promote()."""
+    __slots__ = ("background",)
+
+    def __init__(self):
+        self.background = True
+
+@contextmanager
+def background_llm_calls():
+    """Marks LLM calls made in this block (on this thread) as prefetch traffic. Yields its CallPriority."""
+    previous = getattr(_call_context, "priority", None)
+    priority = _call_context.priority = CallPriority()
+    try:
+        yield priority
+    finally:
+        _call_context.priority = previous
+
+def _usage_tokens(response):
+    usage = getattr(response, "usage_metadata", None)
+    return getattr(usage, "total_token_count", None) if usage else None
+
+def _generate_content(prompt, config=None, call=None):
+    """
+    The only path to client.models.generate_content: rate limited and measured.
+    call: an llm_metrics.LLMCall naming the caller / attempt (JSON callers finish it with the parse outcome).
+    """
+    call = call or llm_metrics.call("unknown")
+    call.start()
+    try:
+        with llm_limiter.slot(_estimate_tokens(prompt)) as usage:
+            call.admitted()
+            response = client.models.generate_content(model=MODEL_NAME, contents=prompt, config=config)
+            usage["tokens"] = _usage_tokens(response)
+            call.set_usage(getattr(response, "usage_metadata", None))
+    except Exception as e:
+        call.end("throttled" if _is_throttle_error(e) else "error")
+        raise
+    call.end("ok")
+    return response
+
+def _generate_content_stream(prompt, config=None, call=None):
+    """Streaming twin of _generate_content; the slot is held until the stream ends or is closed."""
+    call = call or llm_metrics.call("unknown", streamed=True)
+    call.start()
+    outcome = "error"
+    try:
+        with llm_limiter.slot(_estimate_tokens(prompt)) as usage:
+            call.admitted()
+            stream = client.models.generate_content_stream(model=MODEL_NAME, contents=prompt, config=config)
+            try:
+                for chunk in stream:
+                    call.first_chunk()
+                    usage["tokens"] = _usage_tokens(chunk) or usage["tokens"]  # Final chunk carries the totals
+                    call.set_usage(getattr(chunk, "usage_metadata", None))
+                    yield chunk
+                outcome = "ok"
+            finally:
+                close = getattr(stream, "close", None)
+                if close: close()
+    except GeneratorExit:
+        outcome = "cancelled"
+        raise
+    except Exception as e:
+        if _is_throttle_error(e): outcome = "throttled"
+        raise
+    finally:
+        call.end(outcome)
+
 # --- HELPER: JSON CLEANER ---
 def clean_json_text(text):
     """
@@ -39,68 +271,342 @@ def clean_json_text(text):
     if start != -1 and end != 0: return text[start:end]
     return text
 
-def _get_json_response(prompt):
+# --- HELPER: TOLERANT JSON REPAIR ---
+# Re-asking the model costs seconds and tokens, so a reply that json.loads rejects
+# is first repaired: truncated tails are closed, trailing commas dropped, raw control
+# characters / stray inner quotes / single-quoted strings accepted. If a member is
+# beyond repair, the members before it are kept (e.g. the lesson without its quiz).
+LOSSY_REPAIRS = {"truncation", "partial", "dropped_quiz_items"}  # Data was lost: usable, but not cached
+
+_MISSING = object()
+_NUMBER_RE = re.compile(r'-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?')
+_NUMBER_CUT_RE = re.compile(r'[.eE][-+]?\s*')
+_WORD_RE = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+_STRING_RUN = {'"': re.compile(r'[^"\\\x00-\x1f]+'), "'": re.compile(r"[^'\\\x00-\x1f]+")}
+_LITERALS = {"true": True, "false": False, "null": None, "True": True, "False": False, "None": None}
+_ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+class _TolerantJSON:
+    """Recursive-descent parser that repairs as it goes; .repairs names every fix applied."""
+
+    def __init__(self, text):
+        self.s, self.n = text, len(text)
+        self.i = 0
+        self.depth = 0
+        self.repairs = set()
+
+    def parse(self):
+        starts = [p for p in (self.s.find('{'), self.s.find('[')) if p != -1]
+        if not starts: raise ValueError("no JSON object in response")
+        self.i = min(starts)
+        value = self._value()
+        if value is _MISSING: raise ValueError("response truncated before any data")
+        return value
+
+    def _skip_ws(self):
+        while self.i < self.n and self.s[self.i] in " \t\r\n":
+            self.i += 1
+        return self.i < self.n
+
+    def _value(self):
+        if not self._skip_ws():
+            self.repairs.add("truncation")
+            return _MISSING
+        c = self.s[self.i]
+        if c == '{': return self._object()
+        if c == '[': return self._array()
+        if c in "\"'": return self._string(c)
+        if c == '-' or c.isdigit(): return self._number()
+        return self._literal()
+
+    def _object(self):
+        self.i += 1
+        self.depth += 1
+        result, after_comma = {}, False
+        try:
+            while True:
+                if not self._skip_ws():
+                    self.repairs.add("truncation")
+                    return result
+                c = self.s[self.i]
+                if c in '}]':
+                    if after_comma: self.repairs.add("trailing_commas")
+                    if c == ']': self.repairs.add("mismatched_brackets")
+                    self.i += 1
+                    return result
+                if c == ',':
+                    self.i += 1
+                    after_comma = True
+                    continue
+                if result and not after_comma: self.repairs.add("missing_commas")
+
+                try:
+                    key = self._key()
+                    if not self._skip_ws():
+                        self.repairs.add("truncation")
+                        return result
+                    if self.s[self.i] != ':': raise ValueError(f"expected ':' at {self.i}")
+                    self.i += 1
+                    value = self._value()
+                except ValueError:
+                    if self.depth > 1: raise
+                    self.repairs.add("partial")  # Keep the top-level members that did parse
+                    return result
+                if value is _MISSING: return result
+                result[key] = value
+                after_comma = False
+        finally:
+            self.depth -= 1
+
+    def _key(self):
+        c = self.s[self.i]
+        if c in "\"'": return self._string(c)
+        match = _WORD_RE.match(self.s, self.i)
+        if not match: raise ValueError(f"unexpected {c!r} at {self.i}")
+        self.repairs.add("unquoted_keys")
+        self.i = match.end()
+        return match.group()
+
+    def _array(self):
+        self.i += 1
+        self.depth += 1
+        result, after_comma = [], False
+        try:
+            while True:
+                if not self._skip_ws():
+                    self.repairs.add("truncation")
+                    return result
+                c = self.s[self.i]
+                if c in ']}':
+                    if after_comma: self.repairs.add("trailing_commas")
+                    if c == '}': self.repairs.add("mismatched_brackets")
+                    self.i += 1
+                    return result
+                if c == ',':
+                    self.i += 1
+                    after_comma = True
+                    continue
+                if result and not after_comma: self.repairs.add("missing_commas")
+                value = self._value()
+                if value is _MISSING: return result
+                result.append(value)
+                after_comma = False
+        finally:
+            self.depth -= 1
+
+    def _string(self, quote):
+        if quote == "'": self.repairs.add("single_quotes")
+        self.i += 1
+        run, parts = _STRING_RUN[quote], []
+        while True:
+            match = run.match(self.s, self.i)
+            if match:
+                parts.append(match.group())
+                self.i = match.end()
+            if self.i >= self.n:
+                self.repairs.add("truncation")
+                return "".join(parts)
+
+            c = self.s[self.i]
+            if c == quote:
+                # A quote only closes the string if JSON structure follows; otherwise it is an unescaped inner quote
+                j = self.i + 1
+                while j < self.n and self.s[j] in " \t\r\n": j += 1
+                self.i += 1
+                if j >= self.n or self.s[j] in ",:}]":
+                    return "".join(parts)
+                self.repairs.add("unescaped_quotes")
+                parts.append(c)
+            elif c == "\\":
+                if self.i + 1 >= self.n:
+                    self.i = self.n
+                    continue
+                esc = self.s[self.i + 1]
+                if esc == "u":
+                    code = self.s[self.i + 2:self.i + 6]
+                    if len(code) < 4:
+                        self.i = self.n
+                        continue
+                    try: parts.append(chr(int(code, 16)))
+                    except ValueError:
+                        self.repairs.add("invalid_escapes")
+                        parts.append(code)
+                    self.i += 6
+                else:
+                    if esc not in _ESCAPES: self.repairs.add("invalid_escapes")  # e.g. \' or \_ : keep the character
+                    parts.append(_ESCAPES.get(esc, esc))
+                    self.i += 2
+            else:
+                self.repairs.add("control_characters")  # Raw newline / tab inside a string
+                parts.append(c)
+                self.i += 1
+
+    def _number(self):
+        match = _NUMBER_RE.match(self.s, self.i)
+        if not match:
+            if self.s[self.i:].strip() != "-": raise ValueError(f"bad number at {self.i}")
+            self.repairs.add("truncation")
+            self.i = self.n
+            return _MISSING
+        self.i = match.end()
+        if _NUMBER_CUT_RE.fullmatch(self.s, self.i):  # "12." / "1e-" cut off mid-number
+            self.repairs.add("truncation")
+            self.i = self.n
+        text = match.group()
+        return float(text) if any(ch in text for ch in ".eE") else int(text)
+
+    def _literal(self):
+        match = _WORD_RE.match(self.s, self.i)
+        if not match: raise ValueError(f"unexpected {self.s[self.i]!r} at {self.i}")
+        word = match.group()
+        self.i = match.end()
+        if word in _LITERALS:
+            if word[0].isupper(): self.repairs.add("python_literals")
+            return _LITERALS[word]
+        if self.i >= self.n and any(lit.startswith(word) for lit in _LITERALS):
+            self.repairs.add("truncation")
+            return _MISSING
+        raise ValueError(f"unexpected {word!r} at {match.start()}")
+
+def parse_llm_json(text):
     """
-    Sends prompt to AI and retries if JSON parsing fails.
+    Parses a model's JSON reply. Returns (data, repairs): repairs is [] for valid JSON,
+    otherwise the names of the fixes that were needed. Raises ValueError if nothing usable is left.
     """
+    try:
+        return json.loads(clean_json_text(text)), []
+    except ValueError:
+        pass
+    if not text: raise ValueError("empty response")
+
+    parser = _TolerantJSON(text)
+    data = parser.parse()
+    if not data: raise ValueError("no usable JSON in response")
+    return data, sorted(parser.repairs)
+
+_parse_lock = threading.Lock()
+_parse_stats = {"calls": 0, "attempts": 0, "retries": 0, "clean": 0, "repaired": 0, "lossy": 0,
+                "parse_failures": 0, "gave_up": 0, "repairs": {}}
+
+def _record_parse(key, repairs=()):
+    with _parse_lock:
+        _parse_stats[key] += 1
+        for name in repairs:
+            _parse_stats["repairs"][name] = _parse_stats["repairs"].get(name, 0) + 1
+
+def parse_stats():
+    with _parse_lock:
+        stats = dict(_parse_stats, repairs=dict(_parse_stats["repairs"]))
+    stats["retry_rate"] = round(stats["retries"] / stats["calls"], 3) if stats["calls"] else 0.0
+    return stats
+
+def _normalize_quiz(data):
+    """Maps letter answers to option text and drops unusable (e.g. truncated) questions. Returns how many were dropped."""
+    if 'quiz' in data and isinstance(data['quiz'], list):
+        complete = [q for q in data['quiz'] if isinstance(q, dict) and q.get('question')
+                    and isinstance(q.get('options'), list) and len(q['options']) >= 2 and q.get('correct_answer')]
+        dropped = len(data['quiz']) - len(complete)
+        data['quiz'] = complete
+
+        # Fix Quiz Options (Map A/B/C/D to full text if needed)
+        idx_map = {'A': 0, 'B': 1, 'C': 2, 'D': 3}
+        for q in data['quiz']:
+            ans = str(q.get('correct_answer', '')).replace('.', '').strip().upper()
+            opts = q.get('options', [])
+            # If answer is "A", convert it to the actual text of Option A
+            if ans in idx_map and idx_map[ans] < len(opts):
+                q['correct_answer'] = opts[idx_map[ans]]
+        return dropped
+    return 0
+
+def _get_json_response(prompt, use_cache=True, required=(), caller="unknown", reject_lossy=False):
+    """
+    Sends prompt to AI; malformed JSON is repaired first, and a fresh call is only made
+    when nothing usable (with every `required` key) can be recovered.
+    Parsed results are served from / stored in the shared LLM cache unless use_cache=False
+    (results that needed a lossy repair are returned but never cached).
+    reject_lossy=True treats a lossy repair as a parse failure, for results that get stored.
+    """
+    cache_key = llm_cache.make_key(prompt, MODEL_NAME, GENERATION_PARAMS)
+    if use_cache:
+        try:
+            cached = llm_cache.get(cache_key)
+            if cached is not None: return cached
+        except Exception as e:
+            print(f"⚠️ LLM Cache Read Error: {e}")
+    else:
+        llm_cache.record_bypass()
+
     max_retries = 3
+    _record_parse("calls")
     for attempt in range(max_retries):
+        _record_parse("attempts")
+        if attempt: _record_parse("retries")
+        call = llm_metrics.call(caller, attempt=attempt + 1, parsed=True)
         try:
             # ✅ FIX: Removed 'response_mime_type' because Gemma doesn't support it
-            response = client.models.generate_content(
-                model=MODEL_NAME, 
-                contents=prompt,
-                config=types.GenerateContentConfig(
-                    temperature=0.7
-                )
-            )
-            
-            cleaned_text = clean_json_text(response.text)
-            
-            try:
-                data = json.loads(cleaned_text)
-            except json.JSONDecodeError as e:
-                # Handle control characters that break JSON
-                if "control character" in str(e):
-                    cleaned_text = cleaned_text.replace('\n', '\\n').replace('\t', '\\t')
-                    data = json.loads(cleaned_text)
-                else:
-                    # If direct parse fails, sometimes models add extra text. 
-                    # We rely on clean_json_text, but if that fails, retry.
-                    raise e 
-
-            # Fix Quiz Options (Map A/B/C/D to full text if needed)
-            if 'quiz' in data and isinstance(data['quiz'], list):
-                idx_map = {'A': 0, 'B': 1, 'C': 2, 'D': 3}
-                for q in data['quiz']:
-                    ans = str(q.get('correct_answer', '')).replace('.', '').strip().upper()
-                    opts = q.get('options', [])
-                    # If answer is "A", convert it to the actual text of Option A
-                    if ans in idx_map and idx_map[ans] < len(opts):
-                        q['correct_answer'] = opts[idx_map[ans]]
-            
-            return data
+            response = _generate_content(prompt, config=types.GenerateContentConfig(**GENERATION_PARAMS), call=call)
+        except Exception as e:
+            print(f"⚠️ AI Call Error (Attempt {attempt+1}): {e}")
+            # Backoff for rate limits (the limiter has already cut concurrency)
+            if _is_throttle_error(e) and attempt < max_retries - 1:
+                time.sleep(_backoff_delay(attempt))
+            continue
 
+        try:
+            data, repairs = parse_llm_json(response.text)
+            if not isinstance(data, dict): raise ValueError("expected a JSON object")
+            if _normalize_quiz(data): repairs.append("dropped_quiz_items")
+            missing = [key for key in required if not data.get(key)]
+            if missing: raise ValueError(f"missing {', '.join(missing)}")
+            lossy = LOSSY_REPAIRS.intersection(repairs)
+            # A cut-off lesson would be saved for good (the streaming path rejects it the same way)
+            if lossy and reject_lossy: raise ValueError(f"lossy repair: {', '.join(sorted(lossy))}")
         except Exception as e:
+            # Only now is a fresh generation worth its cost
+            _record_parse("parse_failures")
+            call.finish(parse="failed")
             print(f"⚠️ AI JSON Error (Attempt {attempt+1}): {e}")
-            # Backoff for rate limits
-            if "503" in str(e) or "429" in str(e): time.sleep(2)
-            
+            continue
+
+        outcome = "lossy" if lossy else "repaired" if repairs else "clean"
+        _record_parse(outcome, repairs)
+        call.finish(parse=outcome)
+        if repairs: print(f"🩹 Repaired AI JSON: {', '.join(repairs)}")
+
+        if use_cache and not lossy:
+            try: llm_cache.put(cache_key, MODEL_NAME, data)
+            except Exception as e: print(f"⚠️ LLM Cache Write Error: {e}")
+        return data
+
+    _record_parse("gave_up")
     return None
 
 # --- 📸 SMART WIKIMEDIA SEARCH ---
 
-def search_wikimedia_image(search_term):
+WIKI_API_URL = "https://commons.wikimedia.org/w/api.php"
+WIKI_TIMEOUT = (3.05, 6)      # (connect, read) - a slow image shouldn't hold up a lesson
+WIKI_MAX_PARALLEL = 4         # Concurrent lookups (the image stage's workers); Commons asks clients to stay polite
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+# One keep-alive session for every lookup: no TCP/TLS handshake per lesson
+wiki_session = requests.Session()
+wiki_session.headers.update({
+    # ✅ FIX: Enhanced User-Agent to prevent 403 blocks
+    'User-Agent': 'LearnAI_Educational_Project/1.0 (contact: admin@learnai.local)',
+    'Accept': 'application/json'
+})
+wiki_session.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=WIKI_MAX_PARALLEL * 2))
+
+image_cache = ImageSearchCache()
+image_flights = SingleFlight()  # Two lessons asking for the same term share one request
+
+def _fetch_wikimedia_image(search_term):
     """
-    Searches Wikimedia Commons for a SPECIFIC term provided by the AI.
-    Returns the URL of the first valid image found.
+    Hits the Commons API for one term. Returns (url_or_None, status)
+    where status is 'found', 'not_found' or 'error'.
     """
-    if not search_term or len(search_term) < 3: 
-        return None
-
-    url = "https://commons.wikimedia.org/w/api.php"
     print(f"🔍 AI Requested Image Search: '{search_term}'")
-    
     params = {
         "action": "query",
         "generator": "search",
@@ -113,42 +619,77 @@ def search_wikimedia_image(search_term):
     }
 
     try:
-        # ✅ FIX: Enhanced User-Agent to prevent 403 blocks
-        headers = { 
-            'User-Agent': 'LearnAI_Educational_Project/1.0 (contact: admin@learnai.local)',
-            'Accept': 'application/json'
-        }
-        
-        res = requests.get(url, params=params, headers=headers, timeout=10)
+        res = wiki_session.get(WIKI_API_URL, params=params, timeout=WIKI_TIMEOUT)
         
         # ✅ FIX: Check if the request was blocked/failed before parsing JSON
         if res.status_code != 200:
             print(f"⚠️ Wiki Search Failed: Status {res.status_code}")
-            return None
+            return None, "error"
 
-        data = res.json()
-        
-        pages = data.get("query", {}).get("pages", {})
-        
-        for page_id, page_data in pages.items():
-            image_info = page_data.get("imageinfo", [{}])[0]
-            image_url = image_info.get("url")
+        pages = res.json().get("query", {}).get("pages", {})
+        # Keep the search ranking: generator results carry an "index"
+        for page_data in sorted(pages.values(), key=lambda p: p.get("index", 0)):
+            image_url = page_data.get("imageinfo", [{}])[0].get("url")
             
             # Filter for common image formats
-            if image_url and ('.jpg' in image_url.lower() or '.png' in image_url.lower() or '.jpeg' in image_url.lower()):
+            if image_url and image_url.lower().endswith(IMAGE_EXTENSIONS):
                 print(f"✅ Found Image: {image_url}")
-                return image_url
+                return image_url, "found"
+        return None, "not_found"
 
     except requests.exceptions.JSONDecodeError:
         print(f"⚠️ Wiki JSON Error. Raw response was not JSON (likely HTML error page).")
     except Exception as e:
         print(f"⚠️ Wiki Search Error: {e}")
+    return None, "error"
+
+def _lookup_and_cache(search_term):
+    image_url, status = _fetch_wikimedia_image(search_term)
+    image_cache.put(search_term, image_url, status)
+    return image_url
+
+def search_wikimedia_image(search_term):
+    """
+    Searches Wikimedia Commons for a SPECIFIC term provided by the AI.
+    Returns the URL of the first valid image found (cached, including misses).
+    """
+    if not search_term or len(search_term) < 3: 
+        return None
+
+    hit, image_url = image_cache.get(search_term)
+    if hit: return image_url
+    return image_flights.do(("image", image_cache.normalize(search_term)), _lookup_and_cache, search_term)
+
+IMAGE_TAG = "[IMAGE]"
+
+def strip_image_tag(content):
+    return content.replace(IMAGE_TAG, "")
+
+def attach_image(content, search_term):
+    """
+    Resolves search_term to a real image and swaps it in for the [IMAGE] tag.
+    Returns (content, image_url). Slow on a cache miss, so lessons call this
+    from a background stage rather than while the student is waiting.
+    """
+    image_url = search_wikimedia_image(search_term)
+    
+    if image_url:
+        # Serve a resized local copy instead of hot-linking the multi-MB original
+        image_url = mirror_image(image_url) or image_url
+
+        # Replace [IMAGE] with standard Markdown image syntax
+        # We add a caption using the search term
+        image_markdown = f"\n\n![{search_term}]({image_url})\n*Figure: {search_term}*\n\n"
+        content = content.replace(IMAGE_TAG, image_markdown)
+    else:
+        # If search failed or no term, just remove the tag
+        content = strip_image_tag(content)
         
-    return None
+    return content, image_url
 
 # --- CONTENT GENERATION FUNCTIONS ---
 
-def generate_topic_intro(topic):
+def generate_topic_intro(topic, bypass_cache=False):
     prompt = f"""
     The user wants to learn about: '{topic}'.
     Generate a concise but engaging introduction.
@@ -162,13 +703,13 @@ def generate_topic_intro(topic):
         "hook": "A short, catchy tagline (max 10 words)." 
     }}
     """
-    return _get_json_response(prompt) or {
+    return _get_json_response(prompt, use_cache=not bypass_cache, required=("intro",), caller="generate_topic_intro") or {
         "topic": topic, 
         "intro": f"Welcome to **{topic}**! Let's start learning.", 
         "hook": "Start your journey."
     }
 
-def generate_roadmap(topic):
+def generate_roadmap(topic, bypass_cache=False):
     prompt = f"""
     Create a comprehensive learning roadmap for '{topic}'.
     Break the topic down into exactly 4-6 logical modules.
@@ -184,9 +725,9 @@ def generate_roadmap(topic):
         ] 
     }}
     """
-    return _get_json_response(prompt) or {"roadmap": []}
+    return _get_json_response(prompt, use_cache=not bypass_cache, required=("roadmap",), caller="generate_roadmap") or {"roadmap": []}
 
-def generate_sub_roadmap(topic_name, module_title):
+def generate_sub_roadmap(topic_name, module_title, bypass_cache=False):
     prompt = f"""
     The user is learning '{topic_name}'. Current Module: '{module_title}'.
     Break this into 4-6 specific, bite-sized lessons.
@@ -201,12 +742,12 @@ def generate_sub_roadmap(topic_name, module_title):
         ] 
     }}
     """
-    return _get_json_response(prompt) or {"sub_roadmap": []}
+    return _get_json_response(prompt, use_cache=not bypass_cache, required=("sub_roadmap",), caller="generate_sub_roadmap") or {"sub_roadmap": []}
 
-def generate_node_content(topic_name, node_title):
+def generate_node_content(topic_name, node_title, bypass_cache=False):
     """
     Generates the lesson text, quiz, and decides on an image search term.
-    It inserts the image into the markdown text automatically replacing [IMAGE].
+    The [IMAGE] tag is left in the content; attach_image() fills it in later.
     """
     prompt = f"""
     Teach the lesson: '{node_title}' (Part of topic: '{topic_name}').
@@ -232,32 +773,10 @@ def generate_node_content(topic_name, node_title):
     }}
     """
     
-    data = _get_json_response(prompt)
+    data = _get_json_response(prompt, use_cache=not bypass_cache, required=("content",), caller="generate_node_content",
+                              reject_lossy=True)
     
     if data and data.get('content'):
-        # 1. Get the search term the AI suggested
-        search_term = data.get('image_search_term')
-        
-        # 2. Find a real image URL using that term
-        image_url = search_wikimedia_image(search_term)
-        
-        # 3. Inject image into Markdown content
-        content = data['content']
-        
-        if image_url:
-            # Replace [IMAGE] with standard Markdown image syntax
-            # We add a caption using the search term
-            image_markdown = f"\n\n![{search_term}]({image_url})\n*Figure: {search_term}*\n\n"
-            content = content.replace("[IMAGE]", image_markdown)
-        else:
-            # If search failed or no term, just remove the tag
-            content = content.replace("[IMAGE]", "")
-            
-        data['content'] = content
-        
-        # (Optional) Return URL separately if needed by frontend
-        if image_url: data['image_url'] = image_url
-        
         return data
 
     # Fallback if generation fails
@@ -267,24 +786,173 @@ def generate_node_content(topic_name, node_title):
         "image_url": None
     }
 
-def generate_doubt_answer(node_title, context, user_question):
+# --- 🌊 STREAMING LESSONS ---
+# The JSON prompt can't be shown until it is complete, so the streaming prompt asks for
+# plain markdown first and the machine-readable parts after a marker line.
+STREAM_QUIZ_MARKER = "===QUIZ_JSON==="
+
+def _before_partial_image_tag(text, start, end):
+    """Moves end back over a trailing prefix of IMAGE_TAG, so the tag is never split between chunks."""
+    cut = text.rfind("[", start, end)
+    if cut != -1 and end - cut < len(IMAGE_TAG) and IMAGE_TAG.startswith(text[cut:end]):
+        return cut
+    return end
+
+def stream_node_content(topic_name, node_title, bypass_cache=False):
+    """
+    Streams a lesson as ("content", markdown_chunk) events while the model writes it,
+    then ("quiz", [...]) and finally ("done", full_lesson_dict).
+    Like generate_node_content, the image is left for attach_image(): the chunks have the
+    [IMAGE] tag stripped, the "done" lesson keeps it.
+    If the stream breaks off after content was sent (no quiz marker, or a quiz that can't
+    be parsed) it ends with ("incomplete", reason) instead: the partial lesson must not be
+    saved, and the caller should fall back to generate_node_content().
+    """
     prompt = f"""
+    Teach the lesson: '{node_title}' (Part of topic: '{topic_name}').
+    Target Audience: Beginner/Intermediate Student.
+    Tone: Engaging, Clear, Educational.
+    
+    First write the full markdown lesson. Use headers (##), bold text, and lists.
+    IMPORTANT: Insert the tag [IMAGE] exactly once in the text where a diagram or photo would be most helpful.
+    
+    Then write this exact line on its own:
+    {STREAM_QUIZ_MARKER}
+    
+    Then write a valid JSON object and nothing else:
+    {{
+        "image_search_term": "A specific, simple search query for Wikimedia Commons (e.g. 'Binary Search Tree Diagram'). Do not use generic words like 'image'.",
+        "quiz": [
+            {{
+                "question": "Question text?", 
+                "options": ["Option A", "Option B", "Option C", "Option D"], 
+                "correct_answer": "Option A", 
+                "explanation": "Why is this correct?"
+            }},
+            {{ "question": "...", "options": [...], "correct_answer": "...", "explanation": "..." }},
+            {{ "question": "...", "options": [...], "correct_answer": "...", "explanation": "..." }}
+        ]
+    }}
+    """
+    cache_key = llm_cache.make_key(prompt, MODEL_NAME, GENERATION_PARAMS)
+    data = None
+    if not bypass_cache:
+        try: data = llm_cache.get(cache_key)
+        except Exception as e: print(f"⚠️ LLM Cache Read Error: {e}")
+
+    if data:
+        yield ("content", strip_image_tag(data['content']))
+    else:
+        buffer, emitted, stream_failed = "", 0, False
+        call = llm_metrics.call("stream_node_content", streamed=True, parsed=True)
+        try:
+            stream = _generate_content_stream(prompt, config=types.GenerateContentConfig(**GENERATION_PARAMS), call=call)
+            for chunk in stream:
+                buffer += chunk.text or ""
+                marker_at = buffer.find(STREAM_QUIZ_MARKER)
+                # Hold back a tail that might be the start of the marker (or of the image tag)
+                safe_end = marker_at if marker_at != -1 else max(emitted, len(buffer) - len(STREAM_QUIZ_MARKER))
+                safe_end = _before_partial_image_tag(buffer, emitted, safe_end)
+                if safe_end > emitted:
+                    text = strip_image_tag(buffer[emitted:safe_end])
+                    if text: yield ("content", text)
+                    emitted = safe_end
+        except Exception as e:
+            print(f"⚠️ AI Stream Error: {e}")
+            stream_failed = True
+
+        content, marker, tail = buffer.partition(STREAM_QUIZ_MARKER)
+        if not content.strip():
+            # Streaming failed outright: fall back to the regular (retrying) JSON path
+            call.finish(parse="failed")
+            data = generate_node_content(topic_name, node_title, bypass_cache=bypass_cache)
+            yield ("content", strip_image_tag(data['content']))
+            yield ("quiz", data.get('quiz', []))
+            yield ("done", data)
+            return
+
+        if emitted < len(content):
+            text = strip_image_tag(content[emitted:])
+            if text: yield ("content", text)
+        if stream_failed or not marker:
+            _record_parse("parse_failures")
+            call.finish(parse="failed")
+            yield ("incomplete", "the lesson stream was cut off")
+            return
+        try:
+            data, repairs = parse_llm_json(tail)
+            if not isinstance(data, dict): raise ValueError("expected a JSON object")
+        except Exception as e:  # Same net as _get_json_response (deeply nested input can hit RecursionError)
+            print(f"⚠️ AI JSON Error (stream): {e}")
+            _record_parse("parse_failures")
+            call.finish(parse="failed")
+            yield ("incomplete", "the quiz could not be parsed")
+            return
+        data['content'] = content.strip()
+        data.setdefault('quiz', [])
+        if _normalize_quiz(data): repairs.append("dropped_quiz_items")
+        lossy = LOSSY_REPAIRS.intersection(repairs)
+        outcome = "lossy" if lossy else "repaired" if repairs else "clean"
+        _record_parse(outcome, repairs)
+        call.finish(parse=outcome)
+        if repairs: print(f"🩹 Repaired AI JSON: {', '.join(repairs)}")
+        if lossy or not data['quiz']:
+            yield ("incomplete", "the quiz was cut off")
+            return
+
+        if not bypass_cache:
+            try: llm_cache.put(cache_key, MODEL_NAME, data)
+            except Exception as e: print(f"⚠️ LLM Cache Write Error: {e}")
+
+    yield ("quiz", data.get('quiz', []))
+    yield ("done", data)
+
+TUTOR_FALLBACK_ANSWER = "I'm having trouble connecting to my brain right now. Try again?"
+
+def _doubt_prompt(node_title, user_question):
+    return f"""
     Context: The user is learning '{node_title}'.
     User Question: "{user_question}"
     
     Answer as a helpful AI Tutor. Keep it short (max 3 sentences) and encouraging.
     """
+
+def generate_doubt_answer(node_title, context, user_question):
+    prompt = _doubt_prompt(node_title, user_question)
     try:
         # ✅ FIX: Removed explicit model call config to avoid unsupported params
-        response = client.models.generate_content(
-            model=MODEL_NAME, 
-            contents=prompt
-        )
+        response = _generate_content(prompt, call=llm_metrics.call("generate_doubt_answer"))
         return response.text
     except:
-        return "I'm having trouble connecting to my brain right now. Try again?"
+        return TUTOR_FALLBACK_ANSWER
+
+def stream_doubt_answer(node_title, context, user_question):
+    """
+    Yields the tutor's answer in chunks as the model produces them.
+    Closing this generator (client went away) also closes the upstream stream.
+    An error before any text yields the fallback answer; after some text it is
+    re-raised, since the partial answer is not a reply.
+    """
+    prompt = _doubt_prompt(node_title, user_question)
+    stream = None
+    produced = False
+    try:
+        stream = _generate_content_stream(prompt, call=llm_metrics.call("stream_doubt_answer", streamed=True))
+        for chunk in stream:
+            if chunk.text:
+                produced = True
+                yield chunk.text
+    except GeneratorExit:
+        raise
+    except Exception as e:
+        print(f"⚠️ AI Tutor Stream Error: {e}")
+        if produced: raise
+        yield TUTOR_FALLBACK_ANSWER
+    finally:
+        close = getattr(stream, "close", None)
+        if close: close()
 
-def generate_remedial_content(topic_name, node_title, failed_questions):
+def generate_remedial_content(topic_name, node_title, failed_questions, bypass_cache=True):
     prompt = f"""
     The student failed a quiz on '{node_title}' (Topic: '{topic_name}').
     They struggled with these concepts: {failed_questions}.
@@ -300,4 +968,6 @@ def generate_remedial_content(topic_name, node_title, failed_questions):
         "quiz": [ ... easier questions ... ]
     }}
     """
-    return _get_json_response(prompt)
\ No newline at end of file
+    # Bypassed by default: a student asking again wants a fresh rewrite
+    return _get_json_response(prompt, use_cache=not bypass_cache, required=("content",),
+                              caller="generate_remedial_content", reject_lossy=True)
\ No newline at end of file
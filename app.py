@@ -1,36 +1,87 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, request, jsonify, send_from_directory
 from flask_cors import CORS
 import sqlite3
 import hashlib
-import json
+import json_codec as json
 import os
+import threading
 import time
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import CancelledError, ThreadPoolExecutor, TimeoutError as FutureTimeout
 from datetime import datetime, date
+from werkzeug.security import safe_join
 
 # ✅ LOCAL MODULE IMPORTS
-from ml_service import train_model, predict_risk
+from database import connection, transaction, execute, query_one, query_all, db_stats, set_query_observer
+from singleflight import SingleFlight
+from scheduler import (
+    GenerationScheduler,
+    QueueFull,
+    PRIORITY_USER_BLOCKING,
+    PRIORITY_NEXT_LESSON,
+    PRIORITY_SPECULATIVE
+)
+from ml_service import get_risk, score_all_users, high_risk_users, model_registry, training_jobs, ensure_risk_scores_table
+from image_pipeline import IMAGE_DIR, is_content_addressed, mirror_stats, ensure_image_assets_table
+from image_cache import ensure_image_search_cache_table
+from llm_cache import ensure_llm_cache_table
+from feature_store import ensure_learner_features_table, rebuild_learner_features, refresh_learner, record_learner_event
+from event_log import log_event, event_buffer, ensure_learning_events_table
+from json_codec import FastJSONProvider, RawJSON, json_response
+from content_codec import pack, unpack, codec_stats, ensure_zstd_dictionaries_table
+from http_cache import add_content_versions, content_etag, with_validators, not_modified, compress_response, http_stats
 from ai_service import (
     generate_topic_intro, 
     generate_roadmap, 
     generate_sub_roadmap,
     generate_node_content,
+    stream_node_content,
     generate_doubt_answer,
-    generate_remedial_content
+    stream_doubt_answer,
+    generate_remedial_content,
+    attach_image,
+    strip_image_tag,
+    IMAGE_TAG,
+    background_llm_calls,
+    llm_cache,
+    llm_limiter,
+    image_cache,
+    parse_stats
+)
+from llm_metrics import llm_metrics, ensure_llm_call_samples_table
+from metrics import (
+    start_request_timer,
+    record_request,
+    cache_lookup,
+    prefetch_outcome,
+    observe_query,
+    register_scheduler,
+    metrics_response
 )
 
 app = Flask(__name__)
+app.json = FastJSONProvider(app)      # jsonify() / request.json through the fast codec
 CORS(app)
+app.before_request(start_request_timer)
+app.after_request(record_request)     # Registered first so it runs last (timing includes compression)
+app.after_request(compress_response)  # zstd / brotli / gzip for large JSON bodies
+set_query_observer(observe_query)     # SQLite time per query family, for /metrics
 
 # --- CONFIGURATION ---
-DB_NAME = "learning_app.db"
-executor = ThreadPoolExecutor(max_workers=6) 
+scheduler = GenerationScheduler(max_workers=6, max_queue=200)   # Background AI generation
+register_scheduler(scheduler, "gen")
+generation_flights = SingleFlight()   # Dedupes concurrent lesson / sub-roadmap generation
+GENERATION_JOIN_TIMEOUT = 90          # Seconds a request waits on someone else's generation
+prefetch_priorities = {}              # Flight key -> CallPriority of the pre-fetch running it
+ROADMAP_DEADLINE = 60                 # Seconds for intro + roadmap generation, shared
+fanout_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="fanout")   # Parallel foreground LLM calls
+image_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="images")    # Lesson image stage (kept off the LLM scheduler)
+ml_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ml")           # Batch scoring, one job at a time
 
 # =========================================================
 # 🛠️ DATABASE INITIALIZATION
 # =========================================================
 def init_db():
-    with sqlite3.connect(DB_NAME) as conn:
+    with transaction() as conn:
         cursor = conn.cursor()
         
         # 1. Users
@@ -110,13 +161,59 @@ def init_db():
                 FOREIGN KEY(attempt_id) REFERENCES progress(id)
             )
         ''')
-        
-        conn.commit()
+
+# --- VERSIONED MIGRATIONS ---
+# Applied in order, tracked with PRAGMA user_version.
+# Append new steps to the end; never edit one that has already shipped.
+
+def _migration_hot_path_indexes(cursor):
+    # Collapse duplicates left by old check-then-insert races (keep the newest row),
+    # otherwise the UNIQUE indexes below can't be created.
+    cursor.execute("DELETE FROM module_lessons WHERE id NOT IN (SELECT MAX(id) FROM module_lessons GROUP BY attempt_id, node_title)")
+    cursor.execute("DELETE FROM sub_roadmaps WHERE id NOT IN (SELECT MAX(id) FROM sub_roadmaps GROUP BY attempt_id, module_index)")
+    cursor.execute("DELETE FROM user_notes WHERE id NOT IN (SELECT MAX(id) FROM user_notes GROUP BY attempt_id, node_title)")
+
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS ux_module_lessons_attempt_node ON module_lessons(attempt_id, node_title)")
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS ux_sub_roadmaps_attempt_module ON sub_roadmaps(attempt_id, module_index)")
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS ux_user_notes_attempt_node ON user_notes(attempt_id, node_title)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS ix_chat_messages_attempt_node ON chat_messages(attempt_id, node_title, id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS ix_progress_user ON progress(user_id)")
+
+def _migration_lesson_image_stage(cursor):
+    # Images are resolved after the lesson is saved; existing rows already have theirs
+    cursor.execute("ALTER TABLE module_lessons ADD COLUMN image_search_term TEXT")
+    cursor.execute("ALTER TABLE module_lessons ADD COLUMN image_status TEXT DEFAULT 'done'")
+
+def _migration_learner_features(cursor):
+    ensure_learner_features_table(cursor)
+    rebuild_learner_features(cursor)  # Backfill from existing users / progress / chat
+
+def _migration_content_versions(cursor):
+    add_content_versions(cursor)  # ETag / Last-Modified for roadmaps, sub-roadmaps and lessons
+
+def _migration_service_tables(cursor):
+    # Caches, logs and ML output that used to be created lazily by their modules
+    # (IF NOT EXISTS: databases that already have them keep their rows)
+    ensure_llm_cache_table(cursor)
+    ensure_image_search_cache_table(cursor)
+    ensure_image_assets_table(cursor)
+    ensure_risk_scores_table(cursor)
+    ensure_learning_events_table(cursor)
+    ensure_zstd_dictionaries_table(cursor)
+    ensure_llm_call_samples_table(cursor)
+
+MIGRATIONS = [
+    _migration_hot_path_indexes,   # v1
+    _migration_lesson_image_stage, # v2
+    _migration_learner_features,   # v3
+    _migration_content_versions,   # v4
+    _migration_service_tables,     # v5
+]
 
 def run_migrations():
     """Ensure DB schema is up to date without losing data."""
     try:
-        with sqlite3.connect(DB_NAME) as conn:
+        with transaction() as conn:
             cursor = conn.cursor()
             
             # Check for 'completed' in module_lessons
@@ -135,7 +232,13 @@ def run_migrations():
             if 'last_active_date' not in user_columns:
                 cursor.execute("ALTER TABLE users ADD COLUMN last_active_date TEXT")
 
-            conn.commit()
+            # Versioned steps (user_version is transactional, so a failed step is retried next boot)
+            cursor.execute("PRAGMA user_version")
+            version = cursor.fetchone()[0]
+            for step, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+                print(f"🛠️ Applying migration v{step}: {migration.__name__}")
+                migration(cursor)
+                cursor.execute(f"PRAGMA user_version = {step}")
     except Exception as e:
         print(f"Migration Warning: {e}")
 
@@ -146,9 +249,30 @@ run_migrations()
 # =========================================================
 # 📂 STATIC FILE SERVING (IMAGES)
 # =========================================================
+IMAGE_MAX_AGE = 31536000   # One year: image files are never rewritten under the same name
+_image_etags = {}          # path -> (mtime, size, etag) for files that aren't content-addressed
+
+# Helper: Strong ETag for an image file (hashed once per file version)
+def image_etag(filename):
+    if is_content_addressed(filename):
+        return os.path.splitext(os.path.basename(filename))[0]  # The name already is the content hash
+    path = safe_join(IMAGE_DIR, filename)
+    if not path or not os.path.isfile(path):
+        return True  # Let send_from_directory produce the 404
+    st = os.stat(path)
+    cached = _image_etags.get(path)
+    if cached and cached[:2] == (st.st_mtime, st.st_size):
+        return cached[2]
+    with open(path, "rb") as f:
+        etag = hashlib.sha256(f.read()).hexdigest()
+    _image_etags[path] = (st.st_mtime, st.st_size, etag)
+    return etag
+
 @app.route('/static/images/<path:filename>')
 def serve_image(filename):
-    return send_from_directory('static/images', filename)
+    response = send_from_directory(IMAGE_DIR, filename, etag=image_etag(filename), max_age=IMAGE_MAX_AGE)
+    response.cache_control.immutable = True
+    return response
 
 # =========================================================
 # 🔐 AUTHENTICATION
@@ -165,11 +289,10 @@ def signup():
     if not email or not password or not name: return jsonify({"error": "Missing fields"}), 400
     hashed_pw = hash_password(password)
     try:
-        with sqlite3.connect(DB_NAME) as conn:
-            cursor = conn.cursor()
-            cursor.execute("INSERT INTO users (email, password, name) VALUES (?, ?, ?)", (email, hashed_pw, name))
-            conn.commit()
-            return jsonify({"message": "User created successfully!"}), 201
+        with transaction() as conn:
+            user_id = conn.execute("INSERT INTO users (email, password, name) VALUES (?, ?, ?)", (email, hashed_pw, name)).lastrowid
+            refresh_learner(conn, user_id)
+        return jsonify({"message": "User created successfully!"}), 201
     except sqlite3.IntegrityError: return jsonify({"error": "Email already exists"}), 409
 
 @app.route('/api/login', methods=['POST'])
@@ -178,58 +301,132 @@ def login():
     email = data.get('email')
     password = data.get('password')
     hashed_pw = hash_password(password)
-    with sqlite3.connect(DB_NAME) as conn:
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, name, xp, level FROM users WHERE email = ? AND password = ?", (email, hashed_pw, name))
-        user = cursor.fetchone()
-        if user:
-            return jsonify({"message": "Login successful", "user": {"id": user['id'], "name": user['name'], "xp": user['xp'], "level": user['level']}}), 200
-        else: return jsonify({"error": "Invalid credentials"}), 401
+    user = query_one("SELECT id, name, xp, level FROM users WHERE email = ? AND password = ?", (email, hashed_pw))
+    if user:
+        return jsonify({"message": "Login successful", "user": {"id": user['id'], "name": user['name'], "xp": user['xp'], "level": user['level']}}), 200
+    else: return jsonify({"error": "Invalid credentials"}), 401
 
 # =========================================================
 # 🧠 AI & ROADMAP GENERATION
 # =========================================================
 
+# Helper: Request fields from the JSON body (POST) or the query string (GET, ints converted)
+def request_params(*int_fields):
+    if request.method == 'POST':
+        return request.json or {}
+    data = request.args.to_dict()
+    for field in int_fields:
+        if field in data:
+            try: data[field] = int(data[field])
+            except ValueError: pass
+    return data
+
+# Helper: GET only serves stored data. Generating spends LLM quota and writes rows, so it takes
+# a POST: crawlers, link previews and retrying proxies must not be able to trigger it.
+def not_generated(key):
+    response = jsonify({"error": "Not generated yet: POST to generate it", "generating": generation_flights.in_flight(key)})
+    response.cache_control.no_store = True
+    return response, 404
+
 # Helper: Check if topic still exists (Zombie Check)
 def is_topic_active(attempt_id):
     try:
-        with sqlite3.connect(DB_NAME) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT 1 FROM progress WHERE id = ?", (attempt_id,))
-            return cursor.fetchone() is not None
+        return query_one("SELECT 1 FROM progress WHERE id = ?", (attempt_id,)) is not None
     except:
         return False
 
+# Helper: Queue background work; when the scheduler is full, speculative work is just skipped
+def schedule(fn, *args, priority, attempt_id, owner):
+    try:
+        scheduler.submit(fn, *args, priority=priority, attempt_id=attempt_id, owner=owner)
+    except QueueFull as e:
+        print(f"⏳ [Scheduler] Skipped {fn.__name__}: {e}")
+
+# Helper: Generate + save a sub-roadmap (shared by get_sub_roadmap and the pre-fetcher).
+# Always called through generation_flights, so one module is only generated once at a time.
+def build_sub_roadmap(attempt_id, module_index, topic_name, module_title, owner=None):
+    result = generate_sub_roadmap(topic_name, module_title)
+    if not (result and result.get('sub_roadmap')): return []
+    if not is_topic_active(attempt_id): return []
+
+    final_sub_map = result['sub_roadmap']
+    cursor = execute("""
+        INSERT INTO sub_roadmaps (attempt_id, module_index, sub_roadmap_data) VALUES (?, ?, ?)
+        ON CONFLICT(attempt_id, module_index) DO NOTHING
+    """, (attempt_id, module_index, json.dumps(final_sub_map)))
+
+    # Someone else saved it first: serve their copy so lessons line up
+    if cursor.rowcount == 0:
+        row = query_one("SELECT sub_roadmap_data FROM sub_roadmaps WHERE attempt_id = ? AND module_index = ?", (attempt_id, module_index))
+        return json.loads(row['sub_roadmap_data'])
+
+    # Trigger Lesson Prefetch for first 3 items (the first one is what the user opens next)
+    for i, node in enumerate(final_sub_map[:3]):
+        priority = PRIORITY_NEXT_LESSON if i == 0 else PRIORITY_SPECULATIVE
+        schedule(prefetch_lesson_task, attempt_id, i, topic_name, node['title'],
+                 priority=priority, attempt_id=attempt_id, owner=owner)
+    return final_sub_map
+
+# Helper: Run a pre-fetch flight that join_flight() can promote once a user waits on it
+def run_prefetch_flight(key, priority, fn, *args):
+    prefetch_priorities[key] = priority
+    try:
+        return generation_flights.do(key, fn, *args)
+    finally:
+        if prefetch_priorities.get(key) is priority: del prefetch_priorities[key]
+
+# Helper: A user now waits on this flight: if a pre-fetch runs it, its LLM calls go foreground
+def promote_prefetch(key):
+    priority = prefetch_priorities.get(key)
+    if priority: llm_limiter.promote(priority)
+
+# Helper: A user request joining (or starting) a generation flight
+def join_flight(key, fn, *args):
+    promote_prefetch(key)
+    return generation_flights.do(key, fn, *args, timeout=GENERATION_JOIN_TIMEOUT)
+
 # Background Task: Pre-fetch Sub-Roadmap
-def prefetch_sub_roadmap_task(attempt_id, module_index, topic_name, module_title):
-    if not is_topic_active(attempt_id): return 
+def prefetch_sub_roadmap_task(attempt_id, module_index, topic_name, module_title, owner=None):
+    if not is_topic_active(attempt_id): return prefetch_outcome("sub_roadmap", "zombie")
     try:
-        with sqlite3.connect(DB_NAME) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT 1 FROM sub_roadmaps WHERE attempt_id = ? AND module_index = ?", (attempt_id, module_index))
-            if cursor.fetchone(): return 
+        if query_one("SELECT 1 FROM sub_roadmaps WHERE attempt_id = ? AND module_index = ?", (attempt_id, module_index)):
+            return prefetch_outcome("sub_roadmap", "skipped")
 
         print(f"🔮 [Pre-fetch] Predicting Next Module: {module_title}")
         time.sleep(1) 
-        result = generate_sub_roadmap(topic_name, module_title)
-        
-        if not is_topic_active(attempt_id): return
 
-        if result and result.get('sub_roadmap'):
-            with sqlite3.connect(DB_NAME) as conn:
-                cursor = conn.cursor()
-                cursor.execute("INSERT INTO sub_roadmaps (attempt_id, module_index, sub_roadmap_data) VALUES (?, ?, ?)", 
-                               (attempt_id, module_index, json.dumps(result['sub_roadmap'])))
-                conn.commit()
+        key = ("sub_roadmap", attempt_id, module_index)
+        if generation_flights.in_flight(key):  # A foreground request is already on it
+            return prefetch_outcome("sub_roadmap", "skipped")
+        with background_llm_calls() as priority:  # Yields to foreground requests at the rate limiter
+            saved = run_prefetch_flight(key, priority, build_sub_roadmap, attempt_id, module_index, topic_name, module_title, owner)
+        if saved:
             print(f"✅ [Pre-fetch] Saved Module Structure: {module_title}")
-            
-            # Helper to prefetch first few lessons of sub-roadmap
-            for i, node in enumerate(result['sub_roadmap'][:3]):
-                executor.submit(prefetch_lesson_task, attempt_id, i, topic_name, node['title'])
+            prefetch_outcome("sub_roadmap", "saved")
+        else:
+            # build_sub_roadmap returns [] both for an empty generation and for a topic deleted meanwhile
+            prefetch_outcome("sub_roadmap", "failed" if is_topic_active(attempt_id) else "zombie")
 
     except Exception as e:
         print(f"⚠️ Pre-fetch Sub-Map Failed: {e}")
+        prefetch_outcome("sub_roadmap", "failed")
+
+# Helper: Run fn and report how long it took (ms)
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, round((time.perf_counter() - start) * 1000, 1)
+
+# Helper: Store a topic intro whenever its generation finishes (deferred delivery)
+def save_intro_when_ready(attempt_id, intro_future):
+    def _save(future):
+        try:
+            intro_data, intro_ms = future.result()
+            execute("UPDATE progress SET definition_data = ? WHERE id = ?", (json.dumps(intro_data), attempt_id))
+            print(f"✅ [Intro] Delivered late for topic {attempt_id} ({intro_ms} ms)")
+        except Exception as e:
+            print(f"⚠️ Deferred Intro Failed: {e}")
+    intro_future.add_done_callback(_save)
 
 # 1. CREATE NEW TOPIC (Generates Full Roadmap)
 @app.route('/api/generate_roadmap', methods=['POST'])
@@ -237,180 +434,407 @@ def generate_roadmap_api():
     data = request.json
     topic = data.get('topic')
     user_id = data.get('user_id')
+    defer_intro = bool(data.get('defer_intro'))  # Return as soon as the roadmap is ready
 
     print(f"🧠 Generating roadmap for: {topic}")
+    started = time.perf_counter()
+    deadline = started + ROADMAP_DEADLINE
+
+    # A. Generate AI Content (independent calls, run side by side)
+    intro_future = fanout_pool.submit(timed, generate_topic_intro, topic)   # { "intro": "...", "hook": "..." }
+    roadmap_future = fanout_pool.submit(timed, generate_roadmap, topic)     # { "roadmap": [...] }
 
-    # A. Generate AI Content
-    intro_data = generate_topic_intro(topic) # { "intro": "...", "hook": "..." }
-    roadmap_data = generate_roadmap(topic)   # { "roadmap": [...] }
+    try:
+        roadmap_data, roadmap_ms = roadmap_future.result(timeout=deadline - time.perf_counter())
+    except FutureTimeout:
+        return jsonify({"error": "Roadmap generation timed out"}), 504
+
+    intro_data, intro_ms = None, None
+    if not defer_intro:
+        try:
+            intro_data, intro_ms = intro_future.result(timeout=max(0, deadline - time.perf_counter()))
+        except FutureTimeout:
+            pass  # Out of time: deliver it later instead of failing the request
     
     clean_topic = roadmap_data.get('topic_name', topic)
     roadmap_list = roadmap_data.get('roadmap', [])
 
     # B. Save to Database
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO progress (user_id, topic_name, roadmap_data, definition_data, completed_modules)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (
-            user_id, 
-            clean_topic, 
-            json.dumps(roadmap_list), 
-            json.dumps(intro_data),
-            '[]'
-        ))
-        attempt_id = cursor.lastrowid
+    save_started = time.perf_counter()
+    cursor = execute('''
+        INSERT INTO progress (user_id, topic_name, roadmap_data, definition_data, completed_modules)
+        VALUES (?, ?, ?, ?, ?)
+    ''', (
+        user_id, 
+        clean_topic, 
+        pack(json.dumps(roadmap_list)), 
+        json.dumps(intro_data) if intro_data else None,
+        '[]'
+    ))
+    attempt_id = cursor.lastrowid
+    save_ms = round((time.perf_counter() - save_started) * 1000, 1)
+
+    # Intro still running: it lands in progress.definition_data (see get_roadmap) when done
+    if intro_data is None:
+        save_intro_when_ready(attempt_id, intro_future)
 
     # C. Trigger Background Pre-fetch
     if len(roadmap_list) > 0:
-        executor.submit(prefetch_sub_roadmap_task, attempt_id, 0, clean_topic, roadmap_list[0]['title'])
+        schedule(prefetch_sub_roadmap_task, attempt_id, 0, clean_topic, roadmap_list[0]['title'], user_id,
+                 priority=PRIORITY_NEXT_LESSON, attempt_id=attempt_id, owner=user_id)
 
     return jsonify({
         "success": True,
         "attempt_id": attempt_id,
         "topic": clean_topic,
         "roadmap": roadmap_list,
-        "intro": intro_data # Send back to frontend immediately
+        "intro": intro_data, # Send back to frontend immediately
+        "intro_pending": intro_data is None,
+        "timings": {
+            "roadmap_ms": roadmap_ms,
+            "intro_ms": intro_ms,
+            "save_ms": save_ms,
+            "total_ms": round((time.perf_counter() - started) * 1000, 1)
+        }
     })
 
 # 2. GET FULL ROADMAP (Required for main_map view)
-@app.route('/api/get_roadmap', methods=['POST'])
+# GET is cacheable: revalidated with ETag / Last-Modified (completed modules and the intro still change)
+@app.route('/api/get_roadmap', methods=['GET', 'POST'])
 def get_roadmap():
-    data = request.json
+    data = request_params('attempt_id')
     attempt_id = data.get('attempt_id')
     if not attempt_id: return jsonify({"error": "No ID"}), 400
     
-    with sqlite3.connect(DB_NAME) as conn:
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute("SELECT topic_name, completed_modules, roadmap_data, definition_data FROM progress WHERE id = ?", (attempt_id,))
-        row = cursor.fetchone()
-        
-        if row:
-            return jsonify({
-                "topic": row['topic_name'],
-                "roadmap": json.loads(row['roadmap_data']),
-                "completed_indices": json.loads(row['completed_modules']) if row['completed_modules'] else [],
-                "definition": json.loads(row['definition_data']) if row['definition_data'] else None
-            })
-        else:
-            return jsonify({"error": "Topic not found"}), 404
+    row = query_one("SELECT id, version, updated_at, topic_name, completed_modules, roadmap_data, definition_data FROM progress WHERE id = ?", (attempt_id,))
+    
+    if row:
+        etag = content_etag("r", row)
+        cached = not_modified(etag, row['updated_at'])
+        if cached: return cached
+        # Stored JSON is spliced in as-is (it was validated when written)
+        return with_validators(json_response({
+            "topic": row['topic_name'],
+            "roadmap": RawJSON(unpack(row['roadmap_data']), "[]"),
+            "completed_indices": RawJSON(row['completed_modules'], "[]"),
+            "definition": RawJSON(row['definition_data'])
+        }), etag, row['updated_at'])
+    else:
+        return jsonify({"error": "Topic not found"}), 404
 
 # 3. GET SUB-ROADMAP (Required for sub_map view)
-@app.route('/api/get_sub_roadmap', methods=['POST'])
+SUB_ROADMAP_MAX_AGE = 86400  # Never rewritten once saved (first writer wins)
+
+@app.route('/api/get_sub_roadmap', methods=['GET', 'POST'])
 def get_sub_roadmap():
-    data = request.json
+    data = request_params('attempt_id', 'module_index')
     attempt_id = data.get('attempt_id')
     module_index = data.get('module_index')
     module_title = data.get('module_title')
 
     # 1. Check Cache
-    with sqlite3.connect(DB_NAME) as conn:
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute("SELECT sub_roadmap_data FROM sub_roadmaps WHERE attempt_id = ? AND module_index = ?", (attempt_id, module_index))
-        row = cursor.fetchone()
-        if row:
-            print(f"⚡ [Cache] Serving Sub-Roadmap: {module_title}")
-            return jsonify({"sub_roadmap": json.loads(row['sub_roadmap_data'])})
-
-    # 2. Generate if missing
-    topic_name = "General"
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT topic_name FROM progress WHERE id = ?", (attempt_id,))
-        res = cursor.fetchone()
-        if res: topic_name = res[0]
-
+    row = query_one("SELECT id, version, updated_at, sub_roadmap_data FROM sub_roadmaps WHERE attempt_id = ? AND module_index = ?", (attempt_id, module_index))
+    cache_lookup("sub_roadmap", row is not None)
+    if row:
+        etag = content_etag("s", row)
+        cached = not_modified(etag, row['updated_at'], SUB_ROADMAP_MAX_AGE)
+        if cached: return cached
+        print(f"⚡ [Cache] Serving Sub-Roadmap: {module_title}")
+        return with_validators(json_response({"sub_roadmap": RawJSON(row['sub_roadmap_data'], "[]")}), etag, row['updated_at'], SUB_ROADMAP_MAX_AGE)
+
+    key = ("sub_roadmap", attempt_id, module_index)
+    if request.method == 'GET': return not_generated(key)
+
+    # 2. Generate if missing (POST only)
+    topic_name, owner = "General", None
+    res = query_one("SELECT topic_name, user_id FROM progress WHERE id = ?", (attempt_id,))
+    if res: topic_name, owner = res[0], res[1]
+
+    # Joins the pre-fetch if it is already generating this module
     print(f"🗺️ Generating Sub-Roadmap: {module_title}")
-    result = generate_sub_roadmap(topic_name, module_title)
-    
-    if result and result.get('sub_roadmap'):
-        final_sub_map = result['sub_roadmap']
-        # Save to DB
-        with sqlite3.connect(DB_NAME) as conn:
-            cursor = conn.cursor()
-            cursor.execute("INSERT INTO sub_roadmaps (attempt_id, module_index, sub_roadmap_data) VALUES (?, ?, ?)", 
-                          (attempt_id, module_index, json.dumps(final_sub_map)))
-            conn.commit()
-            
-        # Trigger Lesson Prefetch for first 3 items
-        for i, node in enumerate(final_sub_map[:3]): 
-            executor.submit(prefetch_lesson_task, attempt_id, i, topic_name, node['title'])
-            
-        return jsonify({"sub_roadmap": final_sub_map})
-        
-    return jsonify({"sub_roadmap": []})
+    try:
+        final_sub_map = join_flight(key, build_sub_roadmap, attempt_id, module_index, topic_name, module_title, owner)
+    except FutureTimeout:
+        return jsonify({"error": "Still generating, try again shortly"}), 503
+
+    return jsonify({"sub_roadmap": final_sub_map})
 
 # =========================================================
 # 📚 LESSON & CONTENT MANAGEMENT
 # =========================================================
 
+# Helper: Does a freshly generated lesson still need its [IMAGE] resolved?
+def needs_image(result):
+    return IMAGE_TAG in result['content'] and bool(result.get('image_search_term'))
+
+# Helper: The lesson as the client sees it. A pending image's tag is hidden, not shown raw.
+def lesson_response(content, image_url, quiz, image_status):
+    return {"content": strip_image_tag(content), "image_url": image_url, "quiz": quiz, "image_status": image_status}
+
+# raw=True keeps the stored quiz JSON unparsed, for json_response()
+def lesson_from_row(row, raw=False):
+    if raw:
+        quiz = RawJSON(unpack(row['quiz_data']), "[]")
+    else:
+        quiz = json.loads(unpack(row['quiz_data'])) if row['quiz_data'] else []
+    return lesson_response(unpack(row['content']), row['image_url'], quiz, row['image_status'])
+
+def lesson_from_result(result):
+    status = "pending" if result.get('content') and needs_image(result) else "done"
+    return lesson_response(result.get('content', ""), result.get('image_url'), result.get('quiz', []), status)
+
+# Helper: Persist a generated lesson (first writer wins), then queue its image
+def save_lesson(attempt_id, node_index, node_title, result):
+    if result and result.get('content') and is_topic_active(attempt_id):
+        pending = needs_image(result)
+        content = result['content'] if pending else strip_image_tag(result['content'])
+        cursor = execute("""
+            INSERT INTO module_lessons (attempt_id, node_index, node_title, content, image_url, quiz_data, image_search_term, image_status)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(attempt_id, node_title) DO NOTHING
+        """, (attempt_id, node_index, node_title, pack(content), result.get('image_url'), pack(json.dumps(result.get('quiz', []))),
+              result.get('image_search_term'), "pending" if pending else "done"))
+        if pending and cursor.rowcount:
+            queue_lesson_image(attempt_id, node_title)
+
+# --- Image stage: runs after the lesson is already saved and returned ---
+def resolve_lesson_image(attempt_id, node_title):
+    row = query_one(
+        "SELECT content, image_search_term FROM module_lessons WHERE attempt_id = ? AND node_title = ? AND image_status = 'pending'",
+        (attempt_id, node_title)
+    )
+    if not row: return
+    content, image_url = attach_image(unpack(row['content']), row['image_search_term'])
+    # Matching on the old (stored) content means a remedial rewrite in the meantime isn't clobbered
+    execute("""
+        UPDATE module_lessons SET content = ?, image_url = ?, image_status = 'done'
+        WHERE attempt_id = ? AND node_title = ? AND content = ?
+    """, (pack(content), image_url, attempt_id, node_title, row['content']))
+
+# Lessons whose image stage is queued or running. In memory on purpose: after a restart
+# the set is empty, so the next poll re-queues lessons the old process left pending.
+image_jobs = set()
+image_jobs_lock = threading.Lock()
+
+def resolve_lesson_image_task(attempt_id, node_title):
+    try:
+        generation_flights.do(("image", attempt_id, node_title), resolve_lesson_image, attempt_id, node_title)
+    except Exception as e:
+        print(f"⚠️ Image Stage Failed: {e}")
+    finally:
+        with image_jobs_lock: image_jobs.discard((str(attempt_id), node_title))
+
+# No-op while this lesson's image job is still queued or running (get_node_image polls call it)
+def queue_lesson_image(attempt_id, node_title):
+    job = (str(attempt_id), node_title)  # Polls send the id as a string
+    with image_jobs_lock:
+        if job in image_jobs: return
+        image_jobs.add(job)
+    try:
+        image_pool.submit(resolve_lesson_image_task, attempt_id, node_title)
+    except Exception:
+        with image_jobs_lock: image_jobs.discard(job)
+        raise
+
+# Helper: Generate + save a lesson (shared by get_node and the pre-fetcher).
+# Always called through generation_flights, so one lesson is only generated once at a time.
+def build_lesson(attempt_id, node_index, topic_name, node_title):
+    result = generate_node_content(topic_name, node_title)
+    save_lesson(attempt_id, node_index, node_title, result)
+    return result
+
 # Helper: Background Lesson Generation
 def prefetch_lesson_task(attempt_id, node_index, topic_name, node_title):
-    if not is_topic_active(attempt_id): return
+    if not is_topic_active(attempt_id): return prefetch_outcome("lesson", "zombie")
     try:
-        with sqlite3.connect(DB_NAME) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT 1 FROM module_lessons WHERE attempt_id = ? AND node_title = ?", (attempt_id, node_title))
-            if cursor.fetchone(): return 
+        if query_one("SELECT 1 FROM module_lessons WHERE attempt_id = ? AND node_title = ?", (attempt_id, node_title)):
+            return prefetch_outcome("lesson", "skipped")
 
-        print(f"🔮 [Pre-fetch] Writing Lesson: {node_title}")
-        result = generate_node_content(topic_name, node_title)
-        
-        if not is_topic_active(attempt_id): return 
+        key = ("lesson", attempt_id, node_title)
+        if generation_flights.in_flight(key):  # A foreground request is already on it
+            return prefetch_outcome("lesson", "skipped")
 
-        if result and result.get('content'):
-            with sqlite3.connect(DB_NAME) as conn:
-                cursor = conn.cursor()
-                cursor.execute("INSERT INTO module_lessons (attempt_id, node_index, node_title, content, image_url, quiz_data) VALUES (?, ?, ?, ?, ?, ?)", 
-                               (attempt_id, node_index, node_title, result['content'], result.get('image_url'), json.dumps(result['quiz'])))
-                conn.commit()
-            print(f"✅ [Pre-fetch] Saved Lesson: {node_title}")
+        print(f"🔮 [Pre-fetch] Writing Lesson: {node_title}")
+        with background_llm_calls() as priority:  # Yields to foreground requests at the rate limiter
+            result = run_prefetch_flight(key, priority, build_lesson, attempt_id, node_index, topic_name, node_title)
+        if not is_topic_active(attempt_id):  # save_lesson drops lessons of deleted topics
+            return prefetch_outcome("lesson", "zombie")
+        if not (result and result.get('content')):
+            return prefetch_outcome("lesson", "failed")
+        print(f"✅ [Pre-fetch] Saved Lesson: {node_title}")
+        prefetch_outcome("lesson", "saved")
     except Exception as e:
         print(f"⚠️ Pre-fetch Lesson Failed: {e}")
+        prefetch_outcome("lesson", "failed")
+
+class IncompleteStream(Exception):
+    """The lesson stream broke off: nothing was saved, the client should use /api/get_node."""
+
+# Sent with stream errors so the client knows to retry on the regular endpoint
+STREAM_FALLBACK = "/api/get_node"
 
-@app.route('/api/get_node', methods=['POST'])
+@app.route('/api/get_node', methods=['GET', 'POST'])
 def get_node():
-    data = request.json
+    data = request_params('attempt_id', 'node_index')
     attempt_id = data.get('attempt_id')
     node_title = data.get('node_title')
     node_index = data.get('node_index')
     
     # 1. Check Cache
-    with sqlite3.connect(DB_NAME) as conn:
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute("SELECT content, image_url, quiz_data FROM module_lessons WHERE attempt_id = ? AND node_title = ?", (attempt_id, node_title))
-        row = cursor.fetchone()
-        if row:
-            return jsonify({ 
-                "content": row['content'], 
-                "image_url": row['image_url'], 
-                "quiz": json.loads(row['quiz_data']) if row['quiz_data'] else [] 
-            })
-
-    # 2. Generate Content
+    row = query_one("SELECT id, version, updated_at, content, image_url, quiz_data, image_status FROM module_lessons WHERE attempt_id = ? AND node_title = ?", (attempt_id, node_title))
+    cache_lookup("lesson", row is not None)
+    if row:
+        log_event("lesson_viewed", attempt_id=attempt_id, node_title=node_title, cached=True)
+        # Revalidated, not max-age'd: the image stage and remedial rewrites change the lesson
+        etag = content_etag("l", row)
+        cached = not_modified(etag, row['updated_at'])
+        if cached: return cached
+        return with_validators(json_response(lesson_from_row(row, raw=True)), etag, row['updated_at'])
+
+    key = ("lesson", attempt_id, node_title)
+    if request.method == 'GET': return not_generated(key)
+
+    # 2. Generate Content (POST only)
     topic_name = "General"
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT topic_name FROM progress WHERE id = ?", (attempt_id,))
-        res = cursor.fetchone()
-        if res: topic_name = res[0]
+    res = query_one("SELECT topic_name FROM progress WHERE id = ?", (attempt_id,))
+    if res: topic_name = res[0]
 
+    # Joins the pre-fetch if it is already writing this lesson
     print(f"📚 Generating Content: {node_title}")
-    result = generate_node_content(topic_name, node_title)
-    
-    # Save to DB
-    if result and result.get('content'):
-        with sqlite3.connect(DB_NAME) as conn:
-            cursor = conn.cursor()
-            cursor.execute("INSERT INTO module_lessons (attempt_id, node_index, node_title, content, image_url, quiz_data) VALUES (?, ?, ?, ?, ?, ?)", 
-                           (attempt_id, node_index, node_title, result['content'], result.get('image_url'), json.dumps(result['quiz'])))
-            conn.commit()
-            
-    return jsonify(result)
+    try:
+        try:
+            result = join_flight(key, build_lesson, attempt_id, node_index, topic_name, node_title)
+        except IncompleteStream:
+            # Joined a stream that broke off (and saved nothing): generate it ourselves
+            result = join_flight(key, build_lesson, attempt_id, node_index, topic_name, node_title)
+    except FutureTimeout:
+        return jsonify({"error": "Still generating, try again shortly"}), 503
+
+    log_event("lesson_viewed", attempt_id=attempt_id, node_title=node_title, cached=False)
+    return jsonify(lesson_from_result(result))
+
+# Cheap poll for the image stage: one indexed row read, no generation
+@app.route('/api/get_node_image', methods=['GET', 'POST'])
+def get_node_image():
+    data = request.json if request.method == 'POST' else request.args
+    attempt_id = data.get('attempt_id')
+    node_title = data.get('node_title')
+
+    row = query_one("SELECT content, image_url, image_status FROM module_lessons WHERE attempt_id = ? AND node_title = ?", (attempt_id, node_title))
+    if not row:
+        return jsonify({"error": "Lesson not found"}), 404
+
+    if row['image_status'] == 'pending':
+        queue_lesson_image(attempt_id, node_title)  # No-op if already running; recovers lessons orphaned by a restart
+        return jsonify({"image_status": "pending", "image_url": None})
+    return jsonify({"image_status": row['image_status'], "image_url": row['image_url'], "content": unpack(row['content'])})
+
+# Helper: Format one Server-Sent Event
+def sse(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+# Helper: Finish a lesson stream whose client went away, so the LLM work isn't wasted
+def finish_lesson_stream(events, key, attempt_id, node_index, node_title):
+    try:
+        result = None
+        for event, payload in events:
+            if event == "done": result = payload
+            elif event == "incomplete": raise IncompleteStream(payload)
+        save_lesson(attempt_id, node_index, node_title, result)
+        generation_flights.resolve(key, result)
+    except Exception as e:
+        generation_flights.fail(key, e)
+
+# Streaming variant of get_node: markdown arrives as it is written (SSE)
+@app.route('/api/get_node_stream', methods=['GET', 'POST'])
+def get_node_stream():
+    data = request_params('attempt_id', 'node_index')
+    attempt_id = data.get('attempt_id')
+    node_title = data.get('node_title')
+    node_index = data.get('node_index')
+
+    def replay(lesson):
+        # Cached / joined lessons are already complete: send them as one burst
+        yield sse("content", {"text": lesson['content']})
+        yield sse("quiz", {"quiz": lesson.get('quiz', [])})
+        yield sse("image", {"image_url": lesson.get('image_url'), "image_status": lesson['image_status']})
+        yield sse("done", lesson)
+
+    # 1. Check Cache
+    row = query_one("SELECT content, image_url, quiz_data, image_status FROM module_lessons WHERE attempt_id = ? AND node_title = ?", (attempt_id, node_title))
+    cache_lookup("lesson", row is not None)
+    if row:
+        log_event("lesson_viewed", attempt_id=attempt_id, node_title=node_title, cached=True, streamed=True)
+        return Response(replay(lesson_from_row(row)), mimetype='text/event-stream', headers={"Cache-Control": "no-cache"})
+
+    key = ("lesson", attempt_id, node_title)
+    if request.method == 'GET': return not_generated(key)
+
+    # Generating takes a POST (see not_generated)
+    topic_name = "General"
+    res = query_one("SELECT topic_name FROM progress WHERE id = ?", (attempt_id,))
+    if res: topic_name = res[0]
+
+    def generate():
+        # Claimed on first iteration, so a response that is never read can't leave a dangling flight
+        future, is_leader = generation_flights.claim(key)
+
+        # 2. Someone (usually the pre-fetcher) is already writing it: wait, then replay
+        if not is_leader:
+            promote_prefetch(key)
+            try:
+                lesson = generation_flights.wait(future, timeout=GENERATION_JOIN_TIMEOUT)
+            except Exception as e:
+                yield sse("error", {"error": str(e) or "Still generating, try again shortly", "fallback": STREAM_FALLBACK})
+                return
+            log_event("lesson_viewed", attempt_id=attempt_id, node_title=node_title, cached=False, streamed=True)
+            yield from replay(lesson_from_result(lesson))
+            return
+
+        # 3. Stream it ourselves
+        print(f"🌊 Streaming Content: {node_title}")
+        events = stream_node_content(topic_name, node_title)
+        finished = False
+        try:
+            for event, payload in events:
+                if event == "content":
+                    yield sse("content", {"text": payload})
+                elif event == "quiz":
+                    yield sse("quiz", {"quiz": payload})
+                elif event == "done":
+                    save_lesson(attempt_id, node_index, node_title, payload)
+                    generation_flights.resolve(key, payload)
+                    finished = True
+                    lesson = lesson_from_result(payload)
+                    log_event("lesson_viewed", attempt_id=attempt_id, node_title=node_title, cached=False, streamed=True)
+                    # Usually "pending": poll /api/get_node_image for the picture
+                    yield sse("image", {"image_url": lesson['image_url'], "image_status": lesson['image_status']})
+                    yield sse("done", lesson)
+                elif event == "incomplete":
+                    # A cut-off lesson is never saved (first writer wins, so it would stick)
+                    finished = True
+                    generation_flights.fail(key, IncompleteStream(payload))
+                    yield sse("error", {"error": f"Lesson incomplete: {payload}", "fallback": STREAM_FALLBACK})
+        except GeneratorExit:
+            # Client disconnected mid-lesson: let a worker finish and save it
+            if not finished:
+                finished = True
+                try:
+                    task = scheduler.submit(finish_lesson_stream, events, key, attempt_id, node_index, node_title,
+                                            priority=PRIORITY_USER_BLOCKING, attempt_id=attempt_id)
+                    # Topic deleted before the worker got to it: release anyone waiting
+                    task.add_done_callback(lambda t: t.cancelled() and generation_flights.fail(key, CancelledError()))
+                except QueueFull as e:
+                    generation_flights.fail(key, e)
+            raise
+        except Exception as e:
+            if not finished:
+                finished = True
+                generation_flights.fail(key, e)
+            yield sse("error", {"error": str(e), "fallback": STREAM_FALLBACK})
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 # =========================================================
 # 🎓 QUIZ & PROGRESS TRACKING
@@ -425,14 +849,16 @@ def submit_node_quiz():
     xp_gained = 0
     new_level = 1
     new_xp = 0
+    user_id = None
 
     if passed and attempt_id:
         try:
-            with sqlite3.connect(DB_NAME) as conn:
+            with transaction() as conn:
                 cursor = conn.cursor()
                 
-                # Mark lesson complete
-                cursor.execute("UPDATE module_lessons SET completed = 1 WHERE attempt_id = ? AND node_title = ?", (attempt_id, node_title))
+                # Mark lesson complete (rowcount is 0 on a retake)
+                cursor.execute("UPDATE module_lessons SET completed = 1 WHERE attempt_id = ? AND node_title = ? AND COALESCE(completed, 0) = 0", (attempt_id, node_title))
+                newly_completed = cursor.rowcount
                 
                 # Add XP
                 xp_gained = 50
@@ -449,9 +875,16 @@ def submit_node_quiz():
                         new_level = calc_level
                     else: new_level = current_level
                     new_xp = current_xp
-                conn.commit()
+
+                    cursor.execute("SELECT user_id FROM progress WHERE id = ?", (attempt_id,))
+                    user_id = cursor.fetchone()[0]
+                    record_learner_event(cursor, user_id,
+                                         counters={"quizzes_passed": 1, "lessons_completed": newly_completed},
+                                         values={"xp": new_xp, "level": new_level})
         except: pass
 
+    log_event("quiz_submitted", user_id=user_id, attempt_id=attempt_id, node_title=node_title,
+              passed=bool(passed), score=data.get('score'), xp_gained=xp_gained)
     return jsonify({ "success": True, "xp_gained": xp_gained, "total_xp": new_xp, "level": new_level })
 
 @app.route('/api/mark_module_complete', methods=['POST'])
@@ -460,15 +893,16 @@ def mark_module_complete():
     attempt_id = data.get('attempt_id')
     module_index = data.get('module_index')
     try:
-        with sqlite3.connect(DB_NAME) as conn:
+        with transaction() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT completed_modules FROM progress WHERE id = ?", (attempt_id,))
+            cursor.execute("SELECT completed_modules, user_id FROM progress WHERE id = ?", (attempt_id,))
             row = cursor.fetchone()
             completed_list = json.loads(row[0]) if row and row[0] else []
             if module_index not in completed_list:
                 completed_list.append(module_index)
                 cursor.execute("UPDATE progress SET completed_modules = ? WHERE id = ?", (json.dumps(completed_list), attempt_id))
-                conn.commit()
+                record_learner_event(cursor, row['user_id'] if row else None, counters={"modules_completed": 1})
+                log_event("module_completed", user_id=row['user_id'] if row else None, attempt_id=attempt_id, module_index=module_index)
             return jsonify({"success": True, "completed_modules": completed_list})
     except Exception as e: return jsonify({"error": str(e)}), 500
 
@@ -480,23 +914,17 @@ def regenerate_remedial():
     failed_questions = data.get('failed_questions')
     
     topic_name = "General"
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT topic_name FROM progress WHERE id = ?", (attempt_id,))
-        res = cursor.fetchone()
-        if res: topic_name = res[0]
+    res = query_one("SELECT topic_name FROM progress WHERE id = ?", (attempt_id,))
+    if res: topic_name = res[0]
 
     result = generate_remedial_content(topic_name, node_title, str(failed_questions))
     
     if result and result.get('content'):
-        with sqlite3.connect(DB_NAME) as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                UPDATE module_lessons 
-                SET content = ?, quiz_data = ? 
-                WHERE attempt_id = ? AND node_title = ?
-            """, (result['content'], json.dumps(result['quiz']), attempt_id, node_title))
-            conn.commit()
+        execute("""
+            UPDATE module_lessons 
+            SET content = ?, quiz_data = ?, image_status = 'done' 
+            WHERE attempt_id = ? AND node_title = ?
+        """, (pack(result['content']), pack(json.dumps(result['quiz'])), attempt_id, node_title))
         return jsonify({"success": True, "new_content": result})
             
     return jsonify({"error": "Failed to generate"}), 500
@@ -512,15 +940,20 @@ def get_node_chat():
     node_title = data.get('node_title')
     messages = []
     try:
-        with sqlite3.connect(DB_NAME) as conn:
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute("SELECT id, sender, message FROM chat_messages WHERE attempt_id = ? AND node_title = ? ORDER BY id ASC", (attempt_id, node_title))
-            rows = cursor.fetchall()
-            for row in rows: messages.append({ "id": row['id'], "sender": row['sender'], "text": row['message'] })
+        rows = query_all("SELECT id, sender, message FROM chat_messages WHERE attempt_id = ? AND node_title = ? ORDER BY id ASC", (attempt_id, node_title))
+        for row in rows: messages.append({ "id": row['id'], "sender": row['sender'], "text": unpack(row['message']) })
     except: pass
     return jsonify({"messages": messages})
 
+# Helper: Store the learner's chat message and count it as activity
+def save_user_message(attempt_id, node_title, message):
+    with transaction() as conn:
+        msg_id = conn.execute("INSERT INTO chat_messages (attempt_id, node_title, sender, message) VALUES (?, ?, ?, ?)", (attempt_id, node_title, 'user', pack(message))).lastrowid
+        owner = conn.execute("SELECT user_id FROM progress WHERE id = ?", (attempt_id,)).fetchone()
+        if owner: record_learner_event(conn, owner[0], counters={"chat_messages": 1})
+    log_event("chat_message", user_id=owner[0] if owner else None, attempt_id=attempt_id, node_title=node_title)
+    return msg_id
+
 @app.route('/api/send_chat_message', methods=['POST'])
 def send_chat_message():
     data = request.json
@@ -529,27 +962,57 @@ def send_chat_message():
     user_message = data.get('message')
     
     # Save User Msg
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute("INSERT INTO chat_messages (attempt_id, node_title, sender, message) VALUES (?, ?, ?, ?)", (attempt_id, node_title, 'user', user_message))
-        user_msg_id = cursor.lastrowid
-        conn.commit()
+    user_msg_id = save_user_message(attempt_id, node_title, user_message)
 
     # Get AI Response
     ai_response_text = generate_doubt_answer(node_title, node_title, user_message) 
 
     # Save AI Msg
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute("INSERT INTO chat_messages (attempt_id, node_title, sender, message) VALUES (?, ?, ?, ?)", (attempt_id, node_title, 'ai', ai_response_text))
-        ai_msg_id = cursor.lastrowid
-        conn.commit()
+    ai_msg_id = execute("INSERT INTO chat_messages (attempt_id, node_title, sender, message) VALUES (?, ?, ?, ?)", (attempt_id, node_title, 'ai', pack(ai_response_text))).lastrowid
 
     return jsonify({
         "user_message": {"id": user_msg_id, "sender": "user", "text": user_message},
         "ai_message": {"id": ai_msg_id, "sender": "ai", "text": ai_response_text}
     })
 
+# Streaming variant of send_chat_message: tokens arrive as the tutor writes them (SSE)
+@app.route('/api/send_chat_message_stream', methods=['POST'])
+def send_chat_message_stream():
+    data = request.json
+    attempt_id = data.get('attempt_id')
+    node_title = data.get('node_title')
+    user_message = data.get('message')
+
+    # Save User Msg
+    user_msg_id = save_user_message(attempt_id, node_title, user_message)
+
+    def generate():
+        yield sse("user_message", {"id": user_msg_id, "sender": "user", "text": user_message})
+
+        parts, ai_msg_id, failed = [], None, None
+        tokens = stream_doubt_answer(node_title, node_title, user_message)
+        try:
+            for text in tokens:
+                parts.append(text)
+                yield sse("token", {"text": text})
+        except Exception as e:
+            failed = e
+        finally:
+            # Runs on completion *and* on client disconnect (GeneratorExit):
+            # stop pulling from Gemini and keep whatever the user already saw.
+            # An answer cut off by an error is not saved as if it were the tutor's reply.
+            tokens.close()
+            ai_response_text = "".join(parts)
+            if ai_response_text and failed is None:
+                ai_msg_id = execute("INSERT INTO chat_messages (attempt_id, node_title, sender, message) VALUES (?, ?, ?, ?)", (attempt_id, node_title, 'ai', pack(ai_response_text))).lastrowid
+        if failed is not None:
+            yield sse("error", {"error": f"The answer was cut off: {failed}"})
+            return
+        yield sse("done", {"id": ai_msg_id, "sender": "ai", "text": ai_response_text})
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 @app.route('/api/save_notes', methods=['POST'])
 def save_notes():
     data = request.json
@@ -557,16 +1020,11 @@ def save_notes():
     node_title = data.get('node_title')
     content = data.get('content')
     try:
-        with sqlite3.connect(DB_NAME) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT id FROM user_notes WHERE attempt_id = ? AND node_title = ?", (attempt_id, node_title))
-            row = cursor.fetchone()
-            if row:
-                cursor.execute("UPDATE user_notes SET content = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?", (content, row[0]))
-            else:
-                cursor.execute("INSERT INTO user_notes (attempt_id, node_title, content) VALUES (?, ?, ?)", (attempt_id, node_title, content))
-            conn.commit()
-            return jsonify({"success": True})
+        execute("""
+            INSERT INTO user_notes (attempt_id, node_title, content) VALUES (?, ?, ?)
+            ON CONFLICT(attempt_id, node_title) DO UPDATE SET content = excluded.content, updated_at = CURRENT_TIMESTAMP
+        """, (attempt_id, node_title, content))
+        return jsonify({"success": True})
     except Exception as e: return jsonify({"error": str(e)}), 500
 
 @app.route('/api/get_notes', methods=['POST'])
@@ -575,12 +1033,8 @@ def get_notes():
     attempt_id = data.get('attempt_id')
     node_title = data.get('node_title')
     try:
-        with sqlite3.connect(DB_NAME) as conn:
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute("SELECT content FROM user_notes WHERE attempt_id = ? AND node_title = ?", (attempt_id, node_title))
-            row = cursor.fetchone()
-            return jsonify({"content": row['content'] if row else ""})
+        row = query_one("SELECT content FROM user_notes WHERE attempt_id = ? AND node_title = ?", (attempt_id, node_title))
+        return jsonify({"content": row['content'] if row else ""})
     except: return jsonify({"content": ""})
 
 # =========================================================
@@ -593,12 +1047,8 @@ def get_user_history():
     user_id = data.get('user_id')
     history = []
     try:
-        with sqlite3.connect(DB_NAME) as conn:
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute("SELECT id, topic_name FROM progress WHERE user_id = ? ORDER BY id DESC LIMIT 10", (user_id,))
-            rows = cursor.fetchall()
-            for row in rows: history.append({ "id": row['id'], "topic": row['topic_name'] })
+        rows = query_all("SELECT id, topic_name FROM progress WHERE user_id = ? ORDER BY id DESC LIMIT 10", (user_id,))
+        for row in rows: history.append({ "id": row['id'], "topic": row['topic_name'] })
     except: pass
     return jsonify({"history": history})
 
@@ -607,18 +1057,63 @@ def delete_topic():
     data = request.json
     attempt_id = data.get('attempt_id')
     try:
-        with sqlite3.connect(DB_NAME) as conn:
+        with transaction() as conn:
             cursor = conn.cursor()
+            cursor.execute("SELECT user_id FROM progress WHERE id = ?", (attempt_id,))
+            owner = cursor.fetchone()
+
             # Cascade delete (manual since SQLite FK cascade might be off)
             cursor.execute("DELETE FROM chat_messages WHERE attempt_id = ?", (attempt_id,))
             cursor.execute("DELETE FROM module_lessons WHERE attempt_id = ?", (attempt_id,))
             cursor.execute("DELETE FROM sub_roadmaps WHERE attempt_id = ?", (attempt_id,))
             cursor.execute("DELETE FROM user_notes WHERE attempt_id = ?", (attempt_id,))
             cursor.execute("DELETE FROM progress WHERE id = ?", (attempt_id,))
-            conn.commit()
-            return jsonify({"success": True})
+
+            # The topic's modules / lessons / messages no longer count
+            if owner: refresh_learner(cursor, owner[0])
+
+        # Drop queued pre-fetches for this topic (running ones stop at their zombie check)
+        dropped = scheduler.cancel(attempt_id)
+        if dropped: print(f"🧹 [Scheduler] Cancelled {dropped} pending tasks for topic {attempt_id}")
+        return jsonify({"success": True})
     except Exception as e: return jsonify({"error": str(e)}), 500
 
+def advance_streak(user_id, user):
+    """
+    Applies today's visit to the streak, given the user's (streak, last_active_date) row.
+    Writes only when the date actually changed (i.e. on the first visit of the day).
+    """
+    current_streak = user['streak'] or 0
+    last_date_str = user['last_active_date']
+    today_str = date.today().isoformat()
+
+    if last_date_str == today_str:
+        return {"streak": current_streak, "message": "Streak unchanged", "just_increased": False}
+
+    if last_date_str:
+        delta = (date.today() - date.fromisoformat(last_date_str)).days
+        if delta == 1:
+            new_streak, message = current_streak + 1, "🔥 Streak increased!"
+        else:
+            new_streak, message = 1, "💔 Streak reset"
+    else:
+        new_streak, message = 1, "🔥 First streak day!"
+
+    with transaction() as conn:
+        # Compare-and-set on the date we read: a concurrent page load can't double-count the day
+        cursor = conn.execute("UPDATE users SET streak = ?, last_active_date = ? WHERE id = ? AND last_active_date IS ?",
+                              (new_streak, today_str, user_id, last_date_str))
+        if cursor.rowcount == 0:
+            row = conn.execute("SELECT streak FROM users WHERE id = ?", (user_id,)).fetchone()
+            return {"streak": row[0] if row else current_streak, "message": "Streak unchanged", "just_increased": False}
+        record_learner_event(conn, user_id, values={"streak": new_streak})
+
+    return {
+        "streak": new_streak,
+        "message": message,
+        "just_increased": (new_streak > current_streak and new_streak > 1)
+    }
+
 @app.route('/api/update_streak', methods=['POST'])
 def update_streak():
     data = request.json
@@ -626,44 +1121,44 @@ def update_streak():
     if not user_id: return jsonify({"error": "No User ID"}), 400
 
     try:
-        with sqlite3.connect(DB_NAME) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT streak, last_active_date FROM users WHERE id = ?", (user_id,))
-            row = cursor.fetchone()
-            
-            if not row: return jsonify({"error": "User not found"}), 404
-            
-            current_streak = row[0] or 0
-            last_date_str = row[1]
-            today_str = date.today().isoformat()
-            
-            new_streak = current_streak
-            message = "Streak unchanged"
-            
-            if last_date_str == today_str:
-                pass 
-            elif last_date_str:
-                last_date = date.fromisoformat(last_date_str)
-                delta = (date.today() - last_date).days
-                if delta == 1:
-                    new_streak += 1
-                    message = "🔥 Streak increased!"
-                else:
-                    new_streak = 1
-                    message = "💔 Streak reset"
-            else:
-                new_streak = 1
-                message = "🔥 First streak day!"
-
-            cursor.execute("UPDATE users SET streak = ?, last_active_date = ? WHERE id = ?", (new_streak, today_str, user_id))
-            conn.commit()
-            
-            return jsonify({
-                "streak": new_streak, 
-                "message": message,
-                "just_increased": (new_streak > current_streak and new_streak > 1)
-            })
-            
+        user = query_one("SELECT streak, last_active_date FROM users WHERE id = ?", (user_id,))
+        if not user: return jsonify({"error": "User not found"}), 404
+        return jsonify(advance_streak(user_id, user))
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Everything the sidebar needs on page load, from one users-row read on one pooled connection
+# (replaces get_user_history + predict_dropout_risk + update_streak + get_notifications)
+@app.route('/api/bootstrap', methods=['POST'])
+def bootstrap():
+    data = request.json
+    user_id = data.get('user_id')
+    if not user_id: return jsonify({"error": "No User ID"}), 400
+
+    try:
+        with connection():
+            user = query_one("SELECT xp, level, streak, last_active_date FROM users WHERE id = ?", (user_id,))
+            if not user: return jsonify({"error": "User not found"}), 404
+
+            streak = advance_streak(user_id, user)
+            # Notifications see the streak as it is after this visit
+            user = dict(user, streak=streak['streak'], last_active_date=date.today().isoformat())
+
+            try:
+                risk = get_risk(user_id)
+            except Exception as e:
+                risk = {"error": str(e)}
+
+            rows = query_all("SELECT id, topic_name FROM progress WHERE user_id = ? ORDER BY id DESC LIMIT 10", (user_id,))
+
+        return jsonify({
+            "history": [{"id": row['id'], "topic": row['topic_name']} for row in rows],
+            "streak": streak,
+            "risk": risk,
+            "notifications": build_notifications(user),
+            "xp": user['xp'],
+            "level": user['level']
+        })
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -676,11 +1171,82 @@ def get_dropout_risk():
     data = request.json
     user_id = data.get('user_id')
     try:
-        result = predict_risk(user_id)
+        result = get_risk(user_id)  # Precomputed score unless stale
         return jsonify(result)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+# Re-scores every learner in the background (one SQL pass, chunked predict_proba)
+@app.route('/api/score_risk_batch', methods=['POST'])
+def score_risk_batch():
+    ml_pool.submit(score_all_users)
+    return jsonify({"queued": True}), 202
+
+@app.route('/api/high_risk_learners', methods=['GET'])
+def get_high_risk_learners():
+    try:
+        limit = int(request.args.get('limit', 50))
+    except ValueError:
+        return jsonify({"error": "limit must be an integer"}), 400
+    if limit < 1: return jsonify({"error": "limit must be positive"}), 400  # SQLite reads LIMIT -1 as "no limit"
+    return jsonify({"learners": high_risk_users(min(limit, 500))})
+
+# Training runs in the background; poll /api/training_status for progress and metrics
+@app.route('/api/train_model', methods=['POST'])
+def start_training():
+    data = request.json or {}
+    job_id = training_jobs.start(search=bool(data.get('search')), promote=data.get('promote', True))
+    return jsonify({"job_id": job_id}), 202
+
+@app.route('/api/training_status', methods=['GET'])
+def get_training_status():
+    job = training_jobs.status(request.args.get('job_id'))
+    if not job:
+        return jsonify({"error": "Unknown training job"}), 404
+    return jsonify(job)
+
+@app.route('/api/model_info', methods=['GET'])
+def get_model_info():
+    return jsonify(model_registry.info())
+
+# Explicit hot reload (the registry also picks up a replaced model file on its own)
+@app.route('/api/reload_model', methods=['POST'])
+def reload_model():
+    model_registry.reload(force=True)
+    return jsonify(model_registry.info())
+
+def build_notifications(user):
+    """Notification cards for a users row (xp, streak, last_active_date)."""
+    notifications = []
+
+    # 1. Welcome Msg
+    notifications.append({
+        "id": 1, "type": "info", "title": "Welcome!", "message": "Start learning to earn XP.", "time": "Just now"
+    })
+
+    # 2. Streak Msg
+    if user['streak'] > 0:
+        notifications.append({
+            "id": 2, "type": "success", "title": "🔥 Streak Active!", "message": f"{user['streak']} day streak.", "time": "Today"
+        })
+
+    # 3. Risk Msg
+    if user['xp'] < 50 and user['streak'] == 0:
+         notifications.append({
+            "id": 3, "type": "warning", "title": "⚠️ Risk Alert", "message": "You are falling behind.", "time": "2h ago"
+        })
+
+    # 4. Inactivity Msg
+    if user['last_active_date']:
+        last_date = datetime.strptime(user['last_active_date'], "%Y-%m-%d").date()
+        days_gap = (datetime.now().date() - last_date).days
+        if days_gap > 2:
+            notifications.append({
+                "id": 4, "type": "mail", "title": "💌 We missed you...", "message": f"Gone for {days_gap} days.", "time": f"{days_gap}d ago"
+            })
+
+    return notifications
+
 @app.route('/api/get_notifications', methods=['POST'])
 def get_notifications():
     data = request.json
@@ -688,42 +1254,47 @@ def get_notifications():
     notifications = []
     
     try:
-        with sqlite3.connect(DB_NAME) as conn:
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute("SELECT xp, streak, last_active_date FROM users WHERE id = ?", (user_id,))
-            user = cursor.fetchone()
-            
-            if not user: return jsonify({"notifications": []})
-
-            # 1. Welcome Msg
-            notifications.append({
-                "id": 1, "type": "info", "title": "Welcome!", "message": "Start learning to earn XP.", "time": "Just now"
-            })
-
-            # 2. Streak Msg
-            if user['streak'] > 0:
-                notifications.append({
-                    "id": 2, "type": "success", "title": "🔥 Streak Active!", "message": f"{user['streak']} day streak.", "time": "Today"
-                })
-
-            # 3. Risk Msg
-            if user['xp'] < 50 and user['streak'] == 0:
-                 notifications.append({
-                    "id": 3, "type": "warning", "title": "⚠️ Risk Alert", "message": "You are falling behind.", "time": "2h ago"
-                })
-
-            # 4. Inactivity Msg
-            if user['last_active_date']:
-                last_date = datetime.strptime(user['last_active_date'], "%Y-%m-%d").date()
-                days_gap = (datetime.now().date() - last_date).days
-                if days_gap > 2:
-                    notifications.append({
-                        "id": 4, "type": "mail", "title": "💌 We missed you...", "message": f"Gone for {days_gap} days.", "time": f"{days_gap}d ago"
-                    })
-
+        user = query_one("SELECT xp, streak, last_active_date FROM users WHERE id = ?", (user_id,))
+        if user: notifications = build_notifications(user)
     except Exception as e: print(e)
     return jsonify({"notifications": notifications})
 
+# =========================================================
+# 📈 MONITORING
+# =========================================================
+
+@app.route('/api/db_stats', methods=['GET'])
+def get_db_stats():
+    return jsonify(db_stats())
+
+@app.route('/api/scheduler_stats', methods=['GET'])
+def get_scheduler_stats():
+    stats = scheduler.stats()
+    stats["single_flight"] = generation_flights.stats()
+    return jsonify(stats)
+
+@app.route('/api/llm_stats', methods=['GET'])
+def get_llm_stats():
+    return jsonify({"cache": llm_cache.stats(), "limiter": llm_limiter.stats(), "image_cache": image_cache.stats(),
+                    "image_mirror": mirror_stats(), "content_codec": codec_stats(), "json_parse": parse_stats()})
+
+# Per generation function: tokens, retries, parse outcomes and p50/p95/p99 latency
+@app.route('/api/llm_metrics', methods=['GET'])
+def get_llm_metrics():
+    return jsonify(llm_metrics.summary())
+
+@app.route('/api/http_stats', methods=['GET'])
+def get_http_stats():
+    return jsonify(http_stats())
+
+@app.route('/api/event_log_stats', methods=['GET'])
+def get_event_log_stats():
+    return jsonify(event_buffer.stats())
+
+# Prometheus scrape endpoint (see metrics.py)
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return metrics_response()
+
 if __name__ == '__main__':
     app.run(debug=True, port=5000, threaded=True)
\ No newline at end of file
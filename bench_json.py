@@ -0,0 +1,82 @@
+import json
+import sys
+import timeit
+
+from flask import Flask, jsonify
+
+import json_codec
+from json_codec import FastJSONProvider, RawJSON, json_response
+
+# =========================================================
+# ⏱️ JSON MICROBENCHMARK
+# Old read path (json.loads the stored TEXT, then jsonify) vs the codec and the raw splice.
+# Usage: python bench_json.py [repeats]
+# =========================================================
+
+def make_roadmap(modules=40):
+    return [{"title": f"Module {i}: Concepts and Practice",
+             "description": "Covers the core ideas, worked examples and common pitfalls. " * 3,
+             "difficulty": ["Beginner", "Intermediate", "Advanced"][i % 3]} for i in range(modules)]
+
+def make_quiz(questions=10):
+    return [{"question": f"Question {i}: which statement about the topic is correct?",
+             "options": [f"Option {c} for question {i}" for c in "ABCD"],
+             "correct_answer": f"Option A for question {i}",
+             "explanation": "Because the definition says so, see the lesson section above. " * 2} for i in range(questions)]
+
+def bench(label, fn, number):
+    seconds = min(timeit.repeat(fn, number=number, repeat=5)) / number
+    print(f"  {label:<34} {seconds * 1e6:9.1f} µs")
+    return seconds
+
+def run(number=2000):
+    roadmap_text = json.dumps(make_roadmap())
+    quiz_text = json.dumps(make_quiz())
+    lesson_text = "# Lesson\n\n" + ("Some markdown paragraph with **bold** text and a [link](https://example.org). " * 60)
+    print(f"📦 roadmap_data {len(roadmap_text)} bytes, quiz_data {len(quiz_text)} bytes")
+
+    stdlib_app = Flask("stdlib")
+    fast_app = Flask("fast")
+    fast_app.json = FastJSONProvider(fast_app)
+
+    print("\n🔁 Codec round-trip (roadmap)")
+    old = bench("json.loads + json.dumps", lambda: json.dumps(json.loads(roadmap_text)), number)
+    new = bench("json_codec.loads + dumps", lambda: json_codec.dumps(json_codec.loads(roadmap_text)), number)
+    print(f"  speedup x{old / new:.1f}")
+
+    print("\n🗺️ get_roadmap response body")
+    def old_roadmap():
+        with stdlib_app.app_context():
+            return jsonify({"topic": "Python", "roadmap": json.loads(roadmap_text),
+                            "completed_indices": json.loads("[0, 1]"), "definition": None}).get_data()
+    def fast_roadmap():
+        with fast_app.app_context():
+            return jsonify({"topic": "Python", "roadmap": json_codec.loads(roadmap_text),
+                            "completed_indices": json_codec.loads("[0, 1]"), "definition": None}).get_data()
+    def raw_roadmap():
+        return json_response({"topic": "Python", "roadmap": RawJSON(roadmap_text),
+                              "completed_indices": RawJSON("[0, 1]"), "definition": RawJSON(None)}).get_data()
+    old = bench("loads + jsonify (stdlib)", old_roadmap, number)
+    bench("loads + jsonify (codec)", fast_roadmap, number)
+    new = bench("raw splice", raw_roadmap, number)
+    print(f"  speedup x{old / new:.1f}")
+
+    print("\n📚 get_node response body")
+    def old_lesson():
+        with stdlib_app.app_context():
+            return jsonify({"content": lesson_text, "image_url": None,
+                            "quiz": json.loads(quiz_text), "image_status": "done"}).get_data()
+    def raw_lesson():
+        return json_response({"content": lesson_text, "image_url": None,
+                              "quiz": RawJSON(quiz_text), "image_status": "done"}).get_data()
+    old = bench("loads + jsonify (stdlib)", old_lesson, number)
+    new = bench("raw splice", raw_lesson, number)
+    print(f"  speedup x{old / new:.1f}")
+
+    # The splice must produce the same document
+    assert json.loads(raw_roadmap()) == json.loads(old_roadmap())
+    assert json.loads(raw_lesson()) == json.loads(old_lesson())
+    print("\n✅ Spliced responses decode to the same documents")
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
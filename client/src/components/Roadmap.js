@@ -112,6 +112,7 @@ const Roadmap = () => {
   // Content State
   const [lessonContent, setLessonContent] = useState(""); 
   const [lessonImageUrl, setLessonImageUrl] = useState(""); 
+  const selectedNodeRef = useRef(null); // Lets the image poll notice the user has moved on
   const [quizData, setQuizData] = useState([]); 
   const [loading, setLoading] = useState(false);
   const [hasDeepDived, setHasDeepDived] = useState(false); 
@@ -189,11 +190,8 @@ const Roadmap = () => {
     const fetchMainMap = async () => {
         setLoading(true);
         try {
-            const res = await fetch('http://127.0.0.1:5000/api/get_roadmap', { 
-                method: 'POST', 
-                headers: { 'Content-Type': 'application/json' }, 
-                body: JSON.stringify({ attempt_id: activeId }) 
-            });
+            // GET so the browser cache can revalidate it (304 when nothing changed)
+            const res = await fetch(`http://127.0.0.1:5000/api/get_roadmap?attempt_id=${encodeURIComponent(activeId)}`);
             const data = await res.json();
             
             if (data.roadmap) {
@@ -217,6 +215,15 @@ const Roadmap = () => {
     if (activeId) fetchMainMap();
   }, [currentAttemptId, navigate]); 
 
+  // Stored data comes from a cacheable GET; only a miss (404) POSTs, which generates it
+  const fetchOrGenerate = async (endpoint, body) => { 
+      const url = `http://127.0.0.1:5000/api/${endpoint}`; 
+      const res = await fetch(`${url}?${new URLSearchParams(body)}`); 
+      if (res.status !== 404) return res.json(); 
+      const generated = await fetch(url, { method: 'POST', headers: {'Content-Type': 'application/json'}, body: JSON.stringify(body) }); 
+      return generated.json(); 
+  };
+
   // Handlers
   const handleMainModuleClick = async (m, i) => { 
       setLoading(true); 
@@ -224,12 +231,7 @@ const Roadmap = () => {
       setSubRoadmap([]); 
       setCompletedSubIndices([]); 
       try { 
-          const res = await fetch('http://127.0.0.1:5000/api/get_sub_roadmap', { 
-              method: 'POST', 
-              headers: {'Content-Type': 'application/json'}, 
-              body: JSON.stringify({ attempt_id: currentAttemptId, module_index: i, module_title: m.title }) 
-          }); 
-          const data = await res.json(); 
+          const data = await fetchOrGenerate('get_sub_roadmap', { attempt_id: currentAttemptId, module_index: i, module_title: m.title }); 
           setSubRoadmap(data.sub_roadmap || []); 
           setCompletedSubIndices(data.completed_indices || []); 
           setViewMode('sub_map'); 
@@ -237,9 +239,24 @@ const Roadmap = () => {
       } catch (e) { console.error(e); } finally { setLoading(false); } 
   };
 
+  // Lessons arrive before their picture: poll the cheap image endpoint until it lands
+  const pollLessonImage = async (attemptId, nodeTitle, triesLeft = 10) => { 
+      await new Promise(r => setTimeout(r, 1500)); 
+      if (selectedNodeRef.current !== nodeTitle) return; 
+      try { 
+          const res = await fetch(`http://127.0.0.1:5000/api/get_node_image?attempt_id=${encodeURIComponent(attemptId)}&node_title=${encodeURIComponent(nodeTitle)}`); 
+          if (!res.ok) return; 
+          const data = await res.json(); 
+          if (selectedNodeRef.current !== nodeTitle) return; 
+          if (data.image_status === 'done') { setLessonContent(data.content); setLessonImageUrl(data.image_url); return; } 
+      } catch (e) { console.error(e); } 
+      if (triesLeft > 1) pollLessonImage(attemptId, nodeTitle, triesLeft - 1); 
+  };
+
   const handleSubNodeClick = async (n, i) => { 
       setLoading(true); 
       setSelectedNode(n.title); 
+      selectedNodeRef.current = n.title; 
       setSelectedNodeIndex(i); 
       setLessonContent(""); 
       setLessonImageUrl(""); 
@@ -250,22 +267,18 @@ const Roadmap = () => {
       setCurrentQuestionIndex(0); 
       setUserAnswers({}); 
       try { 
-          const res = await fetch('http://127.0.0.1:5000/api/get_node', { 
-              method: 'POST', 
-              headers: {'Content-Type': 'application/json'}, 
-              body: JSON.stringify({ attempt_id: currentAttemptId, node_title: n.title, node_index: i }) 
-          }); 
-          const data = await res.json(); 
+          const data = await fetchOrGenerate('get_node', { attempt_id: currentAttemptId, node_title: n.title, node_index: i }); 
           setLessonContent(data.content); 
           setLessonImageUrl(data.image_url); 
           setQuizData(data.quiz || []); 
           setViewMode('lesson'); 
           window.scrollTo(0, 0); 
+          if (data.image_status === 'pending') pollLessonImage(currentAttemptId, n.title); 
       } catch (e) { console.error(e); } finally { setLoading(false); } 
   };
 
   const handleBack = () => { 
-      if (viewMode === 'lesson') { setViewMode('sub_map'); setSelectedNode(null); } 
+      if (viewMode === 'lesson') { setViewMode('sub_map'); setSelectedNode(null); selectedNodeRef.current = null; } 
       else { setViewMode('main_map'); setActiveModule(null); } 
       window.scrollTo(0, 0); 
   };
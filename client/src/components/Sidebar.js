@@ -27,38 +27,26 @@ const Sidebar = () => {
     const fetchData = async () => {
       if (!user) return;
       try {
-          // A. History
-          const resHist = await fetch('http://127.0.0.1:5000/api/get_user_history', {
+          // One round trip: history, risk, streak and notifications together
+          const res = await fetch('http://127.0.0.1:5000/api/bootstrap', {
               method: 'POST', headers: { 'Content-Type': 'application/json' },
               body: JSON.stringify({ user_id: user.id })
           });
-          const dataHist = await resHist.json();
-          setHistory(dataHist.history || []);
+          const data = await res.json();
+          if (data.error) throw new Error(data.error);
+
+          // A. History
+          setHistory(data.history || []);
 
           // B. Risk
-          const resRisk = await fetch('http://127.0.0.1:5000/api/predict_dropout_risk', {
-              method: 'POST', headers: { 'Content-Type': 'application/json' },
-              body: JSON.stringify({ user_id: user.id })
-          });
-          const dataRisk = await resRisk.json();
-          if (dataRisk.risk_level) setRiskData({ score: dataRisk.risk_score, level: dataRisk.risk_level });
+          if (data.risk?.risk_level) setRiskData({ score: data.risk.risk_score, level: data.risk.risk_level });
 
           // C. Streak
-          const resStreak = await fetch('http://127.0.0.1:5000/api/update_streak', {
-              method: 'POST', headers: { 'Content-Type': 'application/json' },
-              body: JSON.stringify({ user_id: user.id })
-          });
-          const dataStreak = await resStreak.json();
-          setStreak(dataStreak.streak);
+          setStreak(data.streak?.streak || 0);
 
           // D. Notifications
-          const resNotif = await fetch('http://127.0.0.1:5000/api/get_notifications', {
-              method: 'POST', headers: { 'Content-Type': 'application/json' },
-              body: JSON.stringify({ user_id: user.id })
-          });
-          const dataNotif = await resNotif.json();
-          setNotifications(dataNotif.notifications || []);
-          setUnreadCount(dataNotif.notifications?.length || 0);
+          setNotifications(data.notifications || []);
+          setUnreadCount(data.notifications?.length || 0);
 
       } catch (err) { console.error(err); }
     };
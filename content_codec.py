@@ -0,0 +1,191 @@
+import sys
+import threading
+import time
+
+import zstandard
+
+from database import transaction, query_one, query_all
+
+# =========================================================
+# 🗜️ COMPRESSED CONTENT COLUMNS
+# Lessons, quizzes, roadmaps and chat messages are stored as BLOBs:
+#   [codec byte][payload]   0x00 = raw UTF-8 (too short to be worth it)
+#                           0x01 = zstd frame (its header names the dictionary, 0 = none)
+# Rows still holding TEXT (written before this, or not migrated yet) are read as-is.
+# =========================================================
+
+# --- CONFIGURATION ---
+CODEC_RAW = 0x00
+CODEC_ZSTD = 0x01
+MIN_COMPRESS_BYTES = 64          # Below this the frame header eats the savings
+ZSTD_LEVEL = 6                   # Written once, read many times; decompression speed doesn't depend on it
+DICT_SIZE = 64 * 1024
+DICT_SAMPLES_PER_COLUMN = 2000
+
+COMPRESSED_COLUMNS = (
+    ("module_lessons", "content"),
+    ("module_lessons", "quiz_data"),
+    ("progress", "roadmap_data"),
+    ("chat_messages", "message"),
+)
+
+_lock = threading.Lock()
+_local = threading.local()      # zstd (de)compressors are not safe to share between threads
+_dictionaries = {}              # dict_id -> ZstdCompressionDict
+_current = None                 # Dictionary new rows are written with (None = plain zstd)
+_loaded = False
+_stats = {"packed": 0, "unpacked": 0, "bytes_in": 0, "bytes_out": 0}
+
+def ensure_zstd_dictionaries_table(conn):
+    """Schema, applied by app.py's versioned migrations."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS zstd_dictionaries (
+            dict_id INTEGER PRIMARY KEY,
+            data BLOB,
+            sample_count INTEGER,
+            created_at REAL
+        )
+    ''')
+
+def _load_dictionaries():
+    global _current, _loaded
+    if _loaded: return
+    rows = query_all("SELECT dict_id, data FROM zstd_dictionaries ORDER BY created_at")
+    with _lock:
+        for row in rows:
+            _dictionaries[row['dict_id']] = zstandard.ZstdCompressionDict(row['data'])
+        if rows: _current = _dictionaries[rows[-1]['dict_id']]
+        _loaded = True
+
+def _dictionary(dict_id):
+    """Dictionary for a frame; one trained by another process after we started is fetched on demand."""
+    found = _dictionaries.get(dict_id)
+    if found is None:
+        row = query_one("SELECT data FROM zstd_dictionaries WHERE dict_id = ?", (dict_id,))
+        if not row: raise ValueError(f"unknown zstd dictionary {dict_id}")
+        found = zstandard.ZstdCompressionDict(row['data'])
+        with _lock: _dictionaries[dict_id] = found
+    return found
+
+def _compressor():
+    cached = getattr(_local, "compressor", None)
+    if cached and cached[0] is _current:
+        return cached[1]
+    compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL, dict_data=_current) if _current else zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+    _local.compressor = (_current, compressor)
+    return compressor
+
+def _decompressor(dict_id):
+    cache = getattr(_local, "decompressors", None)
+    if cache is None: cache = _local.decompressors = {}
+    if dict_id not in cache:
+        cache[dict_id] = zstandard.ZstdDecompressor(dict_data=_dictionary(dict_id)) if dict_id else zstandard.ZstdDecompressor()
+    return cache[dict_id]
+
+def pack(text):
+    """str -> BLOB for storage (None stays NULL)."""
+    if text is None: return None
+    _load_dictionaries()
+    data = text.encode("utf-8")
+    if len(data) < MIN_COMPRESS_BYTES:
+        packed = bytes([CODEC_RAW]) + data
+    else:
+        packed = bytes([CODEC_ZSTD]) + _compressor().compress(data)
+    with _lock:
+        _stats["packed"] += 1
+        _stats["bytes_in"] += len(data)
+        _stats["bytes_out"] += len(packed)
+    return packed
+
+def unpack(value):
+    """Stored value -> str. Call it only where the column is actually used or returned."""
+    if value is None or isinstance(value, str): return value
+    codec, payload = value[0], memoryview(value)[1:]
+    if codec == CODEC_RAW:
+        return bytes(payload).decode("utf-8")
+    if codec != CODEC_ZSTD:
+        raise ValueError(f"unknown content codec {codec}")
+    _load_dictionaries()
+    dict_id = zstandard.get_frame_parameters(payload).dict_id
+    with _lock: _stats["unpacked"] += 1
+    return _decompressor(dict_id).decompress(payload).decode("utf-8")
+
+def codec_stats():
+    with _lock:
+        stats = dict(_stats)
+        stats["dictionary_id"] = _current.dict_id() if _current else None
+    stats["ratio"] = round(stats["bytes_out"] / stats["bytes_in"], 3) if stats["bytes_in"] else 0.0
+    return stats
+
+# =========================================================
+# 🧰 MAINTENANCE (python content_codec.py train | migrate | stats)
+# =========================================================
+
+def train_dictionary(samples_per_column=DICT_SAMPLES_PER_COLUMN, dict_size=DICT_SIZE):
+    """Trains a dictionary on the newest rows of every compressed column and makes it current."""
+    global _current
+    samples = []
+    for table, column in COMPRESSED_COLUMNS:
+        rows = query_all(f"SELECT {column} FROM {table} WHERE {column} IS NOT NULL ORDER BY id DESC LIMIT ?", (samples_per_column,))
+        samples.extend(unpack(row[0]).encode("utf-8") for row in rows)
+
+    dictionary = zstandard.train_dictionary(dict_size, samples, level=ZSTD_LEVEL)  # ZstdError if there is too little data
+    with transaction() as conn:
+        conn.execute("INSERT OR REPLACE INTO zstd_dictionaries (dict_id, data, sample_count, created_at) VALUES (?, ?, ?, ?)",
+                     (dictionary.dict_id(), dictionary.as_bytes(), len(samples), time.time()))
+    with _lock:
+        _dictionaries[dictionary.dict_id()] = dictionary
+        _current = dictionary
+    return dictionary.dict_id(), len(samples)
+
+def migrate_rows(batch_size=500, pause=0.05):
+    """
+    Packs remaining TEXT rows, one short transaction per batch, so the app keeps
+    serving (and writing) while it runs. Compression happens outside the transaction
+    and each UPDATE only applies if the row still holds the text we read.
+    """
+    totals = {}
+    for table, column in COMPRESSED_COLUMNS:
+        last_id, converted = 0, 0
+        while True:
+            rows = query_all(f"""
+                SELECT id, {column} FROM {table}
+                WHERE id > ? AND typeof({column}) = 'text' ORDER BY id LIMIT ?
+            """, (last_id, batch_size))
+            if not rows: break
+            last_id = rows[-1]['id']
+
+            updates = [(pack(row[column]), row['id'], row[column]) for row in rows]
+            with transaction() as conn:
+                converted += conn.executemany(f"UPDATE {table} SET {column} = ? WHERE id = ? AND {column} = ?", updates).rowcount
+            time.sleep(pause)  # Let foreground writers in between batches
+
+        totals[f"{table}.{column}"] = converted
+        print(f"🗜️ {table}.{column}: packed {converted} rows")
+    return totals
+
+def storage_stats():
+    stats = {}
+    for table, column in COMPRESSED_COLUMNS:
+        row = query_one(f"""
+            SELECT SUM(typeof({column}) = 'text') AS text_rows, SUM(typeof({column}) = 'blob') AS blob_rows,
+                   COALESCE(SUM(length(CAST({column} AS BLOB))), 0) AS bytes
+            FROM {table}
+        """)
+        stats[f"{table}.{column}"] = {"text_rows": row['text_rows'] or 0, "blob_rows": row['blob_rows'] or 0, "bytes": row['bytes']}
+    return stats
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    if command == "train":
+        dict_id, count = train_dictionary()
+        print(f"✅ Trained dictionary {dict_id} on {count} samples")
+    elif command == "migrate":
+        batch = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+        migrate_rows(batch_size=batch)
+        print("✅ Done. Run VACUUM during a quiet period to return the freed pages to the OS.")
+    elif command == "stats":
+        for name, stats in storage_stats().items():
+            print(f"{name}: {stats}")
+    else:
+        print("Usage: python content_codec.py train | migrate [batch_size] | stats")
@@ -0,0 +1,184 @@
+import sqlite3
+import threading
+import queue
+import time
+from contextlib import contextmanager
+
+# --- CONFIGURATION ---
+DB_NAME = "learning_app.db"
+POOL_SIZE = 8                 # Max open connections shared by routes + background workers
+BUSY_TIMEOUT_MS = 5000        # How long a writer waits on a locked DB before giving up
+STATEMENT_CACHE_SIZE = 256    # Prepared statements kept per connection (sqlite3 LRU)
+
+# Applied to every new connection.
+# WAL lets the prefetch workers write while routes keep reading.
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",      # Safe with WAL, avoids an fsync per commit
+    "PRAGMA cache_size=-16000",       # ~16 MB page cache per connection
+    "PRAGMA mmap_size=134217728",     # 128 MB memory-mapped reads
+    "PRAGMA temp_store=MEMORY",
+    f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}",
+)
+
+_idle = queue.LifoQueue()   # LIFO keeps the warmest connection (hot page cache) in use
+_local = threading.local()  # Connection currently checked out by this thread
+_lock = threading.Lock()
+_stats = {
+    "connections_opened": 0,
+    "statements_executed": 0,
+    "checkouts": 0,
+    "pool_waits": 0,
+}
+_observer = None            # fn(sql, seconds) called after each statement, see set_query_observer()
+
+def _bump(key, n=1):
+    with _lock:
+        _stats[key] += n
+
+def set_query_observer(fn):
+    """
+    Registers fn(sql, seconds), called after every statement (None removes it).
+    The time covers execute() only: SELECTs step their first row there, later fetches aren't included.
+    """
+    global _observer
+    _observer = fn
+
+class _CountingCursor(sqlite3.Cursor):
+    def execute(self, sql, params=()):
+        _bump("statements_executed")
+        observer = _observer
+        if observer is None:
+            return super().execute(sql, params)
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, params)
+        finally:
+            observer(sql, time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_params):
+        _bump("statements_executed")
+        observer = _observer
+        if observer is None:
+            return super().executemany(sql, seq_of_params)
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_params)
+        finally:
+            observer(sql, time.perf_counter() - start)
+
+class _PooledConnection(sqlite3.Connection):
+    """Routes every statement through _CountingCursor so the stats see them all."""
+    def cursor(self, factory=_CountingCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+def _open_connection():
+    conn = sqlite3.connect(
+        DB_NAME,
+        timeout=BUSY_TIMEOUT_MS / 1000,
+        cached_statements=STATEMENT_CACHE_SIZE,
+        check_same_thread=False,  # Connections move between threads via the pool
+        factory=_PooledConnection,
+    )
+    conn.row_factory = sqlite3.Row
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+def _checkout():
+    try:
+        return _idle.get_nowait()
+    except queue.Empty:
+        pass
+
+    # Reserve a slot under the lock so racing threads can't overshoot POOL_SIZE
+    with _lock:
+        can_open = _stats["connections_opened"] < POOL_SIZE
+        if can_open: _stats["connections_opened"] += 1
+    if can_open:
+        try:
+            return _open_connection()
+        except Exception:
+            _bump("connections_opened", -1)
+            raise
+
+    # Pool exhausted: wait for another thread to hand a connection back
+    _bump("pool_waits")
+    try:
+        return _idle.get(timeout=BUSY_TIMEOUT_MS / 1000)
+    except queue.Empty:
+        raise sqlite3.OperationalError("database connection pool exhausted")
+
+@contextmanager
+def connection():
+    """
+    Checks a pooled connection out for the current thread.
+    Re-entrant: nested calls on the same thread share one connection.
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is not None:
+        yield conn
+        return
+
+    conn = _checkout()
+    _bump("checkouts")
+    _local.conn = conn
+    try:
+        yield conn
+    finally:
+        _local.conn = None
+        if conn.in_transaction:
+            conn.rollback()  # Never hand a half-finished transaction to the next user
+        _idle.put(conn)
+
+@contextmanager
+def transaction():
+    """
+    Runs the block in one write transaction (BEGIN IMMEDIATE ... COMMIT).
+    Taking the write lock up-front means SQLite's busy timeout applies,
+    instead of failing later when a read lock can't be upgraded.
+    Nested calls join the outer transaction.
+    """
+    with connection() as conn:
+        if conn.in_transaction:
+            yield conn
+            return
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+def execute(sql, params=()):
+    """Runs a single write statement. Auto-commits unless inside transaction()."""
+    with transaction() as conn:
+        return conn.execute(sql, params)
+
+def executemany(sql, seq_of_params):
+    with transaction() as conn:
+        return conn.executemany(sql, seq_of_params)
+
+def query_one(sql, params=()):
+    with connection() as conn:
+        return conn.execute(sql, params).fetchone()
+
+def query_all(sql, params=()):
+    with connection() as conn:
+        return conn.execute(sql, params).fetchall()
+
+def db_stats():
+    """Snapshot of pool counters (for monitoring / debugging)."""
+    with _lock:
+        stats = dict(_stats)
+    stats["idle_connections"] = _idle.qsize()
+    stats["pool_size"] = POOL_SIZE
+    return stats
@@ -0,0 +1,184 @@
+import atexit
+import json
+import sqlite3
+import threading
+import time
+from collections import deque
+
+from database import transaction
+
+# --- CONFIGURATION ---
+FLUSH_BATCH_SIZE = 500        # Flush as soon as this many rows are waiting...
+FLUSH_INTERVAL_SECONDS = 1.0  # ...or this long after the last flush, whichever comes first
+MAX_PENDING = 50000           # Beyond this, new rows are dropped rather than blocking requests
+MAX_FLUSH_RETRIES = 5         # Consecutive failed flushes before the batch at the front is given up on
+
+# Errors caused by the row itself (values SQLite can't bind or that break a constraint)
+ROW_ERRORS = (sqlite3.InterfaceError, sqlite3.ProgrammingError, sqlite3.IntegrityError, sqlite3.DataError,
+              TypeError, ValueError, OverflowError)
+
+class WriteBehindBuffer:
+    """
+    Collects rows in memory and writes them from a background thread in batched
+    executemany() transactions, so callers never wait on SQLite.
+    A batch that fails is retried row by row, and rows SQLite still refuses are
+    dropped (counted as "rejected"), so one bad row can't wedge the queue.
+    If the database itself is unavailable the batch is retried, up to
+    MAX_FLUSH_RETRIES flushes in a row. Rows are flushed on shutdown,
+    but a hard kill can lose up to one interval's worth.
+    """
+
+    def __init__(self, insert_sql, batch_size=FLUSH_BATCH_SIZE,
+                 interval=FLUSH_INTERVAL_SECONDS, max_pending=MAX_PENDING, max_retries=MAX_FLUSH_RETRIES,
+                 name="write-behind"):
+        self.insert_sql = insert_sql
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_pending = max_pending
+        self.max_retries = max_retries
+
+        self._cond = threading.Condition()
+        self._rows = deque()
+        self._closed = False
+        self._failed_flushes = 0             # Consecutive flushes that couldn't write at all
+        self._flush_lock = threading.Lock()  # One writer at a time (background thread or close())
+        self._stats = {"appended": 0, "written": 0, "batches": 0, "dropped": 0, "rejected": 0,
+                       "flush_errors": 0, "abandoned": 0, "max_depth_seen": 0, "last_flush_ms": 0.0}
+
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def append(self, row):
+        """Queues one row. Never blocks on the database; returns False if the row was dropped."""
+        with self._cond:
+            if self._closed or len(self._rows) >= self.max_pending:
+                self._stats["dropped"] += 1
+                return False
+            self._rows.append(row)
+            self._stats["appended"] += 1
+            depth = len(self._rows)
+            if depth > self._stats["max_depth_seen"]: self._stats["max_depth_seen"] = depth
+            if depth >= self.batch_size: self._cond.notify()
+        return True
+
+    def flush(self):
+        """Writes everything queued so far. Returns the number of rows written."""
+        written = 0
+        with self._flush_lock:
+            while True:
+                with self._cond:
+                    batch = [self._rows.popleft() for _ in range(min(self.batch_size, len(self._rows)))]
+                if not batch: return written
+
+                started = time.perf_counter()
+                try:
+                    rejected = self._write(batch)
+                except Exception as e:
+                    # Couldn't write at all (locked, disk full...): keep the rows, unless this keeps happening
+                    self._failed_flushes += 1
+                    with self._cond:
+                        self._stats["flush_errors"] += 1
+                        if self._failed_flushes < self.max_retries:
+                            self._rows.extendleft(reversed(batch))  # Back to the front, order kept
+                        else:
+                            self._stats["abandoned"] += len(batch)
+                    if self._failed_flushes < self.max_retries:
+                        print(f"⚠️ [{self._thread.name}] Flush failed, will retry: {e}")
+                    else:
+                        print(f"⚠️ [{self._thread.name}] Flush failed {self._failed_flushes} times, dropping {len(batch)} rows: {e}")
+                        self._failed_flushes = 0
+                    return written
+
+                self._failed_flushes = 0
+                written += len(batch) - rejected
+                with self._cond:
+                    self._stats["written"] += len(batch) - rejected
+                    self._stats["rejected"] += rejected
+                    self._stats["batches"] += 1
+                    self._stats["last_flush_ms"] = round((time.perf_counter() - started) * 1000, 2)
+
+    def _write(self, batch):
+        """Writes a batch; returns how many rows SQLite refused (those are dropped)."""
+        try:
+            with transaction() as conn:
+                conn.executemany(self.insert_sql, batch)
+            return 0
+        except ROW_ERRORS:
+            pass
+
+        # Find the bad rows: one transaction, each row on its own
+        rejected, first_error = 0, None
+        with transaction() as conn:
+            for row in batch:
+                try:
+                    conn.execute(self.insert_sql, row)
+                except ROW_ERRORS as e:  # Anything else (locked, I/O) aborts the pass and the batch is retried
+                    rejected += 1
+                    first_error = first_error or e
+        if rejected:
+            print(f"⚠️ [{self._thread.name}] Dropped {rejected} of {len(batch)} rows SQLite refused: {first_error}")
+        return rejected
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._closed and len(self._rows) < self.batch_size:
+                    self._cond.wait(self.interval)
+                if self._closed: return
+            self.flush()
+
+    def close(self):
+        """Stops the background thread and writes whatever is left (registered with atexit)."""
+        with self._cond:
+            if self._closed: return
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout=5)
+        self.flush()
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats["queue_depth"] = len(self._rows)
+        stats["max_pending"] = self.max_pending
+        return stats
+
+# =========================================================
+# 📝 LEARNING EVENTS (append-only)
+# =========================================================
+
+def ensure_learning_events_table(conn):
+    """Schema, applied by app.py's versioned migrations."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS learning_events (
+            id INTEGER PRIMARY KEY,
+            created_at REAL,
+            event_type TEXT,
+            user_id INTEGER,
+            attempt_id INTEGER,
+            node_title TEXT,
+            payload TEXT
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_learning_events_user ON learning_events(user_id, created_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_learning_events_attempt ON learning_events(attempt_id, created_at)")
+
+event_buffer = WriteBehindBuffer(
+    "INSERT INTO learning_events (created_at, event_type, user_id, attempt_id, node_title, payload) VALUES (?, ?, ?, ?, ?, ?)",
+    name="event-log",
+)
+
+def _as_id(value):
+    """Ids arrive from request JSON: numbers or numeric strings become int, anything else its str()."""
+    if value is None or (isinstance(value, int) and not isinstance(value, bool)): return value
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return str(value)
+
+def log_event(event_type, user_id=None, attempt_id=None, node_title=None, **payload):
+    """Records a learning event without touching the database on the caller's thread."""
+    event_buffer.append((time.time(), event_type, _as_id(user_id), _as_id(attempt_id),
+                         None if node_title is None else str(node_title),
+                         json.dumps(payload, default=str) if payload else None))
@@ -0,0 +1,123 @@
+import sys
+import time
+
+from database import transaction
+
+# =========================================================
+# 📊 LEARNER FEATURE STORE
+# One row per learner, kept current by the endpoints that change it,
+# so the dropout model reads its inputs with a single primary-key lookup.
+# =========================================================
+
+LEARNER_FEATURES_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS learner_features (
+        user_id INTEGER PRIMARY KEY,
+        xp INTEGER DEFAULT 0,
+        level INTEGER DEFAULT 1,
+        modules_completed INTEGER DEFAULT 0,
+        lessons_completed INTEGER DEFAULT 0,
+        quizzes_passed INTEGER DEFAULT 0,     -- Includes retakes of already-completed lessons
+        chat_messages INTEGER DEFAULT 0,      -- Messages the learner sent (not tutor replies)
+        streak INTEGER DEFAULT 0,
+        last_active_date TEXT,
+        updated_at REAL
+    )
+'''
+
+COUNTERS = ("modules_completed", "lessons_completed", "quizzes_passed", "chat_messages")
+VALUES = ("xp", "level", "streak")
+
+# Model inputs (FEATURES order in ml_service) plus the id.
+# Seeded learners have no activity date, so for them inactivity is simulated from XP
+# (the patterns in seed_data: Dropouts 0-100 XP, Strugglers 50-300, Achievers 500+).
+FEATURES_SQL = """
+    SELECT
+        user_id, xp, level,
+        modules_completed AS modules_count,
+        CASE
+            WHEN last_active_date IS NOT NULL
+                THEN MAX(0, CAST(julianday('now', 'localtime', 'start of day') - julianday(last_active_date) AS INTEGER))
+            WHEN xp < 100 THEN 30   -- Dropout Pattern
+            WHEN xp < 400 THEN 7    -- Struggler Pattern
+            ELSE 1                  -- Achiever Pattern
+        END AS days_inactive
+    FROM learner_features
+"""
+
+# Recomputes rows from the source tables (backfill / repair)
+# Latest of: the streak date, the last chat message, and what the store already knew
+# (quiz / module activity has no timestamp in the source tables)
+_LAST_ACTIVE_DATE = """(SELECT MAX(d) FROM (
+            SELECT u.last_active_date AS d
+            UNION ALL
+            SELECT date(MAX(c.timestamp), 'localtime') FROM progress p JOIN chat_messages c ON c.attempt_id = p.id
+             WHERE p.user_id = u.id AND c.sender = 'user'
+            UNION ALL
+            SELECT f.last_active_date FROM learner_features f WHERE f.user_id = u.id
+        ))"""
+_COMPLETED_LESSONS = """(SELECT COUNT(*) FROM progress p JOIN module_lessons l ON l.attempt_id = p.id
+          WHERE p.user_id = u.id AND l.completed = 1)"""
+
+_REBUILD_SQL = f"""
+    INSERT OR REPLACE INTO learner_features
+        (user_id, xp, level, modules_completed, lessons_completed, quizzes_passed, chat_messages, streak, last_active_date, updated_at)
+    SELECT
+        u.id, COALESCE(u.xp, 0), COALESCE(u.level, 1),
+        COALESCE((SELECT SUM(CASE WHEN json_valid(p.completed_modules) THEN json_array_length(p.completed_modules) END)
+                  FROM progress p WHERE p.user_id = u.id), 0),
+        {_COMPLETED_LESSONS},
+        {_COMPLETED_LESSONS},
+        (SELECT COUNT(*) FROM progress p JOIN chat_messages c ON c.attempt_id = p.id
+          WHERE p.user_id = u.id AND c.sender = 'user'),
+        COALESCE(u.streak, 0),
+        {_LAST_ACTIVE_DATE},
+        ?
+    FROM users u
+"""
+
+def ensure_learner_features_table(conn):
+    conn.execute(LEARNER_FEATURES_SCHEMA)
+
+def rebuild_learner_features(conn=None):
+    """Recomputes every learner's row from users/progress/lessons/chat. Returns the row count."""
+    with transaction() as tx:
+        conn = conn or tx
+        ensure_learner_features_table(conn)
+        conn.execute("DELETE FROM learner_features WHERE user_id NOT IN (SELECT id FROM users)")
+        return conn.execute(_REBUILD_SQL, (time.time(),)).rowcount
+
+def refresh_learner(conn, user_id):
+    """Recomputes one learner's row (e.g. after a topic is deleted, or if the row is missing)."""
+    conn.execute(_REBUILD_SQL + " WHERE u.id = ?", (time.time(), user_id))
+
+def record_learner_event(conn, user_id, counters=None, values=None, active=True):
+    """
+    Applies one event to a learner's row inside the caller's transaction:
+    counters are added (e.g. {"quizzes_passed": 1}), values overwrite (e.g. {"xp": 250}),
+    and active=True marks the learner active today.
+    """
+    if not user_id: return
+    counters = {k: v for k, v in (counters or {}).items() if k in COUNTERS}
+    values = {k: v for k, v in (values or {}).items() if k in VALUES}
+
+    sets = [f"{k} = {k} + ?" for k in counters] + [f"{k} = ?" for k in values]
+    params = list(counters.values()) + list(values.values())
+    if active:
+        sets.append("last_active_date = date('now', 'localtime')")
+    sets.append("updated_at = ?")
+    params += [time.time(), user_id]
+
+    cursor = conn.execute(f"UPDATE learner_features SET {', '.join(sets)} WHERE user_id = ?", params)
+    if cursor.rowcount == 0:
+        # No row yet: build it from the source tables, which already include this event
+        refresh_learner(conn, user_id)
+        if active:
+            conn.execute("UPDATE learner_features SET last_active_date = date('now', 'localtime') WHERE user_id = ?", (user_id,))
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "rebuild":
+        started = time.perf_counter()
+        count = rebuild_learner_features()
+        print(f"✅ Rebuilt learner_features for {count} learners in {time.perf_counter() - started:.2f}s")
+    else:
+        print("Usage: python feature_store.py rebuild")
@@ -0,0 +1,115 @@
+import gzip
+import threading
+from email.utils import formatdate
+
+import brotli
+import zstandard
+from flask import Response, request
+
+# --- CONFIGURATION ---
+COMPRESS_MIN_BYTES = 1024   # Below this the headers cost more than the savings
+COMPRESSIBLE_TYPES = {"application/json", "text/plain", "text/html", "text/markdown", "text/css", "application/javascript"}
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5          # 10-11 are for build-time assets; 5 is close in size and far cheaper per request
+ZSTD_LEVEL = 3
+
+# Stored content versions: bumped by triggers whenever a column the client sees changes
+NOW_SQL = "((julianday('now') - 2440587.5) * 86400.0)"
+VERSIONED_TABLES = {
+    "progress": ("topic_name", "completed_modules", "roadmap_data", "definition_data"),
+    "sub_roadmaps": ("sub_roadmap_data",),
+    "module_lessons": ("content", "image_url", "quiz_data", "image_status"),
+}
+
+_zstd = threading.local()   # ZstdCompressor objects must not be shared between threads
+_lock = threading.Lock()
+_stats = {"not_modified": 0, "compressed": 0, "bytes_in": 0, "bytes_out": 0,
+          "by_encoding": {"zstd": 0, "br": 0, "gzip": 0}}
+
+def _bump(key, n=1):
+    with _lock:
+        _stats[key] += n
+
+def add_content_versions(cursor):
+    """Adds version / updated_at to the content tables and the triggers that maintain them."""
+    for table, columns in VERSIONED_TABLES.items():
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN version INTEGER DEFAULT 1")
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN updated_at REAL")
+        cursor.execute(f"UPDATE {table} SET updated_at = {NOW_SQL}")
+
+        # ALTER TABLE can't default a column to the current time, so inserts are stamped here
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_inserted AFTER INSERT ON {table}
+            BEGIN UPDATE {table} SET updated_at = {NOW_SQL} WHERE id = NEW.id; END
+        """)
+        changed = " OR ".join(f"OLD.{c} IS NOT NEW.{c}" for c in columns)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_changed AFTER UPDATE OF {', '.join(columns)} ON {table}
+            WHEN {changed}
+            BEGIN UPDATE {table} SET version = version + 1, updated_at = {NOW_SQL} WHERE id = NEW.id; END
+        """)
+
+def content_etag(kind, row):
+    """Weak ETag for a versioned row (weak, because the bytes differ per Content-Encoding)."""
+    return f"{kind}{row['id']}.{row['version']}.{int(row['updated_at'] or 0)}"
+
+def with_validators(response, etag, updated_at, max_age=0):
+    """ETag + Last-Modified; max_age=0 means browsers and proxies must revalidate (cheap 304s)."""
+    response.set_etag(etag, weak=True)
+    if updated_at:
+        response.headers["Last-Modified"] = formatdate(int(updated_at), usegmt=True)
+    if max_age:
+        response.cache_control.max_age = max_age
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+def not_modified(etag, updated_at, max_age=0):
+    """A 304 if the client's copy is current, else None (check before building the body)."""
+    if request.if_none_match:
+        fresh = request.if_none_match.contains_weak(etag)
+    else:
+        since = request.if_modified_since
+        fresh = bool(since and updated_at and int(updated_at) <= since.timestamp())
+    if not fresh: return None
+    _bump("not_modified")
+    return with_validators(Response(status=304), etag, updated_at, max_age)
+
+def _compress(data, encoding):
+    if encoding == "zstd":
+        compressor = getattr(_zstd, "compressor", None)
+        if compressor is None:
+            compressor = _zstd.compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+        return compressor.compress(data)
+    if encoding == "br":
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=GZIP_LEVEL)
+
+def compress_response(response):
+    """after_request hook: zstd / brotli / gzip for large text bodies, by the client's Accept-Encoding."""
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or "Content-Encoding" in response.headers or response.mimetype not in COMPRESSIBLE_TYPES):
+        return response
+
+    response.vary.add("Accept-Encoding")
+    encoding = request.accept_encodings.best_match(["zstd", "br", "gzip"])
+    if not encoding: return response
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_BYTES: return response
+
+    compressed = _compress(data, encoding)
+    if len(compressed) >= len(data): return response
+    response.set_data(compressed)
+    response.headers["Content-Encoding"] = encoding
+    with _lock:
+        _stats["compressed"] += 1
+        _stats["bytes_in"] += len(data)
+        _stats["bytes_out"] += len(compressed)
+        _stats["by_encoding"][encoding] += 1
+    return response
+
+def http_stats():
+    with _lock:
+        stats = dict(_stats, by_encoding=dict(_stats["by_encoding"]))
+    stats["compression_ratio"] = round(stats["bytes_out"] / stats["bytes_in"], 3) if stats["bytes_in"] else 0.0
+    return stats
@@ -0,0 +1,97 @@
+import threading
+import time
+
+from database import execute, query_all
+
+# --- CONFIGURATION ---
+FOUND_TTL_SECONDS = 30 * 24 * 3600    # Commons URLs are stable
+NOT_FOUND_TTL_SECONDS = 7 * 24 * 3600 # "No image for this term" rarely changes either
+ERROR_TTL_SECONDS = 15 * 60           # Timeouts / 403s: retry soon, but not on every lesson
+PURGE_EVERY_N_WRITES = 200            # Amortise the expired-row sweep (like LLMCache eviction)
+
+def ensure_image_search_cache_table(conn):
+    """Schema, applied by app.py's versioned migrations."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS image_search_cache (
+            term TEXT PRIMARY KEY,
+            image_url TEXT,
+            status TEXT,
+            expires_at REAL
+        )
+    ''')
+
+class ImageSearchCache:
+    """
+    Persistent search-term -> image URL cache for Wikimedia lookups.
+    Misses are cached too (image_url NULL), with a shorter TTL for errors
+    than for a genuine "nothing found", so a flaky API isn't hammered.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._writes_since_purge = 0
+        self._stats = {"hits": 0, "negative_hits": 0, "misses": 0, "expired": 0, "writes": 0, "purged": 0}
+
+    @staticmethod
+    def normalize(term):
+        return " ".join(term.split()).casefold()
+
+    def _bump(self, key, n=1):
+        with self._lock:
+            self._stats[key] += n
+
+    def get_many(self, terms):
+        """
+        Returns {normalized_term: url_or_None} for every term with a live entry.
+        Terms missing from the result need a real lookup.
+        """
+        keys = list({self.normalize(t) for t in terms})
+        if not keys: return {}
+
+        placeholders = ",".join("?" * len(keys))
+        rows = query_all(f"SELECT term, image_url, expires_at FROM image_search_cache WHERE term IN ({placeholders})", keys)
+
+        now = time.time()
+        found = {}
+        for row in rows:
+            if row['expires_at'] < now:
+                self._bump("expired")
+                continue
+            found[row['term']] = row['image_url']
+            self._bump("hits" if row['image_url'] else "negative_hits")
+        self._bump("misses", len(keys) - len(found))
+        return found
+
+    def get(self, term):
+        """Returns (hit, url). url is None for a cached miss."""
+        key = self.normalize(term)
+        found = self.get_many([term])
+        return key in found, found.get(key)
+
+    def put(self, term, image_url, status):
+        """status: 'found', 'not_found' or 'error' (decides the TTL)."""
+        ttl = {"found": FOUND_TTL_SECONDS, "not_found": NOT_FOUND_TTL_SECONDS}.get(status, ERROR_TTL_SECONDS)
+        execute("""
+            INSERT INTO image_search_cache (term, image_url, status, expires_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT(term) DO UPDATE SET image_url = excluded.image_url, status = excluded.status, expires_at = excluded.expires_at
+        """, (self.normalize(term), image_url, status, time.time() + ttl))
+        self._bump("writes")
+
+        with self._lock:
+            self._writes_since_purge += 1
+            due = self._writes_since_purge >= PURGE_EVERY_N_WRITES
+            if due: self._writes_since_purge = 0
+        if due: self.purge_expired()
+
+    def purge_expired(self):
+        """Deletes expired entries (terms that are never looked up again would otherwise stay forever)."""
+        purged = execute("DELETE FROM image_search_cache WHERE expires_at < ?", (time.time(),)).rowcount
+        self._bump("purged", purged)
+        return purged
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        lookups = stats["hits"] + stats["negative_hits"] + stats["misses"]
+        stats["hit_rate"] = round((stats["hits"] + stats["negative_hits"]) / lookups, 3) if lookups else 0.0
+        return stats
@@ -0,0 +1,195 @@
+import hashlib
+import io
+import json
+import os
+import sys
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from PIL import Image, ImageOps
+
+from database import execute, query_one
+
+# --- CONFIGURATION ---
+IMAGE_DIR = os.path.join("static", "images")
+PUBLIC_BASE_URL = os.environ.get("PUBLIC_BASE_URL", "http://127.0.0.1:5000")  # Lesson markdown needs absolute URLs
+VARIANT_WIDTHS = (480, 960)          # Never upscaled: widths above the original are skipped (the smallest is always made)
+LESSON_VARIANT = (960, "webp")       # What the lesson markdown embeds
+MAX_DOWNLOAD_BYTES = 25 * 1024 * 1024
+DOWNLOAD_TIMEOUT = (3.05, 20)
+WEBP_QUALITY = 80
+JPEG_QUALITY = 82
+
+CONTENT_TYPES = {"image/jpeg": "jpg", "image/png": "png", "image/gif": "gif", "image/webp": "webp"}
+
+# Commons originals live on upload.wikimedia.org; one keep-alive session for all downloads
+download_session = requests.Session()
+download_session.headers.update({'User-Agent': 'LearnAI_Educational_Project/1.0 (contact: admin@learnai.local)'})
+download_session.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=8))
+
+_lock = threading.Lock()
+_stats = {"mirrored": 0, "reused": 0, "deduped": 0, "failed": 0, "bytes_downloaded": 0}
+
+def _bump(key, n=1):
+    with _lock:
+        _stats[key] += n
+
+def ensure_image_assets_table(conn):
+    """Schema, applied by app.py's versioned migrations."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS image_assets (
+            source_url TEXT PRIMARY KEY,
+            content_hash TEXT,
+            width INTEGER,
+            height INTEGER,
+            variants TEXT,
+            created_at REAL
+        )
+    ''')
+
+def public_url(filename):
+    return f"{PUBLIC_BASE_URL}/static/images/{filename}"
+
+def is_content_addressed(filename):
+    """True for files written by this pipeline (<sha256>.<ext> / <sha256>_<width>.<ext>)."""
+    stem = os.path.splitext(filename)[0].split("_")[0]
+    return len(stem) == 64 and all(c in "0123456789abcdef" for c in stem)
+
+def _write_atomic(path, data):
+    # Identical content always has the same name, so an existing file is already correct
+    if os.path.exists(path): return False
+    tmp = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+    return True
+
+def _download(url):
+    res = download_session.get(url, timeout=DOWNLOAD_TIMEOUT, stream=True)
+    try:
+        res.raise_for_status()
+        ext = CONTENT_TYPES.get(res.headers.get("Content-Type", "").split(";")[0].strip())
+        if not ext:
+            raise ValueError(f"not an image: {res.headers.get('Content-Type')}")
+
+        digest, buf = hashlib.sha256(), io.BytesIO()
+        for chunk in res.iter_content(64 * 1024):
+            digest.update(chunk)
+            buf.write(chunk)
+            if buf.tell() > MAX_DOWNLOAD_BYTES:
+                raise ValueError(f"image larger than {MAX_DOWNLOAD_BYTES} bytes")
+        return buf.getvalue(), digest.hexdigest(), ext
+    finally:
+        res.close()
+
+def _encode(image, fmt, width):
+    if image.width > width:
+        image = image.resize((width, round(image.height * width / image.width)), Image.LANCZOS)
+    out = io.BytesIO()
+    if fmt == "webp":
+        image.save(out, "WEBP", quality=WEBP_QUALITY, method=4)
+    else:
+        if image.mode != "RGB":
+            # JPEG has no alpha: flatten onto white so diagrams don't turn black
+            background = Image.new("RGB", image.size, "white")
+            background.paste(image, mask=image.getchannel("A") if "A" in image.getbands() else None)
+            image = background
+        image.save(out, "JPEG", quality=JPEG_QUALITY, optimize=True, progressive=True)
+    return out.getvalue()
+
+def _build_variants(data, content_hash):
+    """Writes resized WebP/JPEG variants. Returns (width, height, {"<width>_<fmt>": filename})."""
+    with Image.open(io.BytesIO(data)) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "transparency" in image.info or "A" in image.getbands() else "RGB")
+
+        variants = {}
+        for width in VARIANT_WIDTHS:
+            if width >= image.width and width != VARIANT_WIDTHS[0]: continue
+            for fmt in ("webp", "jpg"):
+                filename = f"{content_hash}_{width}.{fmt}"
+                _write_atomic(os.path.join(IMAGE_DIR, filename), _encode(image, fmt, width))
+                variants[f"{width}_{fmt}"] = filename
+        return image.width, image.height, variants
+
+def mirror_image(source_url):
+    """
+    Downloads a remote image once, stores it under its content hash and builds resized variants.
+    Returns the local URL lessons should embed, or None if the image couldn't be mirrored
+    (callers then keep the remote URL).
+    """
+    if not source_url: return None
+
+    row = query_one("SELECT variants FROM image_assets WHERE source_url = ?", (source_url,))
+    if row:
+        _bump("reused")
+        return _lesson_url(json.loads(row['variants']))
+
+    try:
+        data, content_hash, ext = _download(source_url)
+        _bump("bytes_downloaded", len(data))
+        os.makedirs(IMAGE_DIR, exist_ok=True)
+        if not _write_atomic(os.path.join(IMAGE_DIR, f"{content_hash}.{ext}"), data):
+            _bump("deduped")  # Same bytes already mirrored from a different URL
+        width, height, variants = _build_variants(data, content_hash)
+        variants["original"] = f"{content_hash}.{ext}"
+    except Exception as e:
+        print(f"⚠️ Image Mirror Failed ({source_url}): {e}")
+        _bump("failed")
+        return None
+
+    execute("""
+        INSERT INTO image_assets (source_url, content_hash, width, height, variants, created_at) VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(source_url) DO NOTHING
+    """, (source_url, content_hash, width, height, json.dumps(variants), time.time()))
+    _bump("mirrored")
+    print(f"🖼️ Mirrored Image: {source_url} -> {content_hash[:12]}")
+    return _lesson_url(variants)
+
+def _lesson_url(variants):
+    width, fmt = LESSON_VARIANT
+    filename = variants.get(f"{width}_{fmt}") or variants.get(f"{VARIANT_WIDTHS[0]}_{fmt}") or variants["original"]
+    return public_url(filename)
+
+def mirror_stats():
+    with _lock:
+        return dict(_stats)
+
+# =========================================================
+# 🧹 ONE-OFF MAINTENANCE
+# =========================================================
+def dedupe_existing(directory=IMAGE_DIR, dry_run=False):
+    """
+    Hardlinks byte-identical files in `directory` to a single copy.
+    Filenames are kept (old lessons still reference them); only the storage is shared.
+    """
+    by_hash, linked, saved = {}, 0, 0
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if not os.path.isfile(path) or os.path.islink(path): continue
+        with open(path, "rb") as f:
+            content_hash = hashlib.sha256(f.read()).hexdigest()
+
+        keeper = by_hash.setdefault(content_hash, path)
+        if keeper == path or os.path.samefile(keeper, path): continue
+
+        size = os.path.getsize(path)
+        if not dry_run:
+            tmp = f"{path}.link.tmp"
+            os.link(keeper, tmp)
+            os.replace(tmp, path)
+        linked += 1
+        saved += size
+        print(f"🔗 {name} -> {os.path.basename(keeper)}")
+
+    print(f"✅ {'Would link' if dry_run else 'Linked'} {linked} duplicate files, {saved} bytes reclaimed ({len(by_hash)} unique)")
+    return linked, saved
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "dedupe":
+        dedupe_existing(dry_run="--dry-run" in sys.argv)
+    else:
+        print("Usage: python image_pipeline.py dedupe [--dry-run]")
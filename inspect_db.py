@@ -1,6 +1,8 @@
 import sqlite3
 import json
 
+from content_codec import unpack
+
 DB_NAME = "learning_app.db"
 
 def inspect_data():
@@ -29,10 +31,10 @@ def inspect_data():
         
         # 3. Check Roadmap Data Integrity
         raw_roadmap = row['roadmap_data']
-        print(f"\n[Raw Roadmap Data (First 100 chars)]:\n{str(raw_roadmap)[:100]}...")
+        print(f"\n[Raw Roadmap Data (First 100 chars)]:\n{str(unpack(raw_roadmap))[:100]}...")
 
         try:
-            parsed = json.loads(raw_roadmap)
+            parsed = json.loads(unpack(raw_roadmap))  # BLOB once packed by content_codec
             print("\n✅ JSON Parsing: SUCCESS")
             print(f"Type: {type(parsed)}")
             if isinstance(parsed, list):
@@ -0,0 +1,66 @@
+import json as _stdlib_json
+
+from flask import Response
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import ujson as _ujson
+except ImportError:  # Pure-stdlib fallback: same API, just slower
+    _ujson = None
+
+# =========================================================
+# ⚡ JSON CODEC
+# Drop-in for the json calls in app.py / ai_service.py (`import json_codec as json`).
+# ujson round-trips roadmap / lesson sized documents ~1.5x faster (see bench_json.py).
+# =========================================================
+
+if _ujson is not None:
+    JSONDecodeError = _ujson.JSONDecodeError  # A ValueError, like json.JSONDecodeError
+
+    def loads(s):
+        return _ujson.loads(s)
+
+    def dumps(obj, default=None):
+        # Unicode kept as-is and "/" unescaped, so stored TEXT matches what json.dumps wrote before
+        return _ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False, default=default)
+else:
+    JSONDecodeError = _stdlib_json.JSONDecodeError
+
+    def loads(s):
+        return _stdlib_json.loads(s)
+
+    def dumps(obj, default=None):
+        return _stdlib_json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=default)
+
+class FastJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by the codec, so jsonify() and request.json use it too."""
+
+    def dumps(self, obj, **kwargs):
+        return dumps(obj, default=self.default)
+
+    def loads(self, s, **kwargs):
+        return loads(s)
+
+# =========================================================
+# 🧩 RAW JSON SPLICING
+# Columns like roadmap_data / quiz_data are written with dumps() and never edited by hand,
+# so reads can send the stored text as-is instead of loads() + jsonify() round-tripping it.
+# =========================================================
+
+class RawJSON:
+    """Already-serialized JSON, inserted verbatim by json_response(). Empty / NULL becomes `default`."""
+    __slots__ = ("text",)
+
+    def __init__(self, text, default="null"):
+        self.text = text if text else default
+
+def json_response(fields, status=200):
+    """
+    Builds an application/json response from {key: value}; RawJSON values are
+    spliced in without being parsed, everything else goes through dumps().
+    """
+    body = ",".join(
+        f"{dumps(key)}:{value.text if isinstance(value, RawJSON) else dumps(value)}"
+        for key, value in fields.items()
+    )
+    return Response("{" + body + "}", status=status, mimetype="application/json")
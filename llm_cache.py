@@ -0,0 +1,104 @@
+import hashlib
+import json
+import threading
+import time
+
+from database import execute, query_one
+
+# --- CONFIGURATION ---
+CACHE_TTL_SECONDS = 30 * 24 * 3600   # Generated lessons don't go stale quickly
+CACHE_MAX_ENTRIES = 20000            # LRU-evicted beyond this
+EVICT_EVERY_N_WRITES = 50            # Amortise the eviction sweep
+TOUCH_INTERVAL_SECONDS = 300         # Only rewrite last_access this often per entry
+
+def ensure_llm_cache_table(conn):
+    """Schema, applied by app.py's versioned migrations."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS llm_cache (
+            cache_key TEXT PRIMARY KEY,
+            model TEXT,
+            response TEXT,
+            created_at REAL,
+            last_access REAL,
+            hits INTEGER DEFAULT 0
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_llm_cache_last_access ON llm_cache(last_access)")
+
+class LLMCache:
+    """
+    Cross-user cache of parsed LLM responses, stored in SQLite.
+    Keyed on a hash of the normalized prompt + model + generation params,
+    so the second learner asking for "Python Basics" costs zero API calls.
+    """
+
+    def __init__(self, ttl_seconds=CACHE_TTL_SECONDS, max_entries=CACHE_MAX_ENTRIES):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._writes_since_evict = 0
+        self._stats = {"hits": 0, "misses": 0, "expired": 0, "writes": 0, "evicted": 0, "bypassed": 0}
+
+    @staticmethod
+    def make_key(prompt, model, params=None):
+        # Whitespace differences in the prompt shouldn't split the cache. Case must: the answer
+        # echoes the prompt's wording (e.g. the topic name), so it can't be shared across spellings.
+        normalized = " ".join(prompt.split())
+        material = json.dumps([normalized, model, params or {}], sort_keys=True)
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def _bump(self, key, n=1):
+        with self._lock:
+            self._stats[key] += n
+
+    def record_bypass(self):
+        self._bump("bypassed")
+
+    def get(self, key):
+        row = query_one("SELECT response, created_at, last_access FROM llm_cache WHERE cache_key = ?", (key,))
+        if not row:
+            self._bump("misses")
+            return None
+
+        now = time.time()
+        if now - row['created_at'] > self.ttl_seconds:
+            execute("DELETE FROM llm_cache WHERE cache_key = ?", (key,))
+            self._bump("expired")
+            self._bump("misses")
+            return None
+
+        if now - row['last_access'] > TOUCH_INTERVAL_SECONDS:
+            execute("UPDATE llm_cache SET last_access = ?, hits = hits + 1 WHERE cache_key = ?", (now, key))
+        self._bump("hits")
+        return json.loads(row['response'])
+
+    def put(self, key, model, data):
+        now = time.time()
+        execute("""
+            INSERT INTO llm_cache (cache_key, model, response, created_at, last_access) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(cache_key) DO UPDATE SET response = excluded.response, created_at = excluded.created_at, last_access = excluded.last_access
+        """, (key, model, json.dumps(data), now, now))
+        self._bump("writes")
+
+        with self._lock:
+            self._writes_since_evict += 1
+            due = self._writes_since_evict >= EVICT_EVERY_N_WRITES
+            if due: self._writes_since_evict = 0
+        if due: self.evict()
+
+    def evict(self):
+        """Drops expired entries, then the least recently used ones beyond max_entries."""
+        expired = execute("DELETE FROM llm_cache WHERE created_at < ?", (time.time() - self.ttl_seconds,)).rowcount
+        overflow = execute("""
+            DELETE FROM llm_cache WHERE cache_key IN (
+                SELECT cache_key FROM llm_cache ORDER BY last_access DESC LIMIT -1 OFFSET ?
+            )
+        """, (self.max_entries,)).rowcount
+        self._bump("evicted", expired + overflow)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 3) if lookups else 0.0
+        return stats
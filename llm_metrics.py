@@ -0,0 +1,165 @@
+import os
+import random
+import threading
+import time
+from collections import deque
+
+from event_log import WriteBehindBuffer
+
+# --- CONFIGURATION ---
+WINDOW_SIZE = 1000                                              # Rolling samples kept per caller for percentiles
+SAMPLE_RATE = float(os.environ.get("LLM_SAMPLE_RATE", 0))       # Share of calls written to llm_call_samples (0 = off)
+PARSE_OUTCOMES = ("clean", "repaired", "lossy", "failed")
+
+def _percentile(values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not values: return None
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+def ensure_llm_call_samples_table(conn):
+    """Schema, applied by app.py's versioned migrations."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS llm_call_samples (
+            id INTEGER PRIMARY KEY,
+            created_at REAL,
+            caller TEXT,
+            attempt INTEGER,
+            streamed INTEGER,
+            outcome TEXT,
+            parse TEXT,
+            queue_ms REAL,
+            wall_ms REAL,
+            ttft_ms REAL,
+            prompt_tokens INTEGER,
+            output_tokens INTEGER,
+            total_tokens INTEGER
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_llm_call_samples_caller ON llm_call_samples(caller, created_at)")
+
+class LLMCall:
+    """
+    One model call: filled in by the _generate_content wrappers (timing, tokens)
+    and, for JSON prompts, by the parser (finish(parse=...)).
+    """
+
+    def __init__(self, metrics, caller, attempt=1, streamed=False, parsed=False):
+        self.metrics = metrics
+        self.caller = caller
+        self.attempt = attempt
+        self.streamed = streamed
+        self.parsed = parsed              # True: the sample waits for finish(parse=...)
+        self.outcome = None
+        self.parse = None
+        self.queue_ms = None              # Waiting for the rate limiter to admit the call
+        self.wall_ms = None               # Model time, from admission to the end of the response
+        self.ttft_ms = None               # Streams only: time to the first chunk
+        self.prompt_tokens = None
+        self.output_tokens = None
+        self.total_tokens = None
+        self._started = None
+        self._done = False
+
+    def start(self):
+        self._started = time.perf_counter()
+
+    def admitted(self):
+        now = time.perf_counter()
+        if self._started is not None:
+            self.queue_ms = round((now - self._started) * 1000, 1)
+        self._started = now
+
+    def first_chunk(self):
+        if self.ttft_ms is None and self._started is not None:
+            self.ttft_ms = round((time.perf_counter() - self._started) * 1000, 1)
+
+    def set_usage(self, usage):
+        if not usage: return
+        self.prompt_tokens = getattr(usage, "prompt_token_count", None) or self.prompt_tokens
+        self.output_tokens = getattr(usage, "candidates_token_count", None) or self.output_tokens
+        self.total_tokens = getattr(usage, "total_token_count", None) or self.total_tokens
+
+    def end(self, outcome):
+        """Called when the model call itself is over ('ok', 'error', 'throttled' or 'cancelled')."""
+        if self._started is not None and self.wall_ms is None:
+            self.wall_ms = round((time.perf_counter() - self._started) * 1000, 1)
+        self.outcome = outcome
+        if outcome != "ok" or not self.parsed:
+            self.finish()
+
+    def finish(self, parse=None):
+        if self._done: return
+        self._done = True
+        if parse: self.parse = parse
+        self.metrics.record(self)
+
+class LLMMetrics:
+    """In-process rolling aggregates per caller, plus optional sampling into SQLite."""
+
+    def __init__(self, window=WINDOW_SIZE, sample_rate=SAMPLE_RATE):
+        self.window = window
+        self.sample_rate = sample_rate
+        self._lock = threading.Lock()
+        self._callers = {}
+        self._samples = None
+        if sample_rate > 0:
+            self._samples = WriteBehindBuffer(
+                """INSERT INTO llm_call_samples (created_at, caller, attempt, streamed, outcome, parse,
+                   queue_ms, wall_ms, ttft_ms, prompt_tokens, output_tokens, total_tokens) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                name="llm-samples",
+            )
+
+    def call(self, caller, attempt=1, streamed=False, parsed=False):
+        return LLMCall(self, caller, attempt, streamed, parsed)
+
+    def _entry(self, caller):
+        entry = self._callers.get(caller)
+        if entry is None:
+            entry = self._callers[caller] = {
+                "calls": 0, "errors": 0, "throttled": 0, "cancelled": 0, "retries": 0,
+                "prompt_tokens": 0, "output_tokens": 0,
+                "parse": dict.fromkeys(PARSE_OUTCOMES, 0),
+                "wall_ms": deque(maxlen=self.window),
+                "ttft_ms": deque(maxlen=self.window),
+                "output_window": deque(maxlen=self.window),
+            }
+        return entry
+
+    def record(self, call):
+        with self._lock:
+            entry = self._entry(call.caller)
+            entry["calls"] += 1
+            if call.outcome == "error": entry["errors"] += 1
+            elif call.outcome in ("throttled", "cancelled"): entry[call.outcome] += 1
+            if call.attempt > 1: entry["retries"] += 1
+            if call.parse in entry["parse"]: entry["parse"][call.parse] += 1
+            entry["prompt_tokens"] += call.prompt_tokens or 0
+            entry["output_tokens"] += call.output_tokens or 0
+            if call.outcome == "ok":
+                if call.wall_ms is not None: entry["wall_ms"].append(call.wall_ms)
+                if call.ttft_ms is not None: entry["ttft_ms"].append(call.ttft_ms)
+                if call.output_tokens is not None: entry["output_window"].append(call.output_tokens)
+
+        if self._samples and random.random() < self.sample_rate:
+            self._samples.append((time.time(), call.caller, call.attempt, int(call.streamed), call.outcome, call.parse,
+                                  call.queue_ms, call.wall_ms, call.ttft_ms, call.prompt_tokens, call.output_tokens, call.total_tokens))
+
+    def summary(self):
+        """Per caller: counts, token totals and p50/p95/p99 of latency (and time to first chunk for streams)."""
+        with self._lock:
+            snapshot = {caller: (dict(entry, parse=dict(entry["parse"])), sorted(entry["wall_ms"]),
+                                 sorted(entry["ttft_ms"]), sorted(entry["output_window"]))
+                        for caller, entry in self._callers.items()}
+
+        summary = {}
+        for caller, (entry, wall, ttft, output) in snapshot.items():
+            stats = {key: entry[key] for key in ("calls", "errors", "throttled", "cancelled", "retries", "prompt_tokens", "output_tokens")}
+            stats["parse"] = entry["parse"]
+            stats["retry_rate"] = round(entry["retries"] / entry["calls"], 3) if entry["calls"] else 0.0
+            stats["wall_ms"] = {f"p{p}": _percentile(wall, p) for p in (50, 95, 99)}
+            if ttft: stats["ttft_ms"] = {f"p{p}": _percentile(ttft, p) for p in (50, 95, 99)}
+            stats["output_tokens_p50"] = _percentile(output, 50)
+            summary[caller] = stats
+        return summary
+
+llm_metrics = LLMMetrics()
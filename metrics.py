@@ -0,0 +1,104 @@
+import re
+import time
+
+from flask import Response, g, request
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+# =========================================================
+# 📈 PROMETHEUS METRICS (/metrics)
+# Request latency per route, lesson / sub-roadmap cache hits, pre-fetch outcomes,
+# scheduler load and SQLite time per query family. Everything on the hot path is a
+# dict lookup plus an observe(); scheduler numbers are only read when scraped.
+# =========================================================
+
+# --- CONFIGURATION ---
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 90)  # Generation can take a minute
+QUERY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+MAX_QUERY_FAMILIES = 1024      # Distinct SQL strings remembered; past this they are classified on every call
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "Time to build the response (streams: until headers are sent)",
+    ["route", "method", "status"], buckets=REQUEST_BUCKETS,
+)
+CACHE_LOOKUPS = Counter(
+    "content_cache_lookups", "Stored lesson / sub-roadmap lookups", ["cache", "result"],
+)
+PREFETCH_OUTCOMES = Counter(
+    "prefetch_tasks", "Background pre-fetch results: saved, skipped (already there / in flight), zombie (topic deleted), failed",
+    ["kind", "outcome"],
+)
+QUERY_LATENCY = Histogram(
+    "sqlite_query_duration_seconds", "Statement execute() time by statement type and table",
+    ["statement", "table"], buckets=QUERY_BUCKETS,
+)
+
+# --- HTTP (before_request / after_request hooks) ---
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+def record_request(response):
+    started = g.pop("request_started", None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else "unmatched"  # Templates, not raw paths: bounded labels
+        REQUEST_LATENCY.labels(route, request.method, str(response.status_code)).observe(time.perf_counter() - started)
+    return response
+
+# --- Content caches / pre-fetch ---
+def cache_lookup(cache, hit):
+    CACHE_LOOKUPS.labels(cache, "hit" if hit else "miss").inc()
+
+def prefetch_outcome(kind, outcome):
+    PREFETCH_OUTCOMES.labels(kind, outcome).inc()
+
+# --- SQLite (database.set_query_observer) ---
+_TABLE_RE = re.compile(r"\b(?:FROM|INTO|UPDATE|JOIN)\s+(?:OR\s+\w+\s+)?[\"`\[]?(\w+)", re.IGNORECASE)
+_families = {}   # sql -> histogram child; statements are mostly constant strings, so this stays small
+
+def query_family(sql):
+    """("select", "module_lessons") for a statement; tableless ones (PRAGMA, BEGIN) get table "-"."""
+    words = sql.split(None, 1)
+    statement = words[0].lower() if words else "-"
+    match = _TABLE_RE.search(sql)
+    return statement, match.group(1).lower() if match else "-"
+
+def observe_query(sql, seconds):
+    child = _families.get(sql)
+    if child is None:
+        child = QUERY_LATENCY.labels(*query_family(sql))
+        if len(_families) < MAX_QUERY_FAMILIES: _families[sql] = child
+    child.observe(seconds)
+
+# --- Scheduler (read at scrape time) ---
+class _SchedulerCollector:
+    def __init__(self, scheduler, name):
+        self.scheduler = scheduler
+        self.name = name
+
+    def collect(self):
+        stats = self.scheduler.stats()
+        depth = GaugeMetricFamily("scheduler_queue_depth", "Tasks waiting for a worker", labels=["scheduler", "priority"])
+        oldest = GaugeMetricFamily("scheduler_oldest_wait_seconds", "Age of the oldest waiting task", labels=["scheduler", "priority"])
+        for priority, queued in stats["priorities"].items():
+            depth.add_metric([self.name, priority], queued["queued"])
+            oldest.add_metric([self.name, priority], queued["oldest_wait_s"])
+        yield depth
+        yield oldest
+
+        active = GaugeMetricFamily("scheduler_active_workers", "Workers running a task", labels=["scheduler"])
+        active.add_metric([self.name], stats["active_workers"])
+        yield active
+        workers = GaugeMetricFamily("scheduler_max_workers", "Worker threads", labels=["scheduler"])
+        workers.add_metric([self.name], stats["max_workers"])
+        yield workers
+
+        tasks = CounterMetricFamily("scheduler_tasks", "Scheduler task events", labels=["scheduler", "event"])
+        for event in ("submitted", "completed", "failed", "cancelled", "rejected", "evicted"):
+            tasks.add_metric([self.name, event], stats[event])
+        yield tasks
+
+def register_scheduler(scheduler, name):
+    REGISTRY.register(_SchedulerCollector(scheduler, name))
+
+def metrics_response():
+    return Response(generate_latest(REGISTRY), content_type=CONTENT_TYPE_LATEST)
@@ -1,142 +1,467 @@
-import sqlite3
 import pandas as pd
 import numpy as np
-import json
 from datetime import datetime
 from sklearn.ensemble import RandomForestClassifier
-from sklearn.model_selection import train_test_split
+from sklearn.model_selection import train_test_split, cross_val_score, GridSearchCV, StratifiedKFold
+from sklearn.metrics import accuracy_score, roc_auc_score
 from sklearn.impute import SimpleImputer
 import joblib
 import os
+import json
+import shutil
+import hashlib
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
-DB_NAME = "learning_app.db"
-MODEL_PATH = "dropout_model.pkl"
+from database import connection, transaction, execute, query_one, query_all
+from feature_store import FEATURES_SQL, refresh_learner, rebuild_learner_features
 
-def get_db_connection():
-    return sqlite3.connect(DB_NAME)
+MODEL_PATH = "dropout_model.pkl"
+FEATURES = ['xp', 'level', 'modules_count', 'days_inactive']
+RELOAD_CHECK_SECONDS = 5   # How often predict_risk stats the model file for changes
 
-# --- 1. FEATURE ENGINEERING ---
-def fetch_training_data():
+# --- 0. MODEL REGISTRY ---
+class LoadedModel:
     """
-    Fetches raw user data and converts it into ML-ready features.
+    One immutable, versioned model plus a flattened copy of its trees.
+    Walking plain Python lists for a single row is far cheaper than
+    sklearn's predict_proba (input validation, DataFrame, 100 tree calls).
     """
-    conn = get_db_connection()
-    
-    # We join Users and Progress to get a full picture
-    query = """
-    SELECT 
-        u.id, u.xp, u.level,
-        p.completed_modules, p.topic_name,
-        -- We simulate a 'last_active' timestamp using the record creation time for now
-        -- In a real app, you would have a specific 'last_login' column
-        p.id as progress_id 
-    FROM users u
-    LEFT JOIN progress p ON u.id = p.user_id
+    __slots__ = ("model", "version", "path", "mtime", "size", "loaded_at", "trees")
+
+    def __init__(self, model, version, path, mtime, size):
+        self.model = model
+        self.version = version
+        self.path = path
+        self.mtime = mtime
+        self.size = size
+        self.loaded_at = time.time()
+        self.trees = self._flatten(model)
+
+    @staticmethod
+    def _flatten(model):
+        classes = list(model.classes_)
+        positive = classes.index(1) if 1 in classes else None
+        trees = []
+        for estimator in model.estimators_:
+            t = estimator.tree_
+            leaf_prob = []
+            for counts in t.value[:, 0, :]:
+                total = counts.sum()
+                leaf_prob.append(float(counts[positive] / total) if positive is not None and total else 0.0)
+            trees.append((t.children_left.tolist(), t.children_right.tolist(),
+                          t.feature.tolist(), t.threshold.tolist(), leaf_prob))
+        return trees
+
+    def predict_one(self, features):
+        """Dropout probability for one feature row (same order as FEATURES)."""
+        x = array('f', features).tolist()  # sklearn compares in float32; match it exactly
+        total = 0.0
+        for left, right, feature, threshold, leaf_prob in self.trees:
+            node = 0
+            while left[node] != -1:
+                node = left[node] if x[feature[node]] <= threshold[node] else right[node]
+            total += leaf_prob[node]
+        return total / len(self.trees)
+
+class ModelRegistry:
+    """
+    Process-wide holder of the serving model.
+    Loads once, then notices a replaced model file (mtime/size, confirmed by hash)
+    and swaps the new version in atomically; readers never see a half-loaded model.
     """
-    
-    df = pd.read_sql(query, conn)
-    conn.close()
 
-    # Feature 1: Modules Completed (Count)
-    def count_modules(x):
-        try: return len(json.loads(x))
-        except: return 0
-    
-    df['modules_count'] = df['completed_modules'].apply(count_modules)
+    def __init__(self, path=MODEL_PATH, check_interval=RELOAD_CHECK_SECONDS):
+        self.path = path
+        self.check_interval = check_interval
+        self._current = None
+        self._next_check = 0.0
+        self._reload_lock = threading.Lock()
+        self._stats = {"loads": 0, "reload_errors": 0}
 
-    # Feature 2: Inactivity (Simulated for this demo)
-    # Since we don't have real login history logs, we infer inactivity from the fake patterns we seeded
-    # In the seed script: Dropouts have 0-100 XP, Strugglers 50-300, Achievers 500+
-    # We add some randomness to make the model work for it
-    df['days_inactive'] = 0
-    
-    # We reverse-engineer the logic from seed_data to create "Ground Truth" for training
-    # (This teaches the model to recognize the patterns we created)
-    conditions = [
-        (df['xp'] < 100),  # Dropout Pattern
-        (df['xp'] < 400),  # Struggler Pattern
-        (df['xp'] >= 400)  # Achiever Pattern
-    ]
-    choices = [30, 7, 1] # Days inactive
-    df['days_inactive'] = np.select(conditions, choices, default=1)
-    
-    # --- LABELING (The "Teacher" Column) ---
-    # Who is actually a dropout? 
-    # Rule: If inactive > 14 days AND modules < 2, they are a Dropout (1). Else (0).
-    df['is_dropout'] = ((df['days_inactive'] > 14) & (df['modules_count'] < 2)).astype(int)
+    def get(self):
+        """The current LoadedModel (or None if no model exists yet)."""
+        now = time.monotonic()
+        if now >= self._next_check:
+            self._next_check = now + self.check_interval
+            self.reload()
+        return self._current
+
+    def reload(self, force=False):
+        # Only one thread loads; the others keep serving the current version meanwhile
+        if not self._reload_lock.acquire(blocking=force):
+            return self._current
+        try:
+            try: st = os.stat(self.path)
+            except FileNotFoundError: return self._current
+
+            current = self._current
+            if not force and current and (current.mtime, current.size) == (st.st_mtime, st.st_size):
+                return current
+
+            with open(self.path, "rb") as f:
+                version = hashlib.sha256(f.read()).hexdigest()[:12]
+            if current and current.version == version and not force:
+                current.mtime, current.size = st.st_mtime, st.st_size  # Touched, not changed
+                return current
+
+            loaded = LoadedModel(joblib.load(self.path), version, self.path, st.st_mtime, st.st_size)
+            self._current = loaded  # Single reference swap
+            self._stats["loads"] += 1
+            print(f"🧠 [ML] Loaded model {version} from {self.path}")
+            return loaded
+        except Exception as e:
+            # Half-written file or bad pickle: keep serving the previous version
+            self._stats["reload_errors"] += 1
+            print(f"⚠️ [ML] Model reload failed: {e}")
+            return self._current
+        finally:
+            self._reload_lock.release()
+
+    def info(self):
+        current = self._current
+        return {
+            "version": current.version if current else None,
+            "path": self.path,
+            "loaded_at": current.loaded_at if current else None,
+            "trees": len(current.trees) if current else 0,
+            **self._stats,
+        }
 
-    return df[['xp', 'level', 'modules_count', 'days_inactive', 'is_dropout']]
+model_registry = ModelRegistry()
+
+# --- 1. FEATURE ENGINEERING ---
+FETCH_CHUNK_SIZE = 10000   # Rows pulled from SQLite per fetchmany()
+
+# One row per learner straight from the feature store (no joins or JSON parsing)
+TRAINING_FEATURES_SQL = f"""
+    SELECT xp, level, modules_count, days_inactive,
+           -- LABEL: inactive > 14 days AND fewer than 2 modules => Dropout (1)
+           (days_inactive > 14 AND modules_count < 2) AS is_dropout
+    FROM ({FEATURES_SQL})
+"""
+
+def fetch_training_data(chunk_size=FETCH_CHUNK_SIZE):
+    """
+    Returns (X, y): X is a float64 array with one row per user in FEATURES order,
+    y the is_dropout labels. Rows are streamed in fixed-size chunks straight
+    into preallocated arrays, so memory stays at ~40 bytes per user.
+    """
+    with connection() as conn:
+        snapshot = not conn.in_transaction
+        if snapshot: conn.execute("BEGIN")  # One read snapshot: the count and the rows must agree
+        n = conn.execute("SELECT COUNT(*) FROM learner_features").fetchone()[0]
+        X = np.empty((n, len(FEATURES)), dtype=np.float64)
+        y = np.empty(n, dtype=np.int8)
+
+        cursor = conn.cursor()
+        cursor.row_factory = None  # Plain tuples convert to NumPy much faster than sqlite3.Row
+        cursor.execute(TRAINING_FEATURES_SQL)
+        filled = 0
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows: break
+            block = np.array(rows, dtype=np.float64)
+            X[filled:filled + len(rows)] = block[:, :len(FEATURES)]
+            y[filled:filled + len(rows)] = block[:, len(FEATURES)]
+            filled += len(rows)
+        if snapshot: conn.rollback()
+
+    return X[:filled], y[:filled]
 
 # --- 2. TRAINING THE MODEL ---
-def train_model():
+MODELS_DIR = "models"      # Every run's artifact + metrics live here; MODEL_PATH is the promoted one
+CV_FOLDS = 5
+HOLDOUT_FRACTION = 0.2
+SEARCH_GRID = {            # Small on purpose: 8 candidates x CV_FOLDS fits
+    "n_estimators": [100, 300],
+    "max_depth": [None, 8],
+    "min_samples_leaf": [1, 5],
+}
+
+def _stratify_ok(y, folds):
+    # Stratified splits need every class present at least `folds` times
+    counts = np.bincount(y, minlength=2)
+    return counts.min() >= folds
+
+def train_model(search=False, promote=True, on_stage=None):
+    """
+    Trains a new versioned model and (optionally) promotes it to MODEL_PATH.
+    Returns the metrics dict that is also written next to the artifact.
+    on_stage(name) is called as each stage starts (used for job status).
+    """
+    timings = {}
+    stage_started = [time.perf_counter(), None]
+
+    def stage(name):
+        now = time.perf_counter()
+        if stage_started[1]: timings[stage_started[1]] = round(now - stage_started[0], 3)
+        stage_started[:] = [now, name]
+        if on_stage and name: on_stage(name)
+
+    run_id = time.strftime("%Y%m%d-%H%M%S")
+    stage("fetch")
     print("🧠 [ML] Fetching data...")
-    df = fetch_training_data()
+    # learner_features only follows app routes: resync it with users written any other way
+    # (seed_data.py, manual edits), and drop rows of users that no longer exist
+    rebuild_learner_features()
+    # X = Features (What the model looks at), y = Target (What we want to predict)
+    X, y = fetch_training_data()
     
-    if df.empty:
-        return {"error": "No data found. Run seed_data.py first!"}
+    if not len(X):
+        return {"error": "No learners found. Sign some up (or run seed_data.py) first!"}
+    if len(np.unique(y)) < 2:
+        return {"error": "Training data only contains one class."}
 
-    # X = Features (What the model looks at)
-    X = df[['xp', 'level', 'modules_count', 'days_inactive']]
-    
-    # y = Target (What we want to predict)
-    y = df['is_dropout']
+    # Wrapped without copying so the model keeps its feature names
+    X = pd.DataFrame(X, columns=FEATURES, copy=False)
+
+    stage("split")
+    X_train, X_test, y_train, y_test = train_test_split(
+        X, y, test_size=HOLDOUT_FRACTION, random_state=42,
+        stratify=y if _stratify_ok(y, 2) else None
+    )
+    folds = CV_FOLDS if _stratify_ok(y_train, CV_FOLDS) else 2
+    print(f"🧠 [ML] Training on {len(X_train)} students, holding out {len(X_test)}...")
+
+    # Initialize Random Forest (all cores for the trees)
+    rf = RandomForestClassifier(n_estimators=100, random_state=42, n_jobs=-1)
+    params = rf.get_params()
+
+    if search:
+        # GridSearchCV fans the candidate fits out over a process pool (loky)
+        stage("search")
+        grid = GridSearchCV(RandomForestClassifier(random_state=42), SEARCH_GRID,
+                            cv=folds, scoring="roc_auc", n_jobs=-1)
+        grid.fit(X_train, y_train)
+        rf.set_params(**grid.best_params_)
+        params = rf.get_params()
+
+    stage("cross_validate")
+    cv_scores = cross_val_score(RandomForestClassifier(**{**params, "n_jobs": 1}), X_train, y_train,
+                                cv=StratifiedKFold(folds, shuffle=True, random_state=42),
+                                scoring="roc_auc", n_jobs=-1)
+
+    stage("fit")
+    rf.fit(X_train, y_train)
+
+    stage("evaluate")
+    proba = rf.predict_proba(X_test)[:, list(rf.classes_).index(1)]
+    holdout_auc = roc_auc_score(y_test, proba) if len(np.unique(y_test)) == 2 else None
+
+    stage("save")
+    os.makedirs(MODELS_DIR, exist_ok=True)
+    artifact = os.path.join(MODELS_DIR, f"dropout_model_{run_id}.pkl")
+    joblib.dump(rf, artifact)
+    with open(artifact, "rb") as f:
+        version = hashlib.sha256(f.read()).hexdigest()[:12]  # Same version the registry will report
 
-    print(f"🧠 [ML] Training on {len(df)} students...")
-    
-    # Initialize Random Forest
-    rf = RandomForestClassifier(n_estimators=100, random_state=42)
-    rf.fit(X, y)
-    
-    # Save the trained model to a file
-    joblib.dump(rf, MODEL_PATH)
-    print("✅ [ML] Model saved to", MODEL_PATH)
-    
     # Get Feature Importance (For the "Wow" factor in demo)
-    importance = dict(zip(X.columns, rf.feature_importances_))
+    importance = {name: round(float(v), 4) for name, v in zip(FEATURES, rf.feature_importances_)}
+    metrics = {
+        "run_id": run_id,
+        "model_version": version,
+        "artifact": artifact,
+        "rows": {"train": len(X_train), "test": len(X_test)},
+        "params": {k: params[k] for k in ("n_estimators", "max_depth", "min_samples_leaf")},
+        "holdout": {
+            "accuracy": round(float(accuracy_score(y_test, proba > 0.5)), 4),
+            "auc": round(float(holdout_auc), 4) if holdout_auc is not None else None,
+        },
+        "cv_auc": {"mean": round(float(np.mean(cv_scores)), 4), "std": round(float(np.std(cv_scores)), 4), "folds": folds},
+        "feature_importance": importance,
+        "promoted": False,
+    }
+
+    if promote:
+        stage("promote")
+        # Copy next to the serving file, then rename over it: readers see old or new, never half
+        tmp_path = f"{MODEL_PATH}.tmp"
+        shutil.copyfile(artifact, tmp_path)
+        os.replace(tmp_path, MODEL_PATH)
+        model_registry.reload(force=True)
+        metrics["promoted"] = True
+        print(f"✅ [ML] Promoted model {version} to {MODEL_PATH}")
+
+    stage(None)
+    metrics["timings_s"] = timings
+    with open(os.path.join(MODELS_DIR, f"dropout_model_{run_id}.json"), "w") as f:
+        json.dump(metrics, f, indent=2)
+    print(f"✅ [ML] Run {run_id}: accuracy {metrics['holdout']['accuracy']}, AUC {metrics['holdout']['auc']}")
     
-    return {"success": True, "accuracy": "98%", "feature_importance": importance}
+    return {"success": True, **metrics}
+
+class TrainingJobs:
+    """
+    Runs train_model() in the background, one job at a time,
+    and keeps the status of recent jobs for the status endpoint.
+    """
+
+    def __init__(self, keep=20):
+        self.keep = keep
+        self._lock = threading.Lock()
+        self._jobs = OrderedDict()
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="train")
+
+    def start(self, search=False, promote=True):
+        job_id = f"train-{int(time.time() * 1000)}"
+        with self._lock:
+            self._jobs[job_id] = {"job_id": job_id, "state": "queued", "stage": None,
+                                  "search": search, "queued_at": time.time(), "result": None, "error": None}
+            while len(self._jobs) > self.keep:
+                self._jobs.popitem(last=False)
+        self._pool.submit(self._run, job_id, search, promote)
+        return job_id
+
+    def _update(self, job_id, **fields):
+        with self._lock:
+            if job_id in self._jobs: self._jobs[job_id].update(fields)
+
+    def _run(self, job_id, search, promote):
+        self._update(job_id, state="running", started_at=time.time())
+        try:
+            result = train_model(search=search, promote=promote, on_stage=lambda name: self._update(job_id, stage=name))
+            state = "failed" if "error" in result else "succeeded"
+            self._update(job_id, state=state, result=result, error=result.get("error"), finished_at=time.time())
+        except Exception as e:
+            print(f"⚠️ [ML] Training job {job_id} failed: {e}")
+            self._update(job_id, state="failed", error=str(e), finished_at=time.time())
+
+    def status(self, job_id=None):
+        """One job's status (the latest if job_id is None), or None if unknown."""
+        with self._lock:
+            if job_id is None:
+                job_id = next(reversed(self._jobs), None)
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+training_jobs = TrainingJobs()
 
 # --- 3. PREDICTION (LIVE) ---
+RISK_SCORE_MAX_AGE = 6 * 3600   # Precomputed scores older than this are re-scored live
+BATCH_CHUNK_SIZE = 5000         # Rows per predict_proba call / write transaction
+
+def risk_level(risk_prob):
+    return "High" if risk_prob > 0.7 else ("Medium" if risk_prob > 0.3 else "Low")
+
 def predict_risk(user_id):
-    if not os.path.exists(MODEL_PATH):
+    model = model_registry.get()
+    if model is None:
         return {"error": "Model not trained yet."}
-        
-    model = joblib.load(MODEL_PATH)
-    
-    conn = get_db_connection()
-    user = conn.execute("SELECT xp, level FROM users WHERE id = ?", (user_id,)).fetchone()
-    progress = conn.execute("SELECT completed_modules FROM progress WHERE user_id = ?", (user_id,)).fetchone()
-    conn.close()
     
-    if not user: return {"risk_score": 0}
+    # 1. Build the Feature Vector for this single user (one primary-key lookup)
+    user = query_one(FEATURES_SQL + " WHERE user_id = ?", (user_id,))
+    if not user:
+        if not query_one("SELECT 1 FROM users WHERE id = ?", (user_id,)): return {"risk_score": 0}
+        with transaction() as conn: refresh_learner(conn, user_id)  # Row missing: build it once
+        user = query_one(FEATURES_SQL + " WHERE user_id = ?", (user_id,))
     
-    # 1. Build the Feature Vector for this single user
-    xp = user[0]
-    level = user[1]
-    
-    modules_count = 0
-    if progress and progress[0]:
-        try: modules_count = len(json.loads(progress[0]))
-        except: pass
-        
-    # For demo purposes, we assume current user was active "Today" (0 days inactive)
-    # UNLESS they have very low XP, then we simulate risk to show off the UI
-    days_inactive = 0 
-    if xp < 50: days_inactive = 10 # Simulate risk for new/struggling users
-    
-    features = pd.DataFrame([[xp, level, modules_count, days_inactive]], 
-                            columns=['xp', 'level', 'modules_count', 'days_inactive'])
-    
-    # 2. Predict Probability
-    # returns [prob_stay, prob_dropout] -> we want index 1
-    risk_prob = model.predict_proba(features)[0][1] 
+    # 2. Predict Probability (flattened trees, no pandas / sklearn overhead)
+    risk_prob = model.predict_one([user['xp'], user['level'], user['modules_count'], user['days_inactive']])
     
     return {
         "user_id": user_id,
         "risk_score": round(risk_prob * 100, 2), # Return percentage
-        "risk_level": "High" if risk_prob > 0.7 else ("Medium" if risk_prob > 0.3 else "Low")
+        "risk_level": risk_level(risk_prob),
+        "model_version": model.version
     }
 
+# --- 4. BATCH SCORING ---
+def ensure_risk_scores_table(conn):
+    """Schema, applied by app.py's versioned migrations."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS risk_scores (
+            user_id INTEGER PRIMARY KEY,
+            risk_score REAL,
+            risk_level TEXT,
+            model_version TEXT,
+            scored_at REAL
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_risk_scores_score ON risk_scores(risk_score DESC)")
+
+UPSERT_RISK_SQL = """
+    INSERT INTO risk_scores (user_id, risk_score, risk_level, model_version, scored_at) VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET
+        risk_score = excluded.risk_score, risk_level = excluded.risk_level,
+        model_version = excluded.model_version, scored_at = excluded.scored_at
+"""
+
+def score_all_users(chunk_size=BATCH_CHUNK_SIZE, n_jobs=-1):
+    """
+    Scores every user in one SQL pass and writes risk_scores.
+    Each chunk is one vectorized predict_proba (trees spread over n_jobs cores)
+    and one write transaction.
+    """
+    model = model_registry.get()
+    if model is None:
+        return {"error": "Model not trained yet."}
+    rebuild_learner_features()  # Same resync as training: score exactly the users that exist
+
+    started = time.perf_counter()
+    classes = list(model.model.classes_)
+    scored = 0
+
+    with connection() as conn:
+        cursor = conn.execute(FEATURES_SQL)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows: break
+            ids = [r['user_id'] for r in rows]
+            X = pd.DataFrame([tuple(r)[1:] for r in rows], columns=FEATURES)
+
+            with joblib.parallel_config(n_jobs=n_jobs):
+                proba = model.model.predict_proba(X)
+            risk = proba[:, classes.index(1)] if 1 in classes else np.zeros(len(rows))
+
+            now = time.time()
+            with transaction():
+                conn.executemany(UPSERT_RISK_SQL, [
+                    (user_id, round(p * 100, 2), risk_level(p), model.version, now)
+                    for user_id, p in zip(ids, risk.tolist())
+                ])
+            scored += len(rows)
+
+    elapsed = round(time.perf_counter() - started, 3)
+    print(f"✅ [ML] Scored {scored} users with model {model.version} in {elapsed}s")
+    return {"scored": scored, "model_version": model.version, "elapsed_s": elapsed}
+
+def get_risk(user_id):
+    """
+    Risk for the dashboard: the precomputed row when it is fresh and from the
+    serving model, otherwise a live score (which is written back for next time).
+    """
+    model = model_registry.get()
+    row = query_one("SELECT risk_score, risk_level, model_version, scored_at FROM risk_scores WHERE user_id = ?", (user_id,))
+    if row and model and row['model_version'] == model.version and time.time() - row['scored_at'] < RISK_SCORE_MAX_AGE:
+        return {
+            "user_id": user_id,
+            "risk_score": row['risk_score'],
+            "risk_level": row['risk_level'],
+            "model_version": row['model_version'],
+            "scored_at": row['scored_at']
+        }
+
+    result = predict_risk(user_id)
+    if "risk_level" in result:
+        execute(UPSERT_RISK_SQL, (user_id, result['risk_score'], result['risk_level'], result['model_version'], time.time()))
+    return result
+
+def high_risk_users(limit=50):
+    rows = query_all("""
+        SELECT user_id, risk_score, risk_level, model_version, scored_at FROM risk_scores
+        ORDER BY risk_score DESC LIMIT ?
+    """, (limit,))
+    return [dict(r) for r in rows]
+
 if __name__ == "__main__":
-    # Test run
-    train_model()
\ No newline at end of file
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == "score":
+        print(score_all_users())
+    else:
+        # Test run (add --search for the hyperparameter grid)
+        print(json.dumps(train_model(search="--search" in sys.argv), indent=2))
+
@@ -0,0 +1,203 @@
+import threading
+import time
+import itertools
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+# --- PRIORITIES (lower runs first) ---
+PRIORITY_USER_BLOCKING = 0   # Someone is waiting on this right now
+PRIORITY_NEXT_LESSON = 1     # What the user will most likely open next
+PRIORITY_SPECULATIVE = 2     # Deeper look-ahead; first to be shed under load
+
+PRIORITY_NAMES = {
+    PRIORITY_USER_BLOCKING: "user_blocking",
+    PRIORITY_NEXT_LESSON: "next_lesson",
+    PRIORITY_SPECULATIVE: "speculative",
+}
+
+class QueueFull(Exception):
+    """Raised by submit() when the scheduler refuses new work (backpressure)."""
+
+class _Task:
+    __slots__ = ("fn", "args", "kwargs", "priority", "owner", "attempt_id", "future", "enqueued_at", "seq")
+
+    def __init__(self, fn, args, kwargs, priority, owner, attempt_id, seq):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.owner = owner
+        self.attempt_id = attempt_id
+        self.future = Future()
+        self.enqueued_at = time.monotonic()
+        self.seq = seq
+
+class GenerationScheduler:
+    """
+    Background worker pool for AI generation.
+
+    - Strict priority between levels (user-blocking > next lesson > speculative).
+    - Round-robin between owners (users) inside a level, so one user's big
+      roadmap can't starve everyone else.
+    - Bounded queue: speculative work is rejected (or evicted) when full.
+    - cancel(attempt_id) drops everything still pending for a topic.
+    """
+
+    def __init__(self, max_workers=6, max_queue=200, max_per_owner=40, name="gen"):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.max_per_owner = max_per_owner
+
+        self._cond = threading.Condition()
+        # priority -> OrderedDict(owner -> deque[_Task]); dict order is the round-robin order
+        self._queues = {p: OrderedDict() for p in PRIORITY_NAMES}
+        self._depth = 0
+        self._owner_depth = {}
+        self._active = 0
+        self._seq = itertools.count()
+        self._shutdown = False
+
+        self._waits = {p: deque(maxlen=500) for p in PRIORITY_NAMES}  # Recent queue wait times (s)
+        self._counters = {"submitted": 0, "completed": 0, "failed": 0, "cancelled": 0, "rejected": 0, "evicted": 0}
+
+        self._workers = []
+        for i in range(max_workers):
+            t = threading.Thread(target=self._worker_loop, name=f"{name}-worker-{i}", daemon=True)
+            t.start()
+            self._workers.append(t)
+
+    # --- PUBLIC API ---
+    def submit(self, fn, *args, priority=PRIORITY_SPECULATIVE, owner=None, attempt_id=None, **kwargs):
+        """Queues fn(*args, **kwargs). Returns a Future, or raises QueueFull."""
+        with self._cond:
+            if self._shutdown:
+                raise RuntimeError("scheduler is shut down")
+
+            if priority == PRIORITY_SPECULATIVE and self._owner_depth.get(owner, 0) >= self.max_per_owner:
+                self._counters["rejected"] += 1
+                raise QueueFull(f"owner {owner!r} has {self.max_per_owner} tasks pending")
+
+            if self._depth >= self.max_queue:
+                # Make room for important work by dropping the newest speculative task
+                if priority == PRIORITY_SPECULATIVE or not self._evict_speculative():
+                    self._counters["rejected"] += 1
+                    raise QueueFull(f"queue is full ({self.max_queue} tasks)")
+
+            task = _Task(fn, args, kwargs, priority, owner, attempt_id, next(self._seq))
+            self._queues[priority].setdefault(owner, deque()).append(task)
+            self._depth += 1
+            self._owner_depth[owner] = self._owner_depth.get(owner, 0) + 1
+            self._counters["submitted"] += 1
+            self._cond.notify()
+            return task.future
+
+    def cancel(self, attempt_id):
+        """Drops all pending work for a topic. Returns the number of tasks cancelled."""
+        cancelled = []
+        attempt_id = str(attempt_id)  # JSON clients send ids as either numbers or strings
+        with self._cond:
+            for owners in self._queues.values():
+                for owner in list(owners):
+                    tasks = owners[owner]
+                    keep = deque(t for t in tasks if str(t.attempt_id) != attempt_id)
+                    if len(keep) == len(tasks): continue
+                    cancelled.extend(t for t in tasks if str(t.attempt_id) == attempt_id)
+                    if keep: owners[owner] = keep
+                    else: del owners[owner]
+            for task in cancelled:
+                self._forget(task)
+            self._counters["cancelled"] += len(cancelled)
+
+        for task in cancelled:
+            task.future.cancel()
+        return len(cancelled)
+
+    def stats(self):
+        now = time.monotonic()
+        with self._cond:
+            per_priority = {}
+            for priority, owners in self._queues.items():
+                pending = [t for tasks in owners.values() for t in tasks]
+                waits = sorted(self._waits[priority])
+                per_priority[PRIORITY_NAMES[priority]] = {
+                    "queued": len(pending),
+                    "oldest_wait_s": round(max((now - t.enqueued_at for t in pending), default=0), 3),
+                    "avg_wait_s": round(sum(waits) / len(waits), 3) if waits else 0,
+                    "p95_wait_s": round(waits[int(len(waits) * 0.95) - 1], 3) if waits else 0,
+                }
+            return {
+                "queue_depth": self._depth,
+                "max_queue": self.max_queue,
+                "active_workers": self._active,
+                "max_workers": self.max_workers,
+                "owners_waiting": sum(1 for d in self._owner_depth.values() if d),
+                "priorities": per_priority,
+                **self._counters,
+            }
+
+    def shutdown(self, cancel_pending=True):
+        with self._cond:
+            self._shutdown = True
+            pending = []
+            if cancel_pending:
+                for owners in self._queues.values():
+                    for tasks in owners.values(): pending.extend(tasks)
+                    owners.clear()
+                self._depth = 0
+                self._owner_depth.clear()
+            self._cond.notify_all()
+        for task in pending:
+            task.future.cancel()
+
+    # --- INTERNALS (call with self._cond held) ---
+    def _forget(self, task):
+        self._depth -= 1
+        self._owner_depth[task.owner] -= 1
+        if not self._owner_depth[task.owner]:
+            del self._owner_depth[task.owner]
+
+    def _evict_speculative(self):
+        owners = self._queues[PRIORITY_SPECULATIVE]
+        if not owners: return False
+        # Newest speculative task is the least likely to be needed soon
+        owner, tasks = max(owners.items(), key=lambda kv: kv[1][-1].seq)
+        task = tasks.pop()
+        if not tasks: del owners[owner]
+        self._forget(task)
+        self._counters["evicted"] += 1
+        task.future.cancel()
+        return True
+
+    def _next_task(self):
+        for priority in sorted(self._queues):
+            owners = self._queues[priority]
+            if not owners: continue
+            owner, tasks = owners.popitem(last=False)
+            task = tasks.popleft()
+            if tasks: owners[owner] = tasks   # Back of the line for this owner
+            self._forget(task)
+            return task
+        return None
+
+    def _worker_loop(self):
+        while True:
+            with self._cond:
+                task = self._next_task()
+                while task is None:
+                    if self._shutdown: return
+                    self._cond.wait()
+                    task = self._next_task()
+                self._active += 1
+                self._waits[task.priority].append(time.monotonic() - task.enqueued_at)
+
+            try:
+                if task.future.set_running_or_notify_cancel():
+                    try:
+                        task.future.set_result(task.fn(*task.args, **task.kwargs))
+                    except BaseException as e:
+                        task.future.set_exception(e)
+                        with self._cond: self._counters["failed"] += 1
+            finally:
+                with self._cond:
+                    self._active -= 1
+                    self._counters["completed"] += 1
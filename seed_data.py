@@ -4,6 +4,8 @@ import json
 from datetime import datetime, timedelta
 from werkzeug.security import generate_password_hash
 
+from feature_store import rebuild_learner_features
+
 DB_NAME = "learning_app.db"
 
 def create_connection():
@@ -95,5 +97,7 @@ if __name__ == "__main__":
         clear_data(conn)
         seed_users(conn)
         conn.close()
+        # Direct inserts bypass the app's feature updates: resync the model inputs
+        print(f"📊 Rebuilt learner_features for {rebuild_learner_features()} learners.")
     except Exception as e:
         print(f"❌ Error: {e}")
\ No newline at end of file
@@ -0,0 +1,82 @@
+import threading
+from concurrent.futures import Future, TimeoutError
+
+class SingleFlight:
+    """
+    Collapses concurrent calls for the same key into one execution.
+    The first caller (the leader) runs the function; anyone arriving while it
+    is still running waits on the same Future and receives the same result,
+    or the same exception if it fails.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self._stats = {"leaders": 0, "joined": 0, "errors": 0, "timeouts": 0}
+
+    def in_flight(self, key):
+        with self._lock:
+            return key in self._in_flight
+
+    def claim(self, key):
+        """
+        Low-level form of do() for work that can't be wrapped in a single call
+        (e.g. a streamed generation). Returns (future, is_leader).
+        A leader must finish the flight with resolve() or fail().
+        """
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is not None:
+                self._stats["joined"] += 1
+                return future, False
+            future = Future()
+            self._in_flight[key] = future
+            self._stats["leaders"] += 1
+            return future, True
+
+    def resolve(self, key, result):
+        with self._lock:
+            future = self._in_flight[key]
+        future.set_result(result)
+        with self._lock:
+            self._in_flight.pop(key, None)
+
+    def fail(self, key, exc):
+        with self._lock:
+            future = self._in_flight[key]
+            self._stats["errors"] += 1
+        future.set_exception(exc)
+        with self._lock:
+            self._in_flight.pop(key, None)
+
+    def wait(self, future, timeout=None):
+        """Waits on a joined flight; raises concurrent.futures.TimeoutError after `timeout`."""
+        try:
+            return future.result(timeout=timeout)
+        except TimeoutError:
+            with self._lock: self._stats["timeouts"] += 1
+            raise
+
+    def do(self, key, fn, *args, timeout=None, **kwargs):
+        """
+        Runs fn(*args, **kwargs) once per key at a time.
+        `timeout` only applies to callers that join an existing flight;
+        they get concurrent.futures.TimeoutError if the leader takes longer.
+        """
+        future, is_leader = self.claim(key)
+        if not is_leader:
+            return self.wait(future, timeout)
+
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            self.fail(key, e)
+            raise
+        self.resolve(key, result)
+        return result
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["in_flight"] = len(self._in_flight)
+        return stats